@@ -0,0 +1,92 @@
+"""
+Microbenchmark of the elect-sign and disjoint-merge step of TIES merging.
+
+Compares `resolve_sign` + `disjoint_merge` with the fused `elect_sign_disjoint_merge`
+kernel (eager and `torch.compile`-d), reporting the run time and the total size of the
+tensors allocated during one call, which is a proxy of the memory traffic.
+
+Example:
+    python experiment_utils/benchmark_ties_kernel.py --num_models 8 --num_params 20000000
+"""
+
+import argparse
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from fusion_bench.method.ties_merging.ties_merging_utils import (
+    disjoint_merge,
+    elect_sign_disjoint_merge,
+    resolve_sign,
+    topk_values_mask,
+)
+
+
+def allocated_bytes(fn):
+    with profile(activities=[ProfilerActivity.CPU], profile_memory=True) as prof:
+        fn()
+    return sum(
+        event.self_cpu_memory_usage
+        for event in prof.events()
+        if event.self_cpu_memory_usage > 0
+    )
+
+
+def run_time(fn, repeats: int):
+    fn()  # warm up
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--num_models", type=int, default=8)
+    parser.add_argument("--num_params", type=int, default=10_000_000)
+    parser.add_argument("--threshold", type=float, default=20)
+    parser.add_argument("--merge_func", type=str, default="mean")
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    task_vectors = torch.randn(args.num_models, args.num_params)
+    trimmed, *_ = topk_values_mask(task_vectors, K=args.threshold)
+    del task_vectors
+
+    kernels = {
+        "resolve_sign + disjoint_merge": lambda: disjoint_merge(
+            trimmed, args.merge_func, resolve_sign(trimmed)
+        ),
+        "elect_sign_disjoint_merge": lambda: elect_sign_disjoint_merge(
+            trimmed, args.merge_func
+        ),
+        "elect_sign_disjoint_merge (compiled)": lambda: elect_sign_disjoint_merge(
+            trimmed, args.merge_func, compile=True
+        ),
+    }
+
+    reference = None
+    input_bytes = trimmed.nbytes
+    print(
+        f"input: {args.num_models} x {args.num_params} {trimmed.dtype} "
+        f"({input_bytes / 2**20:.1f} MiB), merge_func={args.merge_func}"
+    )
+    for name, fn in kernels.items():
+        output = fn()
+        if reference is None:
+            reference = output
+        seconds = run_time(fn, args.repeats)
+        nbytes = allocated_bytes(fn)
+        print(
+            f"{name:40s} time: {seconds * 1000:9.1f} ms  "
+            f"allocated: {nbytes / 2**20:9.1f} MiB ({nbytes / input_bytes:.2f}x input)  "
+            f"equal: {torch.equal(output, reference)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
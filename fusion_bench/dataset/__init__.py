@@ -4,7 +4,7 @@ from omegaconf import DictConfig, open_dict
 
 from fusion_bench.utils import instantiate
 
-from .clip_dataset import CLIPDataset
+from .clip_dataset import CLIPCollator, CLIPDataset, PreprocessedCLIPDataset
 
 
 def load_dataset_from_config(dataset_config: DictConfig):
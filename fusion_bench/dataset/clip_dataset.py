@@ -2,12 +2,22 @@
 This module provides a class to convert a dataset whose object is a list of dictionaries with keys "image" and "label" to a dataset whose object is a tuple of tensors (inputs, label) for CLIP models.
 """
 
-from typing import Optional, Tuple
+import json
+import logging
+import math
+import os
+import shutil
+from pathlib import Path
+from typing import Any, List, Optional, Tuple, Union
 
 import torch
 from transformers import CLIPProcessor, ProcessorMixin
 
-__all__ = ["CLIPDataset"]
+from fusion_bench.utils.cache_utils import TensorCache
+
+__all__ = ["CLIPDataset", "PreprocessedCLIPDataset", "CLIPCollator"]
+
+log = logging.getLogger(__name__)
 
 
 class CLIPDataset(torch.utils.data.Dataset):
@@ -50,15 +60,7 @@ class CLIPDataset(torch.utils.data.Dataset):
             ValueError: If the item is neither a dictionary nor a tuple/list of length 2.
         """
         try:
-            item = self.dataset[idx]
-            if isinstance(item, dict):
-                item = item
-            elif isinstance(item, (tuple, list)):
-                assert len(item) == 2, "Each item should be a tuple or list of length 2"
-                item = {"image": item[0], "label": item[1]}
-            else:
-                raise ValueError("Each item should be a dictionary or a tuple of length 2")
-            image = item["image"]
+            image, label = self.get_raw_item(idx)
             if self.processor is not None:
                 if isinstance(self.processor, ProcessorMixin):
                     # Apply the processor to the image to get the input tensor
@@ -74,12 +76,303 @@ class CLIPDataset(torch.utils.data.Dataset):
             else:
                 # if processor is None, return the raw image directly
                 inputs = image
-            # convert boolean label to int, this is for the case when the label is a binary classification task
-            if isinstance(item["label"], bool):
-                item["label"] = 1 if item["label"] else 0
-            return inputs, item["label"]
+            return inputs, label
         
         except Exception as e:
             print(f"Skipping bad sample at index {idx}: {e}")
             return None
-            
\ No newline at end of file
+
+    def get_raw_item(self, idx: int) -> Tuple[Any, int]:
+        """
+        Retrieves an item from the dataset without preprocessing.
+
+        Returns:
+            tuple: A tuple containing the raw image and the label.
+        """
+        item = self.dataset[idx]
+        if isinstance(item, dict):
+            item = item
+        elif isinstance(item, (tuple, list)):
+            assert len(item) == 2, "Each item should be a tuple or list of length 2"
+            item = {"image": item[0], "label": item[1]}
+        else:
+            raise ValueError("Each item should be a dictionary or a tuple of length 2")
+        # convert boolean label to int, this is for the case when the label is a binary classification task
+        if isinstance(item["label"], bool):
+            item["label"] = 1 if item["label"] else 0
+        return item["image"], item["label"]
+
+
+class PreprocessedCLIPDataset(CLIPDataset):
+    """
+    A `CLIPDataset` whose preprocessed images are computed once and stored in a memory-mapped file.
+
+    On the first use, the images are preprocessed in batches and their `pixel_values` are written to
+    `cache_dir`, together with the labels. The next instances with the same dataset and processor
+    configuration read the `pixel_values` from the memory-mapped file: an item is a slice of the file,
+    no image is decoded or resized again.
+
+    The `pixel_values` are stored as float16 by default, as float32 (no conversion on access), or as uint8
+    (the resized and cropped images before rescaling and normalization, which are applied on access).
+    The items are returned as float32 tensors, and the bad samples as None, as in `CLIPDataset`.
+
+    Args:
+        dataset: The original dataset to wrap.
+        processor (CLIPProcessor): The CLIP processor for preparing inputs, or a callable transform returning a tensor.
+        cache_dir (Union[str, Path]): The directory of the preprocessed datasets.
+        name (Optional[str]): A name identifying the dataset in the cache, e.g. "mnist/test".
+            Required if the dataset has no fingerprint (as the datasets of Hugging Face `datasets` have).
+        storage_dtype (str): One of "float16", "float32" and "uint8". "uint8" requires a `CLIPProcessor`.
+        batch_size (int): The number of images preprocessed at once while building the cache.
+    """
+
+    _STORAGE_DTYPES = {
+        "float16": torch.float16,
+        "float32": torch.float32,
+        "uint8": torch.uint8,
+    }
+
+    def __init__(
+        self,
+        dataset,
+        processor: Union[CLIPProcessor, Any],
+        cache_dir: Union[str, Path],
+        name: Optional[str] = None,
+        storage_dtype: str = "float16",
+        batch_size: int = 64,
+    ):
+        super().__init__(dataset, processor)
+        if processor is None:
+            raise ValueError("A processor is required to preprocess the images.")
+        if storage_dtype not in self._STORAGE_DTYPES:
+            raise ValueError(f"Unknown storage dtype: {storage_dtype}")
+        if storage_dtype == "uint8" and not isinstance(processor, ProcessorMixin):
+            raise ValueError('storage_dtype="uint8" requires a CLIPProcessor.')
+        self.storage_dtype = storage_dtype
+        self.batch_size = batch_size
+
+        fingerprint = getattr(dataset, "_fingerprint", None)
+        if name is None and fingerprint is None:
+            raise ValueError(
+                "`name` is required for a dataset without fingerprint, to identify it in the cache."
+            )
+        if isinstance(processor, ProcessorMixin):
+            processor_config = processor.image_processor.to_dict()
+        else:
+            processor_config = repr(processor)
+        key = TensorCache.make_key(
+            name=name,
+            fingerprint=fingerprint,
+            num_samples=len(dataset),
+            processor=processor_config,
+            storage_dtype=storage_dtype,
+        )
+        self.cache_path = Path(cache_dir) / key
+        if not (self.cache_path / "meta.json").exists():
+            self._build_cache()
+
+        with open(self.cache_path / "meta.json") as f:
+            self._meta = json.load(f)
+        self.labels, self.valid = torch.load(
+            self.cache_path / "labels.pt", weights_only=True
+        )
+        self._pixel_values = None
+
+        if storage_dtype == "uint8":
+            image_processor = processor.image_processor
+            shape = (-1, 1, 1)
+            self._rescale_factor = image_processor.rescale_factor
+            self._image_mean = torch.tensor(image_processor.image_mean).view(shape)
+            self._image_std = torch.tensor(image_processor.image_std).view(shape)
+
+    def __getstate__(self):
+        # the mapped file is not pickled, each data loader worker maps it again
+        state = self.__dict__.copy()
+        state["_pixel_values"] = None
+        return state
+
+    @property
+    def pixel_values(self) -> torch.Tensor:
+        """The preprocessed images of shape (num_samples, channels, height, width), backed by the mapped file."""
+        if self._pixel_values is None:
+            shape = self._meta["shape"]
+            self._pixel_values = torch.from_file(
+                str(self.cache_path / "pixel_values.bin"),
+                shared=False,
+                size=math.prod(shape),
+                dtype=self._STORAGE_DTYPES[self.storage_dtype],
+            ).view(shape)
+        return self._pixel_values
+
+    def __getitem__(self, idx: int) -> Optional[Tuple[torch.Tensor, int]]:
+        if not self.valid[idx]:
+            return None
+        inputs = self.pixel_values[idx]
+        if self.storage_dtype == "uint8":
+            inputs = (
+                inputs.float() * self._rescale_factor - self._image_mean
+            ) / self._image_std
+        else:
+            inputs = inputs.float()
+        return inputs, self.labels[idx].item()
+
+    def _preprocess(self, images: List[Any]) -> torch.Tensor:
+        if self.storage_dtype == "uint8":
+            # keep the resized and cropped images, rescaling and normalization are applied on access
+            return self.processor.image_processor(
+                images, do_rescale=False, do_normalize=False, return_tensors="pt"
+            )["pixel_values"].round()
+        if isinstance(self.processor, ProcessorMixin):
+            return self.processor(images=images, return_tensors="pt")["pixel_values"]
+        return torch.stack([self.processor(image) for image in images])
+
+    def _preprocess_batch(self, indices: List[int]):
+        """
+        Preprocess the items `indices`, one by one if the batch fails. Returns the indices of the
+        valid items, their labels and their `pixel_values`.
+        """
+        items = {}
+        for idx in indices:
+            try:
+                items[idx] = self.get_raw_item(idx)
+            except Exception as e:
+                print(f"Skipping bad sample at index {idx}: {e}")
+        try:
+            pixel_values = self._preprocess([image for image, _ in items.values()])
+            valid_indices = list(items)
+        except Exception:
+            valid_indices, pixel_values = [], []
+            for idx, (image, _) in items.items():
+                try:
+                    pixel_values.append(self._preprocess([image])[0])
+                    valid_indices.append(idx)
+                except Exception as e:
+                    print(f"Skipping bad sample at index {idx}: {e}")
+            pixel_values = torch.stack(pixel_values) if len(pixel_values) > 0 else None
+        labels = [items[idx][1] for idx in valid_indices]
+        return valid_indices, labels, pixel_values
+
+    def _build_cache(self):
+        log.info(f"Preprocessing {len(self)} images to {self.cache_path}")
+        num_samples = len(self)
+        dtype = self._STORAGE_DTYPES[self.storage_dtype]
+        tmp_path = self.cache_path.with_name(f"{self.cache_path.name}.{os.getpid()}.tmp")
+        tmp_path.mkdir(parents=True, exist_ok=True)
+
+        labels = torch.zeros(num_samples, dtype=torch.int64)
+        valid = torch.zeros(num_samples, dtype=torch.bool)
+        storage = None
+        for start in range(0, num_samples, self.batch_size):
+            indices = list(range(start, min(start + self.batch_size, num_samples)))
+            valid_indices, batch_labels, pixel_values = self._preprocess_batch(indices)
+            if len(valid_indices) == 0:
+                continue
+            if storage is None:
+                # the size of the file is known once the first image is preprocessed
+                shape = [num_samples, *pixel_values.shape[1:]]
+                storage = torch.from_file(
+                    str(tmp_path / "pixel_values.bin"),
+                    shared=True,
+                    size=math.prod(shape),
+                    dtype=dtype,
+                ).view(shape)
+            storage[valid_indices] = pixel_values.to(dtype)
+            labels[valid_indices] = torch.as_tensor(batch_labels, dtype=torch.int64)
+            valid[valid_indices] = True
+        if storage is None:
+            raise RuntimeError("No valid image in the dataset.")
+        del storage
+
+        torch.save((labels, valid), tmp_path / "labels.pt")
+        with open(tmp_path / "meta.json", "w") as f:
+            json.dump({"shape": shape, "storage_dtype": self.storage_dtype}, f)
+        try:
+            os.rename(tmp_path, self.cache_path)
+        except OSError:
+            # another process has built the same cache
+            shutil.rmtree(tmp_path, ignore_errors=True)
+
+
+class CLIPCollator:
+    """
+    A collate function that preprocesses a batch of raw images with a single processor call.
+
+    It is used with a `CLIPDataset` without processor, which returns the raw images, so that the
+    image processor runs once per batch instead of once per image. The bad samples (None) are skipped
+    as in `skip_none_collate_fn`, and so are the images that the processor fails on.
+
+    Examples:
+        >>> dataset = CLIPDataset(test_dataset, processor=None)
+        >>> collate_fn = CLIPCollator(processor)
+        >>> collate_fn.check(dataset)
+        >>> loader = DataLoader(dataset, batch_size=128, collate_fn=collate_fn)
+
+    Args:
+        processor (CLIPProcessor): The CLIP processor, or a callable transform of a single image returning a tensor.
+    """
+
+    def __init__(self, processor: Union[CLIPProcessor, Any]):
+        self.processor = processor
+
+    def _preprocess(self, images: List[Any]) -> torch.Tensor:
+        if isinstance(self.processor, ProcessorMixin):
+            return self.processor(images=images, return_tensors="pt")["pixel_values"]
+        elif callable(self.processor):
+            return torch.stack([self.processor(image) for image in images])
+        else:
+            raise ValueError(
+                "The processor should be a CLIPProcessor or a callable function"
+            )
+
+    def __call__(
+        self, batch: List[Optional[Tuple[Any, int]]]
+    ) -> Optional[Tuple[torch.Tensor, torch.Tensor]]:
+        batch = [b for b in batch if b is not None]
+        if len(batch) == 0:
+            return None
+        images, labels = tuple(zip(*batch))
+        try:
+            inputs = self._preprocess(list(images))
+        except Exception:
+            # find the bad images
+            valid_inputs, valid_labels = [], []
+            for image, label in batch:
+                try:
+                    valid_inputs.append(self._preprocess([image])[0])
+                    valid_labels.append(label)
+                except Exception as e:
+                    print(f"Skipping bad sample: {e}")
+            if len(valid_inputs) == 0:
+                return None
+            inputs, labels = torch.stack(valid_inputs), valid_labels
+        return inputs, torch.as_tensor(labels)
+
+    def check(self, dataset: CLIPDataset, num_samples: int = 8, atol: float = 1e-5):
+        """
+        Check that the batched preprocessing of the first `num_samples` items of `dataset` matches
+        the per-sample preprocessing of `CLIPDataset`.
+
+        Raises:
+            ValueError: If the outputs differ by more than `atol`.
+        """
+        reference = CLIPDataset(dataset.dataset, self.processor)
+        indices = range(min(num_samples, len(dataset)))
+        expected = [reference[idx] for idx in indices]
+        expected = [item for item in expected if item is not None]
+        batch = self([dataset[idx] for idx in indices])
+        if len(expected) == 0 and batch is None:
+            return
+        if batch is None or len(batch[0]) != len(expected):
+            raise ValueError(
+                "Batched preprocessing does not return the same samples as per-sample preprocessing."
+            )
+        inputs, labels = batch
+        for idx, (expected_inputs, expected_label) in enumerate(expected):
+            if (
+                inputs[idx].shape != expected_inputs.shape
+                or not torch.allclose(inputs[idx], expected_inputs, atol=atol)
+                or labels[idx].item() != expected_label
+            ):
+                raise ValueError(
+                    f"Batched preprocessing differs from per-sample preprocessing at index {idx}."
+                )
@@ -35,6 +35,7 @@ _import_structure = {
     "weighted_average": ["WeightedAverageAlgorithm", "WeightedAverageForLLama"],
     "task_arithmetic": ["TaskArithmeticAlgorithm"],
     "ties_merging": ["TiesMergingAlgorithm"],
+    "streaming_merge": ["StreamingMergeAlgorithm"],
     "dare": ["DareSimpleAverage", "DareTaskArithmetic", "DareTiesMerging"],
     "fisher_merging": [
         "FisherMergingForCLIPVisionModel",
@@ -203,6 +204,7 @@ if TYPE_CHECKING:
         PCPSparseLoForLlama,
         SparseLoForLlama,
     )
+    from .streaming_merge import StreamingMergeAlgorithm
     from .task_arithmetic import TaskArithmeticAlgorithm
     from .task_singular_vector import TaskSingularVectorMerging
     from .ties_merging import TiesMergingAlgorithm
@@ -99,6 +99,7 @@ class LayerWiseAdaMergingAlgorithm(
             clamp_weights=self.config.clamp_weights,
             tie_weights=self.config.tie_weights,
             strict=self.config.strict,
+            task_vector_layout=self.config.get("task_vector_layout", "models"),
         )
         print(f"{layer_wise_weight.size()=}, {layer_wise_weight.numel()=}")
         return module
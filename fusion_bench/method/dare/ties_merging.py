@@ -4,7 +4,11 @@ import torch
 from torch import Tensor, nn
 
 from fusion_bench import BaseAlgorithm, BaseModelPool
-from fusion_bench.method.ties_merging.ties_merging_utils import ties_merging
+from fusion_bench.method.ties_merging.ties_merging_utils import (
+    merged_task_vector_to_state_dict,
+    ties_merging,
+    ties_merging_streaming,
+)
 from fusion_bench.utils.parameters import state_dict_to_vector, vector_to_state_dict
 from fusion_bench.utils.state_dict_arithmetic import state_dict_sum
 
@@ -28,6 +32,9 @@ class DareTiesMerging(BaseAlgorithm):
         threshold: int,
         remove_keys: list[str],
         merge_func: Literal["sum", "mean", "max"],
+        streaming: bool = False,
+        threshold_mode: Literal["model", "global"] = "model",
+        chunk_size: int = 2**24,
         **kwargs,
     ):
         self.sparsity_ratio = sparsity_ratio
@@ -37,6 +44,9 @@ class DareTiesMerging(BaseAlgorithm):
         self.threshold = threshold
         self.remove_keys = remove_keys
         self.merge_func = merge_func
+        self.streaming = streaming
+        self.threshold_mode = threshold_mode
+        self.chunk_size = chunk_size
         super().__init__(**kwargs)
 
     @torch.no_grad()
@@ -76,6 +86,22 @@ class DareTiesMerging(BaseAlgorithm):
                 module_random_drop_(tv, self.sparsity_ratio, rescale=self.rescale)
 
         ptm_check = pretrained_model.state_dict()
+        if self.streaming or self.threshold_mode != "model":
+            merged_tv = ties_merging_streaming(
+                [tv.state_dict() for tv in task_vectors.values()],
+                reset_thresh=self.threshold,
+                merge_func=self.merge_func,
+                remove_keys=self.remove_keys,
+                threshold_mode=self.threshold_mode,
+                chunk_size=self.chunk_size,
+            )
+            del task_vectors
+            merged_state_dict = merged_task_vector_to_state_dict(
+                merged_tv, ptm_check, self.scaling_factor, remove_keys=self.remove_keys
+            )
+            pretrained_model.load_state_dict(merged_state_dict)
+            return pretrained_model
+
         flat_ptm = state_dict_to_vector(ptm_check, self.remove_keys)
         tv_flat_checks = torch.vstack(
             [
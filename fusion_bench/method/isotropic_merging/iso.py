@@ -1,6 +1,7 @@
-from typing import List
+from typing import List, Optional
 
 import torch
+from omegaconf import DictConfig
 
 from fusion_bench import BaseAlgorithm, BaseModelPool
 from fusion_bench.mixins import LightningFabricMixin
@@ -9,6 +10,7 @@ from fusion_bench.utils.state_dict_arithmetic import (
     state_dict_mul,
     state_dict_sub,
 )
+from fusion_bench.utils.svd_scheduler import SVDScheduler
 
 from .iso_utils import check_parameterNamesMatch, iso_c, iso_cts
 
@@ -22,9 +24,11 @@ class IsotropicMergingInCommonSubspace(BaseAlgorithm, LightningFabricMixin):
         self,
         scaling_factor: float,
         exclude_keys: List[str] = None,
+        svd_scheduler: Optional[DictConfig] = None,
     ):
         self.scaling_factor = scaling_factor
         self.exclude_keys = exclude_keys
+        self.svd_scheduler = svd_scheduler
         super().__init__()
 
     def run(self, modelpool: BaseModelPool):
@@ -47,6 +51,7 @@ class IsotropicMergingInCommonSubspace(BaseAlgorithm, LightningFabricMixin):
             task_vectors,
             accelerator=self.fabric.device,
             exclude_keys=self.exclude_keys,
+            svd_scheduler=SVDScheduler(**(self.svd_scheduler or {})),
         )
 
         # merged_parameters = pretrained_parameters + scaling_factor * merged_task_vector
@@ -135,10 +140,12 @@ class IsotropicMergingInCommonAndTaskSubspace(BaseAlgorithm, LightningFabricMixi
         scaling_factor: float,
         common_space_fraction: float,
         exclude_keys: List[str] = None,
+        svd_scheduler: Optional[DictConfig] = None,
     ):
         self.common_space_fraction = common_space_fraction
         self.scaling_factor = scaling_factor
         self.exclude_keys = exclude_keys
+        self.svd_scheduler = svd_scheduler
         super().__init__()
 
     def run(self, modelpool: BaseModelPool):
@@ -162,6 +169,7 @@ class IsotropicMergingInCommonAndTaskSubspace(BaseAlgorithm, LightningFabricMixi
             common_space_fraction=self.common_space_fraction,
             accelerator=self.fabric.device,
             exclude_keys=self.exclude_keys,
+            svd_scheduler=SVDScheduler(**(self.svd_scheduler or {})),
         )
 
         # merged_parameters = pretrained_parameters + scaling_factor * merged_task_vector
@@ -1,48 +1,64 @@
 import math
-from typing import List
+from typing import List, Optional
 
 import torch
+from torch import Tensor
 
 from fusion_bench.utils import timeit_context
+from fusion_bench.utils.svd_scheduler import SVDScheduler
 from fusion_bench.utils.type import StateDictType
 
 
+def _isotropic_spectrum(matrix: Tensor) -> Tensor:
+    """
+    Replace the singular values of the (batch of) matrices with their mean.
+    """
+    U, S, V = torch.linalg.svd(matrix, full_matrices=False)
+    S_mean = S.mean(dim=-1, keepdim=True)
+    return (U * S_mean.unsqueeze(-2)) @ V
+
+
 def iso_c(
     task_vectors: List[StateDictType],
     accelerator="cuda",
     exclude_keys: List[str] = None,
+    svd_scheduler: Optional[SVDScheduler] = None,
 ) -> StateDictType:
     exclude_keys = [] if exclude_keys is None else exclude_keys
+    svd_scheduler = SVDScheduler() if svd_scheduler is None else svd_scheduler
 
     with torch.no_grad(), timeit_context("ISO-C Merging"):
         new_vector = {}
-        for key in task_vectors[0]:
-            print(f"Merging {key}...")
-            original_device = task_vectors[0][key].device
-            tvs = [
-                task_vector[key].to(device=accelerator, non_blocking=True)
-                for task_vector in task_vectors
-            ]
-            num_tvs = len(tvs)
-            new_vector[key] = sum(tvs) / num_tvs
-            del tvs  # free memory
-
-            if len(task_vectors[0][key].shape) == 2 and key not in exclude_keys:
-                # if the key is a 2D matrix, we need to merge the task vectors in the common space
-                new_vector[key] *= num_tvs
-                U, S, V = torch.linalg.svd(new_vector[key], full_matrices=False)
-                S_mean = torch.ones_like(S) * S.mean()
-
-                new_vector[key] = torch.linalg.multi_dot(
-                    (
-                        U,
-                        torch.diag(S_mean),
-                        V,
+
+        def summed_task_vectors():
+            for key in task_vectors[0]:
+                print(f"Merging {key}...")
+                original_device = task_vectors[0][key].device
+                tvs = [
+                    task_vector[key].to(device=accelerator, non_blocking=True)
+                    for task_vector in task_vectors
+                ]
+                num_tvs = len(tvs)
+                merged_tv = sum(tvs) / num_tvs
+                del tvs  # free memory
+
+                if len(task_vectors[0][key].shape) == 2 and key not in exclude_keys:
+                    # if the key is a 2D matrix, we need to merge the task vectors in the common space
+                    merged_tv *= num_tvs
+                    yield key, merged_tv
+                else:
+                    new_vector[key] = merged_tv.to(
+                        device=original_device, non_blocking=True
                     )
-                )
-            new_vector[key] = new_vector[key].to(
-                device=original_device, non_blocking=True
+
+        # the SVDs of the layers are independent, let the scheduler run them
+        for key, merged_tv in svd_scheduler.imap(
+            summed_task_vectors(), svd_fn=_isotropic_spectrum
+        ):
+            new_vector[key] = merged_tv.to(
+                device=task_vectors[0][key].device, non_blocking=True
             )
+        new_vector = {key: new_vector[key] for key in task_vectors[0]}
     return new_vector
 
 
@@ -52,8 +68,10 @@ def iso_cts(
     common_space_fraction: float,
     accelerator: str = "cuda",
     exclude_keys: List[str] = None,
+    svd_scheduler: Optional[SVDScheduler] = None,
 ):
     exclude_keys = [] if exclude_keys is None else exclude_keys
+    svd_scheduler = SVDScheduler() if svd_scheduler is None else svd_scheduler
     new_vector = {}
 
     print("ISO-CTS Merging")
@@ -100,12 +118,16 @@ def iso_cts(
 
             ### Calculate task specific space ###
             n_dims_per_task = int((min(shape_) - common_space_index_s) / len(task_vectors))
-            for i, task_vector in enumerate(task_vectors):
-                w = task_vector[key].to(device=accelerator)
 
-                # calculate the projection onto task specific space to remove the common space
-                w_ts = w - common_space_u @ common_space_u.T @ w
-                u_ts, s_ts, v_ts = torch.linalg.svd(w_ts, full_matrices=False)
+            def task_specific_matrices():
+                for i, task_vector in enumerate(task_vectors):
+                    w = task_vector[key].to(device=accelerator)
+
+                    # calculate the projection onto task specific space to remove the common space
+                    yield i, w - common_space_u @ common_space_u.T @ w
+
+            # the SVDs of the tasks are independent, let the scheduler run them
+            for i, (u_ts, s_ts, v_ts) in svd_scheduler.imap(task_specific_matrices()):
 
                 if i == 0:
                     combined_space_u = torch.zeros_like(u_ts, device=accelerator)
@@ -139,11 +161,14 @@ def iso_cts(
             ] = common_space_v
 
             ### Orthogonalize combined_space_u and combined_space_v ###
-            u_combined_space_u, s_combined_space_u, v_combined_space_u = torch.linalg.svd(
-                combined_space_u, full_matrices=False
+            orthogonalization_svds = svd_scheduler.map(
+                {"u": combined_space_u, "v": combined_space_v}
+            )
+            u_combined_space_u, s_combined_space_u, v_combined_space_u = (
+                orthogonalization_svds["u"]
             )
-            u_combined_space_v, s_combined_space_v, v_combined_space_v = torch.linalg.svd(
-                combined_space_v, full_matrices=False
+            u_combined_space_v, s_combined_space_v, v_combined_space_v = (
+                orthogonalization_svds["v"]
             )
             combined_space_u = u_combined_space_u @ v_combined_space_u
             combined_space_v = u_combined_space_v @ v_combined_space_v
@@ -1,10 +1,11 @@
+import logging
 import os
 import random
 import time
 from collections import defaultdict
 from copy import deepcopy
 from pathlib import Path
-from typing import TYPE_CHECKING, List, Literal, Optional, Tuple, cast
+from typing import TYPE_CHECKING, Dict, List, Literal, Optional, Tuple, cast
 
 import lightning as L
 import numpy as np
@@ -17,16 +18,24 @@ from transformers import CLIPVisionModel
 from fusion_bench import BaseAlgorithm, BaseModelPool
 from fusion_bench.mixins import LightningFabricMixin, SimpleProfilerMixin
 from fusion_bench.taskpool import CLIPVisionModelTaskPool
-from fusion_bench.utils import instantiate
+from fusion_bench.utils import SVDScheduler, instantiate
 from fusion_bench.utils.json import load_from_json, save_to_json
 from fusion_bench.utils.parameters import state_dict_to_vector
 from fusion_bench.utils.state_dict_arithmetic import state_dict_sub
 
-from .utils import frobenius_inner_product, get_task_vector_norm, is_leaf_module, svd
+from .utils import (
+    frobenius_inner_product,
+    get_task_vector_norm,
+    is_leaf_module,
+    svd,
+    warm_started_svd,
+)
 
 if TYPE_CHECKING:
     from torch.utils.tensorboard import SummaryWriter
 
+log = logging.getLogger(__name__)
+
 
 class OPCMForCLIP(
     BaseAlgorithm,
@@ -40,6 +49,10 @@ class OPCMForCLIP(
         seed: Optional[int] = None,
         save_on_every_step: bool = True,
         evaluate_on_every_step: bool = False,
+        svd_scheduler: Optional[DictConfig] = None,
+        incremental_svd_rank: Optional[int] = None,
+        incremental_svd_oversampling: int = 10,
+        incremental_svd_niter: int = 2,
         **kwargs,
     ):
         """
@@ -51,12 +64,24 @@ class OPCMForCLIP(
             seed (Optional[int]): the seed to use.
             save_on_every_step (bool): whether to save the merged model on every step.
             evaluate_on_every_step (bool): whether to evaluate the merged model on every step.
+            svd_scheduler (Optional[DictConfig]): the arguments of the `SVDScheduler` that runs the SVDs of the linear layers.
+            incremental_svd_rank (Optional[int]): if set, only the leading `incremental_svd_rank` singular triplets of
+                the merged task vectors are computed, with a subspace iteration warm-started from the decomposition
+                of the previous step, instead of full SVDs. Only the components of the new task vectors along these
+                singular directions are projected out, and the split rank is capped at `incremental_svd_rank`
+                (a warning is logged when the full SVD would split beyond it).
+            incremental_svd_oversampling (int): the number of additional directions of the incremental SVD.
+            incremental_svd_niter (int): the number of power iterations of the incremental SVD.
         """
         self.alpha = alpha
         self.shuffle_order = shuffle_order
         self.seed = seed
         self.save_on_every_step = save_on_every_step
         self.evaluate_on_every_step = evaluate_on_every_step
+        self.svd_scheduler = svd_scheduler
+        self.incremental_svd_rank = incremental_svd_rank
+        self.incremental_svd_oversampling = incremental_svd_oversampling
+        self.incremental_svd_niter = incremental_svd_niter
         super().__init__(**kwargs)
 
     @torch.no_grad()
@@ -107,6 +132,8 @@ class OPCMForCLIP(
 
         self.previous_lambda_t = 1
         self.lambda_t = None
+        # the right singular vectors of the merged task vectors of the linear layers, for the incremental SVD
+        self._incremental_svd_states: Dict[str, Tensor] = {}
         self.fabric.log("model/lambda_t", self.previous_lambda_t, step=0)
         self.fabric.log("empirical/lambda_t", 1, step=0)
 
@@ -138,6 +165,10 @@ class OPCMForCLIP(
 
                 self.lambda_t = 1  # temporary value
 
+                # the SVDs of the previous merged task vectors of the linear layers, in the order of the modules
+                svd_results = self.compute_linear_svds(
+                    merged_model, pretrained_model, accelerator
+                )
                 for module_name, module in tqdm(
                     list(merged_model.named_modules()),
                     desc=f"Processing {model_name}",
@@ -147,6 +178,8 @@ class OPCMForCLIP(
                         continue
 
                     if isinstance(module, nn.Linear):
+                        svd_module_name, svd_cache = next(svd_results)
+                        assert svd_module_name == module_name
                         module.weight.data = self.merge_linear_weights(
                             module.weight,
                             pretrained_model.get_submodule(module_name).weight,
@@ -154,6 +187,7 @@ class OPCMForCLIP(
                             param_name=".".join([module_name, "weight"]),
                             alpha=self.alpha,
                             accelerator=accelerator,
+                            svd_cache=svd_cache,
                         )
                         if module.bias is not None:
                             module.bias.data = self.merge_other_parameters(
@@ -223,6 +257,55 @@ class OPCMForCLIP(
             Path(self.log_dir) / "checkpoints" / f"merged_model_{step}"
         )
 
+    def compute_linear_svds(
+        self,
+        merged_model: nn.Module,
+        pretrained_model: nn.Module,
+        accelerator: str = "cpu",
+    ):
+        """
+        Compute the SVDs of the merged task vectors of the linear layers with the SVD scheduler.
+
+        The SVDs are computed lazily, in the order of `merged_model.named_modules()`, and each
+        task vector is read before the corresponding layer is updated.
+        If `incremental_svd_rank` is set, the truncated SVDs are warm-started from the ones of the
+        previous step and computed one after the other.
+
+        Returns:
+            Iterator[Tuple[str, Tuple[Tensor, Tensor, Tensor]]]: The module names and the (u, s, v) of their task vectors.
+        """
+        svd_scheduler = SVDScheduler(**(self.svd_scheduler or {}))
+
+        def merged_task_vectors():
+            for module_name, module in merged_model.named_modules():
+                if is_leaf_module(module) and isinstance(module, nn.Linear):
+                    pretrained_W = pretrained_model.get_submodule(module_name).weight
+                    yield module_name, module.weight.to(
+                        accelerator
+                    ) - pretrained_W.to(accelerator)
+
+        if self.incremental_svd_rank is not None:
+            return (
+                (module_name, self.incremental_svd(module_name, merged_tv))
+                for module_name, merged_tv in merged_task_vectors()
+            )
+        return svd_scheduler.imap(merged_task_vectors(), svd_fn=svd)
+
+    def incremental_svd(self, module_name: str, merged_tv: Tensor):
+        """
+        Compute the leading singular triplets of the merged task vector of a linear layer,
+        starting from the right singular vectors of the previous step.
+        """
+        u, s, v = warm_started_svd(
+            merged_tv,
+            rank=self.incremental_svd_rank,
+            v0=self._incremental_svd_states.get(module_name),
+            oversampling=self.incremental_svd_oversampling,
+            niter=self.incremental_svd_niter,
+        )
+        self._incremental_svd_states[module_name] = v
+        return u, s, v
+
     def merge_linear_weights(
         self,
         merged_W: Tensor,
@@ -231,6 +314,7 @@ class OPCMForCLIP(
         param_name: str,
         alpha: float,
         accelerator: str = "cpu",
+        svd_cache: Optional[Tuple[Tensor, Tensor, Tensor]] = None,
     ):
         original_device = merged_W.device
         merged_W = merged_W.to(accelerator)
@@ -240,16 +324,49 @@ class OPCMForCLIP(
         previous_merged_tv = merged_W - pretrained_W
         task_tv = task_W - pretrained_W
 
-        u, s, v = svd(previous_merged_tv)
+        if svd_cache is None:
+            u, s, v = svd(previous_merged_tv)
+        else:
+            u, s, v = svd_cache
         rank = s.size(0)
-        split_rank = (s.cumsum(dim=0) / s.sum() > alpha).float().argmax().item()
+        if self.incremental_svd_rank is None:
+            split_rank = (s.cumsum(dim=0) / s.sum() > alpha).float().argmax().item()
 
-        projected_task_tv = u.T @ task_tv @ v
-        projected_task_tv.diagonal().fill_(0)
+            projected_task_tv = u.T @ task_tv @ v
+            projected_task_tv.diagonal().fill_(0)
+
+            projected_task_tv[:split_rank, :split_rank] = 0
+
+            cleaned_task_tv = u @ projected_task_tv @ v.T
+        else:
+            # only the leading singular triplets are known, the sum of the remaining singular values
+            # is estimated from their energy, assuming a flat tail of the spectrum
+            tail_energy = (previous_merged_tv.square().sum() - s.square().sum()).clamp(
+                min=0
+            )
+            tail_rank = min(previous_merged_tv.shape) - rank
+            s_sum = s.sum() + (tail_rank * tail_energy).sqrt()
+            above_alpha = s.cumsum(dim=0) / s_sum > alpha
+            if above_alpha.any():
+                split_rank = above_alpha.float().argmax().item()
+            else:
+                # the split rank of the full SVD lies beyond the computed singular triplets
+                log.warning(
+                    f"{param_name}: the leading {rank} singular values hold less than alpha={alpha} of the "
+                    f"estimated spectrum, the split rank is capped at incremental_svd_rank={rank}. "
+                    "Increase `incremental_svd_rank` to remove the interference beyond this subspace."
+                )
+                split_rank = rank
 
-        projected_task_tv[:split_rank, :split_rank] = 0
+            # remove the components of the task vector on the diagonal and on the leading block
+            projected_task_tv = u.T @ task_tv @ v
+            interference = torch.zeros_like(projected_task_tv)
+            interference[:split_rank, :split_rank] = projected_task_tv[
+                :split_rank, :split_rank
+            ]
+            interference.diagonal().copy_(projected_task_tv.diagonal())
 
-        cleaned_task_tv = u @ projected_task_tv @ v.T
+            cleaned_task_tv = task_tv - u @ interference @ v.T
 
         previous_lambda_t = self.previous_lambda_t
         lambda_t = self.lambda_t
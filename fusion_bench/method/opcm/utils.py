@@ -1,4 +1,4 @@
-from typing import Tuple
+from typing import Optional, Tuple
 
 import torch
 from torch import Tensor, nn
@@ -21,7 +21,7 @@ def _svd(w: Tensor, full_matrices=True) -> Tuple[Tensor, Tensor, Tensor]:
     u, s, vh = torch.linalg.svd(
         w, full_matrices=full_matrices, driver="gesvd" if w.is_cuda else None
     )
-    v = vh.T
+    v = vh.mT
     return u, s, v
 
 
@@ -47,6 +47,46 @@ def svd(
     return u.to(original_device), s.to(original_device), v.to(original_device)
 
 
+def warm_started_svd(
+    w: Tensor,
+    rank: int,
+    v0: Optional[Tensor] = None,
+    oversampling: int = 10,
+    niter: int = 2,
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Approximate the leading singular triplets of a matrix with a warm-started subspace iteration.
+
+    The iteration starts from `v0`, the right singular vectors of a previous decomposition (e.g. of the
+    merged task vector before the last merging step), completed with random directions. When the matrix
+    changed little since then, a few iterations recover its leading singular subspaces, at a cost of
+    O(m * n * (rank + oversampling)) per iteration instead of the O(m * n * min(m, n)) of a full SVD.
+
+    Args:
+        w (Tensor): The input matrix of shape (m, n).
+        rank (int): The number of singular triplets to compute.
+        v0 (Optional[Tensor]): The initial right singular vectors of shape (n, k). Defaults to random directions.
+        oversampling (int): The number of additional directions of the subspace iteration.
+        niter (int): The number of power iterations.
+
+    Returns:
+        Tuple[Tensor, Tensor, Tensor]: The U (m, rank), S (rank,) and V (n, rank) matrices.
+    """
+    num_directions = min(rank + oversampling, *w.shape)
+    omega = torch.randn(w.size(1), num_directions, dtype=w.dtype, device=w.device)
+    if v0 is not None:
+        num_warm = min(v0.size(1), num_directions)
+        omega[:, :num_warm] = v0[:, :num_warm].to(omega)
+
+    q = torch.linalg.qr(w @ omega).Q
+    for _ in range(niter):
+        q = torch.linalg.qr(w.mT @ q).Q
+        q = torch.linalg.qr(w @ q).Q
+    u, s, vh = torch.linalg.svd(q.mT @ w, full_matrices=False)
+    rank = min(rank, s.size(0))
+    return q @ u[:, :rank], s[:rank], vh[:rank].mT
+
+
 def frobenius_inner_product(w1: Tensor, w2: Tensor) -> Tensor:
     return torch.trace(w1.T @ w2)
 
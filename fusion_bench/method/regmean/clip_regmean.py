@@ -1,5 +1,5 @@
 import logging
-from typing import Dict, List, cast  # noqa: F401
+from typing import Dict, List, Optional, cast  # noqa: F401
 
 import torch
 import torch.utils.data
@@ -9,7 +9,6 @@ from torch.nn.modules import Module
 from torch.utils.data import DataLoader
 from tqdm.autonotebook import tqdm
 
-from fusion_bench.dataset.clip_dataset import CLIPDataset
 from fusion_bench.mixins import CLIPClassificationMixin
 
 from .regmean import RegMeanAlgorithm
@@ -23,15 +22,35 @@ class RegMeanAlgorithmForCLIP(
 ):
     _config_mapping = {
         "_dataloader_kwargs": "dataloader_kwargs",
+        "preprocessed_cache_dir": "preprocessed_cache_dir",
+        "batched_preprocessing": "batched_preprocessing",
     }
 
-    def __init__(self, *, dataloader_kwargs: DictConfig, **kwargs):
+    def __init__(
+        self,
+        *,
+        dataloader_kwargs: DictConfig,
+        preprocessed_cache_dir: Optional[str] = None,
+        batched_preprocessing: bool = False,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self._dataloader_kwargs = dataloader_kwargs
+        self.preprocessed_cache_dir = preprocessed_cache_dir
+        self.batched_preprocessing = batched_preprocessing
 
     def on_regmean_start(self):
         self.setup_zero_shot_classification_head()
 
+    def gram_cache_key_components(self):
+        return {
+            **super().gram_cache_key_components(),
+            "dataloader_kwargs": dict(self._dataloader_kwargs),
+            "image_processor": self.clip_processor.image_processor.to_dict(),
+            # the cached images are stored as float16
+            "preprocessed": self.preprocessed_cache_dir is not None,
+        }
+
     def compute_logits(self, module, batch, task: str) -> Tensor:
         images, _ = batch
         text_embeds = self.zeroshot_weights[task]
@@ -58,74 +77,36 @@ class RegMeanAlgorithmForCLIP(
         linear_modules_to_merge: Dict[str, Module],
     ):
         # setup dataloader
-        train_dataset = CLIPDataset(train_dataset, self.clip_processor)
+        train_dataset = self.get_clip_dataset(train_dataset, name=f"{model_name}/train")
         train_dataloader = DataLoader(
-            train_dataset, shuffle=True, **self._dataloader_kwargs
+            train_dataset,
+            shuffle=True,
+            collate_fn=self.get_clip_collate_fn(),
+            **self._dataloader_kwargs,
         )
         train_dataloader = self.fabric.setup_dataloaders(train_dataloader)
         model = self.fabric.setup(model)
 
-        def compute_regmean_weights(module_name: str):
-            """
-            compute the regmean weights, a hook function to deal with each module's input
-            :param module_name: str, module name
-            :return:
-            """
-
-            def hook(module: nn.Module, input: tuple, output: torch.Tensor):
-                # Tensor, shape (batch_size, sequence_length, hidden_dim)
-                x = cast(Tensor, input[0]).detach()
-                batch_num_actual_examples = x.shape[0]
-                # Tensor, shape (batch_size * sequence_length, hidden_dim)
-                x = x.reshape(-1, x.shape[-1])
-                # Tensor, shape (hidden_dim, hidden_dim)
-                xtx = torch.matmul(x.transpose(0, 1), x)
-                # store the averaged weights in regmean_weights
-                if module_name not in regmean_weights.keys():
-                    regmean_weights[module_name] = xtx / x.shape[0]
-                    num_computed_examples[module_name] = x.shape[0]
-                    num_actual_examples[module_name] = batch_num_actual_examples
-                else:
-                    regmean_weights[module_name] = (
-                        regmean_weights[module_name]
-                        * num_computed_examples[module_name]
-                        + xtx
-                    ) / (num_computed_examples[module_name] + x.shape[0])
-                    num_computed_examples[module_name] += x.shape[0]
-                    num_actual_examples[module_name] += batch_num_actual_examples
-
-            return hook
-
-        handles = []
-        # dictionary, regmean matrices for each linear module inputs
-        regmean_weights = {}
-        # dictionary, number of examples (multiplied the sequence length) used for computing regmean matrices
-        num_computed_examples = {}
-        # dictionary, number of actual examples used for computing regmean matrices
-        num_actual_examples = {}
-
-        for module_name, linear_module_to_merge in linear_modules_to_merge.items():
-            # register a hook in the forward process
-            handle = linear_module_to_merge.register_forward_hook(
-                compute_regmean_weights(module_name=module_name)
-            )
-            handles.append(handle)
+        # accumulate regmean matrices for each linear module inputs
+        accumulator = self.create_gram_accumulator()
+        # register hooks in the forward process
+        handles = accumulator.register_forward_hooks(linear_modules_to_merge)
         for step, batch in tqdm(
             enumerate(train_dataloader),
             desc=f"computing regmean weights for model {model_name}",
         ):
             if (
-                len(num_actual_examples) > 0
-                and list(num_actual_examples.values())[0] >= self.num_regmean_examples
+                len(accumulator.num_actual_examples) > 0
+                and list(accumulator.num_actual_examples.values())[0]
+                >= self.num_regmean_examples
             ):
                 break
+            if batch is None:
+                continue  # all samples in batch were invalid
             logits = self.compute_logits(model, batch, model_name)  # noqa: F841
 
         # remove the added hook
         for handle in handles:
             handle.remove()
 
-        for module_name in regmean_weights.keys():
-            regmean_weights[module_name] = regmean_weights[module_name].detach().cpu()
-
-        return regmean_weights
+        return accumulator.finalize(device="cpu")
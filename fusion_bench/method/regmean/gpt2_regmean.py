@@ -51,6 +51,9 @@ class RegMeanAlgorithmForGPT2(
             classifier = classifier.to(self.fabric.device)
             self.classifiers[model_name] = classifier
 
+    def gram_cache_key_components(self):
+        return {**super().gram_cache_key_components(), "batch_size": self.batch_size}
+
     def compute_logits(self, module: GPT2Model, batch, task: str) -> Tensor:
         self.classifiers[task].transformer = module
         input_ids = batch["input_ids"]
@@ -80,58 +83,17 @@ class RegMeanAlgorithmForGPT2(
         train_dataloader = self.fabric.setup_dataloaders(train_dataloader)
         model = self.fabric.setup(model)
 
-        def compute_regmean_weights(module_name: str):
-            """
-            compute the regmean weights, a hook function to deal with each module's input
-            :param module_name: str, module name
-            :return:
-            """
-
-            def hook(module: nn.Module, input: tuple, output: torch.Tensor):
-                # Tensor, shape (batch_size, sequence_length, hidden_dim)
-                x = cast(Tensor, input[0]).detach()
-                batch_num_actual_examples = x.shape[0]
-                # Tensor, shape (batch_size * sequence_length, hidden_dim)
-                x = x.reshape(-1, x.shape[-1])
-                # Tensor, shape (hidden_dim, hidden_dim)
-                xtx = torch.matmul(x.transpose(0, 1), x)
-                # store the averaged weights in regmean_weights
-                if module_name not in regmean_weights.keys():
-                    regmean_weights[module_name] = xtx / x.shape[0]
-                    num_computed_examples[module_name] = x.shape[0]
-                    num_actual_examples[module_name] = batch_num_actual_examples
-                else:
-                    regmean_weights[module_name] = (
-                        regmean_weights[module_name]
-                        * num_computed_examples[module_name]
-                        + xtx
-                    ) / (num_computed_examples[module_name] + x.shape[0])
-                    num_computed_examples[module_name] += x.shape[0]
-                    num_actual_examples[module_name] += batch_num_actual_examples
-
-            return hook
-
-        handles = []
-        # dictionary, regmean matrices for each linear module inputs
-        regmean_weights = {}
-        # dictionary, number of examples (multiplied the sequence length) used for computing regmean matrices
-        num_computed_examples = {}
-        # dictionary, number of actual examples used for computing regmean matrices
-        num_actual_examples = {}
-
-        for module_name, linear_module_to_merge in linear_modules_to_merge.items():
-            # register a hook in the forward process
-            handle = linear_module_to_merge.register_forward_hook(
-                compute_regmean_weights(module_name=module_name)
-            )
-            handles.append(handle)
+        # accumulate regmean matrices for each linear module inputs
+        accumulator = self.create_gram_accumulator()
+        # register hooks in the forward process
+        handles = accumulator.register_forward_hooks(linear_modules_to_merge)
         for step, batch in tqdm(
             enumerate(train_dataloader),
             desc=f"computing regmean weights for model {model_name}",
         ):
             if (
-                len(num_actual_examples) > 0
-                and list(num_actual_examples.values())[0]
+                len(accumulator.num_actual_examples) > 0
+                and list(accumulator.num_actual_examples.values())[0]
                 >= self.config.num_regmean_examples
             ):
                 break
@@ -141,7 +103,4 @@ class RegMeanAlgorithmForGPT2(
         for handle in handles:
             handle.remove()
 
-        for module_name in regmean_weights.keys():
-            regmean_weights[module_name] = regmean_weights[module_name].detach().cpu()
-
-        return regmean_weights
+        return accumulator.finalize(device="cpu")
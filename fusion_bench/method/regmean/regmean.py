@@ -6,7 +6,8 @@ modified from https://github.com/yule-BUAA/MergeLM/blob/6d49ad96fd69c92013654b83
 import logging
 import re
 from collections import defaultdict
-from typing import Dict, List, cast
+from copy import deepcopy
+from typing import Dict, List, Optional, cast
 
 import torch
 from torch import Tensor, nn
@@ -15,6 +16,16 @@ from tqdm.autonotebook import tqdm
 from fusion_bench.method import BaseAlgorithm
 from fusion_bench.mixins import SimpleProfilerMixin
 from fusion_bench.modelpool import BaseModelPool
+from fusion_bench.utils.cache_utils import TensorCache, state_dict_fingerprint
+
+from .utils import (
+    GramAccumulator,
+    create_gram_accumulator,
+    get_dataset_fingerprint,
+    regmean_merge_modules,
+    regmean_merge_modules_sweep,
+    rng_state_fingerprint,
+)
 
 log = logging.getLogger(__name__)
 
@@ -95,64 +106,84 @@ def merging_with_regmean_weights(
     :param reduce_non_diagonal_ratio: float, reduce non-diagonal elements in regmean weights by multiplying this scalar
     :return:
     """
-    # dict, dictionary of model parameters
-    merged_params = {}
-
+    module_weights, module_regmean_weights = _collect_linear_modules(
+        models_to_merge_param_dict, models_to_merge_regmean_weights_list
+    )
+    # merge all the linear modules with batched solves
+    merged_weights = regmean_merge_modules(
+        module_weights=module_weights,
+        module_gram_matrices=module_regmean_weights,
+        reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
+        weight_transpose=weight_transpose,
+    )
+    return _merged_params_from_weights(models_to_merge_param_dict, merged_weights)
+
+
+def merging_with_regmean_weights_sweep(
+    models_to_merge_param_dict: dict,
+    models_to_merge_regmean_weights_list: list,
+    reduce_non_diagonal_ratios: List[float],
+    weight_transpose: bool = True,
+) -> List[Dict[str, Tensor]]:
+    """
+    same as merging_with_regmean_weights, for several values of reduce_non_diagonal_ratio,
+    the regmean weights are decomposed once and shared by all the values
+    :param reduce_non_diagonal_ratios: list, values of reduce_non_diagonal_ratio
+    :return: list, merged parameters for each value of reduce_non_diagonal_ratio
+    """
+    module_weights, module_regmean_weights = _collect_linear_modules(
+        models_to_merge_param_dict, models_to_merge_regmean_weights_list
+    )
+    merged_weights_list = regmean_merge_modules_sweep(
+        module_weights=module_weights,
+        module_gram_matrices=module_regmean_weights,
+        reduce_non_diagonal_ratios=reduce_non_diagonal_ratios,
+        weight_transpose=weight_transpose,
+    )
+    # the averaged parameters do not depend on reduce_non_diagonal_ratio
+    averaged_params = _merged_params_from_weights(models_to_merge_param_dict, {})
+    return [
+        {
+            **averaged_params,
+            **_merged_params_from_weights(
+                models_to_merge_param_dict, merged_weights, average=False
+            ),
+        }
+        for merged_weights in merged_weights_list
+    ]
+
+
+def _collect_linear_modules(
+    models_to_merge_param_dict: dict, models_to_merge_regmean_weights_list: list
+):
+    # only perform regmean merging on the "weight" parameter of Linear module
+    module_weights, module_regmean_weights = {}, {}
     for param_name, param_value_list in models_to_merge_param_dict.items():
-        merged_by_regmean = False
-        # only perform regmean merging on the "weight" parameter of Linear module
         if param_name.endswith(".weight"):
             module_name = param_name[: -len(".weight")]
             if module_name in models_to_merge_regmean_weights_list[0].keys():
-                # two lists with length num_models_to_merge
-                param_multiplied_results, module_regmean_weights_list = [], []
-                for model_idx, model_to_merge_regmean_weights in enumerate(
-                    models_to_merge_regmean_weights_list
-                ):
-                    # Tensor, shape (hidden_dim, hidden_dim)
-                    module_regmean_weights = model_to_merge_regmean_weights[module_name]
-
-                    # reduce non-diagonal elements
-                    module_regmean_weights = reduce_non_diagonal_elements(
-                        regmean_weights=module_regmean_weights,
-                        reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
-                    )
-                    module_regmean_weights_list.append(module_regmean_weights)
-
-                    model_to_merge_param = param_value_list[model_idx]
-                    # since the weight shape of Linear module is (output_size, input_size), we need to transpose it
-                    param_multiplied_results.append(
-                        torch.matmul(
-                            module_regmean_weights,
-                            (
-                                model_to_merge_param.transpose(0, 1)
-                                if weight_transpose
-                                else model_to_merge_param
-                            ),
-                        )
-                    )
+                module_weights[module_name] = param_value_list
+                module_regmean_weights[module_name] = [
+                    model_to_merge_regmean_weights[module_name]
+                    for model_to_merge_regmean_weights in models_to_merge_regmean_weights_list
+                ]
+    return module_weights, module_regmean_weights
 
-                # sum up module_regmean_weights and param_multiplied_results over all individual models
-                sum_module_regmean_weights = sum(module_regmean_weights_list)
-                sum_param_multiplied_results = sum(param_multiplied_results)
 
-                # get the inverse matrix
-                inv_sum_module_regmean_weights = torch.inverse(
-                    sum_module_regmean_weights
-                )
-                # merge parameters with regmean
-                merged_param = torch.matmul(
-                    inv_sum_module_regmean_weights, sum_param_multiplied_results
-                )
-                # transpose to the original shape of "weight" in Linear module
-                merged_params[param_name] = (
-                    merged_param.transpose(0, 1) if weight_transpose else merged_param
-                )
-                merged_by_regmean = True
+def _merged_params_from_weights(
+    models_to_merge_param_dict: dict,
+    merged_weights: Dict[str, Tensor],
+    average: bool = True,
+):
+    # dict, dictionary of model parameters
+    merged_params = {}
+    for param_name, param_value_list in models_to_merge_param_dict.items():
+        module_name = param_name[: -len(".weight")]
+        if param_name.endswith(".weight") and module_name in merged_weights:
+            merged_params[param_name] = merged_weights[module_name]
         # use average merging for parameters whose names are not end with ".weight" or not in Linear module
-        if not merged_by_regmean:
+        elif average:
             merged_params[param_name] = torch.stack(param_value_list, dim=0).mean(dim=0)
-
     return merged_params
 
 
@@ -162,6 +193,7 @@ def regmean_merging(
     exclude_param_names_regex: list,
     nums_regmean_examples: list,
     reduce_non_diagonal_ratio: float = 1.0,
+    accumulate_dtype: Optional[str] = None,
 ):
     """
     regmean merging method
@@ -170,39 +202,9 @@ def regmean_merging(
     :param exclude_param_names_regex: list, regular expression of names of parameters that need to be excluded
     :param nums_regmean_examples: list, numbers of examples to compute regmean weights
     :param reduce_non_diagonal_ratio: float, reduce non-diagonal elements in regmean weights by multiplying this scalar
+    :param accumulate_dtype: str, dtype used to accumulate the regmean weights, defaults to the dtype of the inputs
     :return:
     """
-
-    def compute_regmean_weights(module_name: str):
-        """
-        compute the regmean weights, a hook function to deal with each module's input
-        :param module_name: str, module name
-        :return:
-        """
-
-        def hook(module: nn.Module, input: tuple, output: torch.Tensor):
-            # Tensor, shape (batch_size, sequence_length, hidden_dim)
-            x = input[0].detach()
-            batch_num_actual_examples = x.shape[0]
-            # Tensor, shape (batch_size * sequence_length, hidden_dim)
-            x = x.reshape(-1, x.shape[-1])
-            # Tensor, shape (hidden_dim, hidden_dim)
-            xtx = torch.matmul(x.transpose(0, 1), x)
-            # store the averaged weights in regmean_weights
-            if module_name not in regmean_weights.keys():
-                regmean_weights[module_name] = xtx / x.shape[0]
-                num_computed_examples[module_name] = x.shape[0]
-                num_actual_examples[module_name] = batch_num_actual_examples
-            else:
-                regmean_weights[module_name] = (
-                    regmean_weights[module_name] * num_computed_examples[module_name]
-                    + xtx
-                ) / (num_computed_examples[module_name] + x.shape[0])
-                num_computed_examples[module_name] += x.shape[0]
-                num_actual_examples[module_name] += batch_num_actual_examples
-
-        return hook
-
     # dictionary of list, where key is the parameter name,
     # value is a list of the corresponding parameters of all the models that need to be merged
     models_to_merge_param_dict = defaultdict(list)
@@ -232,20 +234,10 @@ def regmean_merging(
             linear_modules_to_merge = get_modules_to_merge(
                 model=model_to_merge, include_module_types=[nn.Linear]
             )
-            handles = []
-            # dictionary, regmean matrices for each linear module inputs
-            regmean_weights = {}
-            # dictionary, number of examples (multiplied the sequence length) used for computing regmean matrices
-            num_computed_examples = {}
-            # dictionary, number of actual examples used for computing regmean matrices
-            num_actual_examples = {}
-
-            for module_name, linear_module_to_merge in linear_modules_to_merge.items():
-                # register a hook in the forward process
-                handle = linear_module_to_merge.register_forward_hook(
-                    compute_regmean_weights(module_name=module_name)
-                )
-                handles.append(handle)
+            # accumulate regmean matrices for each linear module inputs
+            accumulator = GramAccumulator(dtype=accumulate_dtype)
+            # register hooks in the forward process
+            handles = accumulator.register_forward_hooks(linear_modules_to_merge)
 
             train_dataloader = trainer.get_train_dataloader()
             if num_regmean_examples % trainer._train_batch_size != 0:
@@ -258,18 +250,21 @@ def regmean_merging(
                 desc=f"computing regmean weights for model {model_idx}",
             ):
                 if (
-                    len(num_actual_examples) > 0
-                    and list(num_actual_examples.values())[0] >= num_regmean_examples
+                    len(accumulator.num_actual_examples) > 0
+                    and list(accumulator.num_actual_examples.values())[0]
+                    >= num_regmean_examples
                 ):
                     break
                 inputs = trainer._prepare_inputs(inputs)
                 outputs = model_to_merge(**inputs)
 
-            models_to_merge_regmean_weights_list.append(regmean_weights)
-
             # remove the added hook
             for handle in handles:
                 handle.remove()
+
+            models_to_merge_regmean_weights_list.append(
+                accumulator.finalize(device=None)
+            )
         # merging with regmean weights
         merged_params = merging_with_regmean_weights(
             models_to_merge_param_dict=models_to_merge_param_dict,
@@ -287,6 +282,12 @@ class RegMeanAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
         "exclude_param_names_regex": "exclude_param_names_regex",
         "reduce_non_diagonal_ratio": "reduce_non_diagonal_ratio",
         "weight_transpose": "weight_transpose",
+        "accumulate_dtype": "accumulate_dtype",
+        "gram_cache_dir": "gram_cache_dir",
+        "gram_cache_max_size": "gram_cache_max_size",
+        "gram_rank": "gram_rank",
+        "gram_error_report": "gram_error_report",
+        "reduce_non_diagonal_ratios": "reduce_non_diagonal_ratios",
     }
 
     def __init__(
@@ -296,12 +297,29 @@ class RegMeanAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
         exclude_param_names_regex: list,
         reduce_non_diagonal_ratio: float,
         weight_transpose: bool,
+        accumulate_dtype: Optional[str] = None,
+        gram_cache_dir: Optional[str] = None,
+        gram_cache_max_size: Optional[float] = None,
+        gram_rank: Optional[int] = None,
+        gram_error_report: bool = False,
+        reduce_non_diagonal_ratios: Optional[List[float]] = None,
         **kwargs,
     ):
         self.num_regmean_examples = num_regmean_examples
         self.exclude_param_names_regex = exclude_param_names_regex
         self.reduce_non_diagonal_ratio = reduce_non_diagonal_ratio
         self.weight_transpose = weight_transpose
+        # dtype used to accumulate the regmean weights, e.g. "float64"
+        self.accumulate_dtype = accumulate_dtype
+        # directory of the persistent cache of regmean weights, and its maximum size in GB
+        self.gram_cache_dir = gram_cache_dir
+        self.gram_cache_max_size = gram_cache_max_size
+        # rank of the diagonal-plus-low-rank approximation of the regmean weights, None for the dense regmean weights
+        self.gram_rank = gram_rank
+        # whether to log the error of the approximated regmean weights, the dense ones are computed as well
+        self.gram_error_report = gram_error_report
+        # values of reduce_non_diagonal_ratio to sweep over with a single pass of statistics, overrides reduce_non_diagonal_ratio
+        self.reduce_non_diagonal_ratios = reduce_non_diagonal_ratios
         super().__init__(**kwargs)
 
     def run(self, modelpool: BaseModelPool, **kwargs):
@@ -309,6 +327,7 @@ class RegMeanAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
             modelpool = BaseModelPool(modelpool)
         self.modelpool = modelpool
         self.on_regmean_start()
+        self.setup_gram_cache()
 
         # dictionary of list, where key is the parameter name,
         # value is a list of the corresponding parameters of all the models that need to be merged
@@ -394,7 +413,7 @@ class RegMeanAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
 
                     ##################### ONLY FOR EXPERIMENTS #####################
 
-                    regmean_weights = self.get_regmean_weights(
+                    regmean_weights = self.get_regmean_weights_cached(
                         name,
                         model,
                         train_dataset=dataset,
@@ -413,12 +432,23 @@ class RegMeanAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
 
         with self.profile("merging models"):
             # merging with regmean weights
-            merged_params = merging_with_regmean_weights(
-                models_to_merge_param_dict=models_to_merge_param_dict,
-                models_to_merge_regmean_weights_list=models_to_merge_regmean_weights_list,
-                reduce_non_diagonal_ratio=self.reduce_non_diagonal_ratio,
-                weight_transpose=self.config.get("weight_transpose", True),
-            )
+            if self.reduce_non_diagonal_ratios is None:
+                merged_params_list = [
+                    merging_with_regmean_weights(
+                        models_to_merge_param_dict=models_to_merge_param_dict,
+                        models_to_merge_regmean_weights_list=models_to_merge_regmean_weights_list,
+                        reduce_non_diagonal_ratio=self.reduce_non_diagonal_ratio,
+                        weight_transpose=self.config.get("weight_transpose", True),
+                    )
+                ]
+            else:
+                # the regmean weights do not depend on reduce_non_diagonal_ratio, so they are computed only once for the sweep
+                merged_params_list = merging_with_regmean_weights_sweep(
+                    models_to_merge_param_dict=models_to_merge_param_dict,
+                    models_to_merge_regmean_weights_list=models_to_merge_regmean_weights_list,
+                    reduce_non_diagonal_ratios=list(self.reduce_non_diagonal_ratios),
+                    weight_transpose=self.config.get("weight_transpose", True),
+                )
 
 
             ##################### ONLY FOR EXPERIMENTS #####################
@@ -453,19 +483,131 @@ class RegMeanAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
                 for key in models_to_merge_param_dict.keys():
                     match = re.search(r'layers\.(\d+)\.', key)
                     if match is not None and (int(match.group(1)) < layer_start or int(match.group(1)) > layer_end):
-                        merged_params[key] = torch.stack(models_to_merge_param_dict[key], dim=0).mean(dim=0)
+                        for merged_params in merged_params_list:
+                            merged_params[key] = torch.stack(models_to_merge_param_dict[key], dim=0).mean(dim=0)
             ##################### ONLY FOR EXPERIMENTS #####################
 
 
-            merged_model = modelpool.load_model("_pretrained_")
-            merged_model.load_state_dict(merged_params, strict=False)
+            merged_models = []
+            for merged_params in merged_params_list:
+                merged_model = modelpool.load_model("_pretrained_")
+                if any(merged_model is other_model for other_model in merged_models):
+                    # the model pool returns the same instance for in-memory models
+                    merged_model = deepcopy(merged_model)
+                merged_model.load_state_dict(merged_params, strict=False)
+                merged_models.append(merged_model)
 
         self.print_profile_summary()
-        return merged_model
+        if self.reduce_non_diagonal_ratios is None:
+            return merged_models[0]
+        # one merged model per value, each of them is evaluated by the program
+        return {
+            f"reduce_non_diagonal_ratio={ratio}": merged_model
+            for ratio, merged_model in zip(self.reduce_non_diagonal_ratios, merged_models)
+        }
 
     def on_regmean_start(self):
         pass
 
+    def create_gram_accumulator(self) -> GramAccumulator:
+        """
+        Create the accumulator of the regmean weights of one model, a `SketchedGramAccumulator` if `gram_rank` is set.
+        """
+        return create_gram_accumulator(
+            dtype=self.accumulate_dtype,
+            rank=self.gram_rank,
+            track_error=self.gram_error_report,
+        )
+
+    def setup_gram_cache(self):
+        """
+        Open the persistent cache of regmean weights if `gram_cache_dir` is set.
+        """
+        self.gram_cache = None
+        if self.gram_cache_dir is not None:
+            max_size = (
+                int(self.gram_cache_max_size * 1024**3)
+                if self.gram_cache_max_size is not None
+                else None
+            )
+            self.gram_cache = TensorCache(self.gram_cache_dir, max_size=max_size)
+
+    def gram_cache_key_components(self) -> Dict:
+        """
+        Settings other than the model and the dataset that affect the regmean weights, used in the keys of the gram cache.
+        """
+        return {
+            "num_regmean_examples": self.num_regmean_examples,
+            "accumulate_dtype": self.accumulate_dtype,
+        }
+
+    def get_gram_cache_key(
+        self, state_dict: Dict[str, Tensor], train_dataset, **components
+    ) -> Optional[str]:
+        """
+        Build the key of the regmean weights of a model in the gram cache.
+
+        Returns None if the gram cache is disabled or if the dataset has no fingerprint.
+        """
+        if self.gram_cache is None:
+            return None
+        if self.gram_rank is not None:
+            log.warning("The approximated regmean weights are not cached.")
+            return None
+        dataset_fingerprint = get_dataset_fingerprint(train_dataset)
+        if dataset_fingerprint is None:
+            log.warning(
+                "The dataset has no fingerprint, the regmean weights are not cached."
+            )
+            return None
+        return TensorCache.make_key(
+            algorithm=self.__class__.__name__,
+            model=state_dict_fingerprint(state_dict),
+            dataset=dataset_fingerprint,
+            # the state of the generator determines which examples are drawn by the shuffled dataloaders
+            rng_state=rng_state_fingerprint(),
+            **self.gram_cache_key_components(),
+            **components,
+        )
+
+    def get_regmean_weights_cached(
+        self,
+        model_name: str,
+        model: nn.Module,
+        train_dataset,
+        linear_modules_to_merge: Dict[str, nn.Module],
+    ) -> Dict[str, Tensor]:
+        """
+        Same as `get_regmean_weights`, but look up the regmean weights in the gram cache first.
+
+        The state of the random number generator after the computation is cached as well and
+        restored on a cache hit, so that the following models draw the same examples as in an
+        uncached run.
+        """
+        key = self.get_gram_cache_key(
+            model.state_dict(),
+            train_dataset,
+            modules=sorted(linear_modules_to_merge.keys()),
+        )
+        if key is not None:
+            regmean_weights = self.gram_cache.get(key)
+            if regmean_weights is not None:
+                log.info(f"loaded cached regmean weights for model {model_name}")
+                torch.set_rng_state(regmean_weights.pop("__rng_state__"))
+                return regmean_weights
+
+        regmean_weights = self.get_regmean_weights(
+            model_name,
+            model,
+            train_dataset=train_dataset,
+            linear_modules_to_merge=linear_modules_to_merge,
+        )
+        if key is not None:
+            self.gram_cache.put(
+                key, {**regmean_weights, "__rng_state__": torch.get_rng_state()}
+            )
+        return regmean_weights
+
     def get_regmean_weights(
         self,
         model_name: str,
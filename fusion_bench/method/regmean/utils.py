@@ -0,0 +1,761 @@
+"""
+Batched merge kernels shared by RegMean and RegMean++.
+"""
+
+import hashlib
+import logging
+from collections import defaultdict
+from typing import Callable, Dict, List, NamedTuple, Optional, Sequence, Tuple, cast
+
+import torch
+from torch import Tensor, nn
+from torch.utils.hooks import RemovableHandle
+
+from fusion_bench.utils.dtype import parse_dtype
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    "GramAccumulator",
+    "SketchedGramAccumulator",
+    "LowRankGram",
+    "create_gram_accumulator",
+    "regmean_batched_merge_low_rank",
+    "scale_non_diagonal_elements_",
+    "solve_regmean_system",
+    "regmean_batched_merge",
+    "regmean_merge_modules",
+    "regmean_batched_merge_sweep",
+    "regmean_merge_modules_sweep",
+]
+
+
+def scale_non_diagonal_elements_(
+    gram_matrices: Tensor, reduce_non_diagonal_ratio: float
+) -> Tensor:
+    """
+    Multiply the non-diagonal elements of (a batch of) Gram matrices by `reduce_non_diagonal_ratio` in place.
+
+    Args:
+        gram_matrices (Tensor): Tensor of shape (..., hidden_dim, hidden_dim).
+        reduce_non_diagonal_ratio (float): Scalar applied to the non-diagonal elements.
+
+    Returns:
+        Tensor: The modified `gram_matrices`.
+    """
+    if reduce_non_diagonal_ratio == 1.0:
+        return gram_matrices
+    diagonal = gram_matrices.diagonal(dim1=-2, dim2=-1)
+    saved_diagonal = diagonal.clone()
+    gram_matrices.mul_(reduce_non_diagonal_ratio)
+    diagonal.copy_(saved_diagonal)
+    return gram_matrices
+
+
+def solve_regmean_system(
+    sum_gram_matrices: Tensor,
+    rhs: Tensor,
+    solver: str = "cholesky",
+) -> Tensor:
+    """
+    Solve `sum_gram_matrices @ X = rhs` for (a batch of) symmetric positive semi-definite systems.
+
+    The Cholesky solve is used by default. If any of the matrices in the batch is not
+    positive definite, the whole batch falls back to an LU solve.
+
+    Args:
+        sum_gram_matrices (Tensor): Tensor of shape (..., hidden_dim, hidden_dim).
+        rhs (Tensor): Tensor of shape (..., hidden_dim, k).
+        solver (str): "cholesky" or "lu".
+
+    Returns:
+        Tensor: The solution of shape (..., hidden_dim, k).
+    """
+    if solver == "cholesky":
+        L, info = torch.linalg.cholesky_ex(sum_gram_matrices)
+        if not bool((info > 0).any()):
+            return torch.cholesky_solve(rhs, L)
+        log.warning(
+            "Gram matrix is not positive definite, falling back to LU solve."
+        )
+    elif solver != "lu":
+        raise ValueError(f"Unknown solver: {solver}")
+    return torch.linalg.solve(sum_gram_matrices, rhs)
+
+
+def regmean_batched_merge(
+    param_weights: Tensor,
+    gram_matrices: Tensor,
+    reduce_non_diagonal_ratio: float = 1.0,
+    weight_transpose: bool = True,
+    solver: str = "cholesky",
+) -> Tensor:
+    """
+    Merge the weights of a batch of linear modules with RegMean.
+
+    For every module, the merged weight is the solution of
+    `(sum_i G_i) W^T = sum_i G_i W_i^T`, where `G_i` are the Gram matrices of the inputs
+    of the i-th model after reducing their non-diagonal elements.
+    The Gram matrices are modified in place.
+
+    Args:
+        param_weights (Tensor): Stacked weights of shape (..., num_models, out_features, in_features)
+            if `weight_transpose` is True, else (..., num_models, in_features, out_features).
+        gram_matrices (Tensor): Stacked Gram matrices of shape (..., num_models, in_features, in_features).
+        reduce_non_diagonal_ratio (float): Scalar applied to the non-diagonal elements of the Gram matrices.
+        weight_transpose (bool): Whether the weights are stored as (out_features, in_features).
+        solver (str): "cholesky" or "lu".
+
+    Returns:
+        Tensor: Merged weights of shape (..., out_features, in_features) if `weight_transpose` is True,
+            else (..., in_features, out_features).
+    """
+    *batch_shape, num_models, hidden_dim, _ = gram_matrices.shape
+    if weight_transpose:
+        param_weights = param_weights.transpose(-1, -2)
+    param_weights = param_weights.to(gram_matrices.dtype)
+
+    scale_non_diagonal_elements_(gram_matrices, reduce_non_diagonal_ratio)
+    sum_gram_matrices = gram_matrices.sum(dim=-3)
+
+    # sum_i G_i P_i computed as a single GEMM, since the Gram matrices are symmetric
+    # [G_1 ... G_M] @ [P_1; ...; P_M]
+    rhs = torch.matmul(
+        gram_matrices.reshape(*batch_shape, num_models * hidden_dim, hidden_dim).mT,
+        param_weights.reshape(*batch_shape, num_models * hidden_dim, -1),
+    )
+    merged_param = solve_regmean_system(sum_gram_matrices, rhs, solver=solver)
+    return merged_param.transpose(-1, -2) if weight_transpose else merged_param
+
+
+def regmean_batched_merge_sweep(
+    param_weights: Tensor,
+    gram_matrices: Tensor,
+    reduce_non_diagonal_ratios: Sequence[float],
+    weight_transpose: bool = True,
+) -> List[Tensor]:
+    """
+    Same as `regmean_batched_merge`, for several values of `reduce_non_diagonal_ratio` at once.
+
+    With `S = sum_i G_i` and `D = sum_i diag(G_i)`, the system of ratio `a` is
+    `a S + (1 - a) D = D^{1/2} (a C + (1 - a) I) D^{1/2}`, where `C = D^{-1/2} S D^{-1/2}`.
+    `C` is eigendecomposed once, after which every ratio only costs a diagonal scaling and
+    one matrix product. The Gram matrices are not modified.
+
+    Args:
+        param_weights (Tensor): Stacked weights of shape (..., num_models, out_features, in_features)
+            if `weight_transpose` is True, else (..., num_models, in_features, out_features).
+        gram_matrices (Tensor): Stacked Gram matrices of shape (..., num_models, in_features, in_features).
+        reduce_non_diagonal_ratios (Sequence[float]): The values of `reduce_non_diagonal_ratio`.
+        weight_transpose (bool): Whether the weights are stored as (out_features, in_features).
+
+    Returns:
+        List[Tensor]: The merged weights for each ratio, with the same layout as in `regmean_batched_merge`.
+    """
+    *batch_shape, num_models, hidden_dim, _ = gram_matrices.shape
+    if weight_transpose:
+        param_weights = param_weights.transpose(-1, -2)
+    param_weights = param_weights.to(gram_matrices.dtype)
+
+    diagonals = gram_matrices.diagonal(dim1=-2, dim2=-1)
+    # sum_i G_i P_i and sum_i diag(G_i) P_i
+    rhs = torch.matmul(
+        gram_matrices.reshape(*batch_shape, num_models * hidden_dim, hidden_dim).mT,
+        param_weights.reshape(*batch_shape, num_models * hidden_dim, -1),
+    )
+    rhs_diagonal = (diagonals.unsqueeze(-1) * param_weights).sum(dim=-3)
+
+    inv_sqrt_diagonal = (
+        diagonals.sum(dim=-2)
+        .clamp_min(torch.finfo(gram_matrices.dtype).tiny)
+        .rsqrt()
+        .unsqueeze(-1)
+    )
+    normalized_gram = (
+        inv_sqrt_diagonal * gram_matrices.sum(dim=-3) * inv_sqrt_diagonal.mT
+    )
+    eigenvalues, eigenvectors = torch.linalg.eigh(normalized_gram)
+    eigenvalues = eigenvalues.unsqueeze(-1)
+    projected_rhs = eigenvectors.mT @ (inv_sqrt_diagonal * rhs)
+    projected_rhs_diagonal = eigenvectors.mT @ (inv_sqrt_diagonal * rhs_diagonal)
+
+    merged_params = []
+    for ratio in reduce_non_diagonal_ratios:
+        merged_param = inv_sqrt_diagonal * (
+            eigenvectors
+            @ (
+                (ratio * projected_rhs + (1 - ratio) * projected_rhs_diagonal)
+                / (ratio * eigenvalues + (1 - ratio))
+            )
+        )
+        merged_params.append(
+            merged_param.transpose(-1, -2) if weight_transpose else merged_param
+        )
+    return merged_params
+
+
+def _merge_modules(
+    module_weights: Dict[str, List[Tensor]],
+    module_gram_matrices: Dict[str, List[Tensor]],
+    batched_merge_fn: Callable[[Tensor, Tensor], List[Tensor]],
+    weight_transpose: bool = True,
+    device=None,
+) -> List[Dict[str, Tensor]]:
+    """
+    Group the modules as described in `regmean_merge_modules` and merge every group with
+    `batched_merge_fn`, which returns a list of merged weights (e.g. one per hyperparameter value).
+    """
+    out_dim = 0 if weight_transpose else -1
+
+    # group the modules with shared Gram matrices
+    shared_groups: Dict[Tuple, List[str]] = defaultdict(list)
+    for module_name, weights in module_weights.items():
+        key = (
+            tuple(id(g) for g in module_gram_matrices[module_name]),
+            weights[0].dtype,
+        )
+        shared_groups[key].append(module_name)
+
+    # each merge unit is (module names, weights per model, gram matrices per model)
+    merge_units = []
+    for module_names in shared_groups.values():
+        if len(module_names) == 1:
+            weights = module_weights[module_names[0]]
+        else:
+            weights = [
+                torch.cat([module_weights[name][i] for name in module_names], dim=out_dim)
+                for i in range(len(module_weights[module_names[0]]))
+            ]
+        merge_units.append(
+            (module_names, weights, module_gram_matrices[module_names[0]])
+        )
+
+    # group the merge units with the same weight shape
+    groups: Dict[Tuple, List[int]] = defaultdict(list)
+    for unit_idx, (_, weights, _) in enumerate(merge_units):
+        groups[(tuple(weights[0].shape), weights[0].dtype)].append(unit_idx)
+
+    merged_weights_list: List[Dict[str, Tensor]] = []
+    for (_, dtype), unit_indices in groups.items():
+        group_device = (
+            device if device is not None else merge_units[unit_indices[0]][1][0].device
+        )
+        # shape (num_units, num_models, ...)
+        param_weights = torch.stack(
+            [
+                torch.stack([w.to(group_device) for w in merge_units[idx][1]])
+                for idx in unit_indices
+            ]
+        )
+        gram_matrices = stack_gram_matrices(
+            [
+                stack_gram_matrices(merge_units[idx][2], device=group_device)
+                for idx in unit_indices
+            ]
+        )
+        for result_idx, merged in enumerate(
+            batched_merge_fn(param_weights, gram_matrices)
+        ):
+            if result_idx == len(merged_weights_list):
+                merged_weights_list.append({})
+            merged_weights = merged_weights_list[result_idx]
+            for idx, merged_weight in zip(unit_indices, merged.to(dtype).unbind(0)):
+                module_names = merge_units[idx][0]
+                split_sizes = [
+                    module_weights[name][0].shape[out_dim] for name in module_names
+                ]
+                for name, merged_module_weight in zip(
+                    module_names, merged_weight.split(split_sizes, dim=out_dim)
+                ):
+                    merged_weights[name] = merged_module_weight
+    return merged_weights_list
+
+
+def regmean_merge_modules(
+    module_weights: Dict[str, List[Tensor]],
+    module_gram_matrices: Dict[str, List[Tensor]],
+    reduce_non_diagonal_ratio: float = 1.0,
+    weight_transpose: bool = True,
+    solver: str = "cholesky",
+    device=None,
+) -> Dict[str, Tensor]:
+    """
+    Merge several linear modules at once. Modules with the same weight shape are stacked
+    and solved together with a single batched call of `regmean_batched_merge`.
+
+    Modules that share the same Gram matrix objects for every model (see `GramAccumulator`)
+    are concatenated along the output dimension, so that the system is factorized only once.
+    `LowRankGram` approximations are merged with `regmean_batched_merge_low_rank`.
+
+    Args:
+        module_weights (Dict[str, List[Tensor]]): module name -> list of weights, one per model.
+        module_gram_matrices (Dict[str, List[Tensor | LowRankGram]]): module name -> list of Gram matrices, one per model.
+        reduce_non_diagonal_ratio (float): Scalar applied to the non-diagonal elements of the Gram matrices.
+        weight_transpose (bool): Whether the weights are stored as (out_features, in_features).
+        solver (str): "cholesky" or "lu".
+        device: Device to run the merge on. Defaults to the device of the weights.
+
+    Returns:
+        Dict[str, Tensor]: module name -> merged weight.
+    """
+
+    def batched_merge_fn(param_weights, gram_matrices):
+        if isinstance(gram_matrices, LowRankGram):
+            return [
+                regmean_batched_merge_low_rank(
+                    param_weights,
+                    gram_matrices,
+                    reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
+                    weight_transpose=weight_transpose,
+                )
+            ]
+        return [
+            regmean_batched_merge(
+                param_weights,
+                gram_matrices,
+                reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
+                weight_transpose=weight_transpose,
+                solver=solver,
+            )
+        ]
+
+    merged_weights_list = _merge_modules(
+        module_weights,
+        module_gram_matrices,
+        batched_merge_fn,
+        weight_transpose=weight_transpose,
+        device=device,
+    )
+    return merged_weights_list[0] if len(merged_weights_list) > 0 else {}
+
+
+def regmean_merge_modules_sweep(
+    module_weights: Dict[str, List[Tensor]],
+    module_gram_matrices: Dict[str, List[Tensor]],
+    reduce_non_diagonal_ratios: Sequence[float],
+    weight_transpose: bool = True,
+    device=None,
+) -> List[Dict[str, Tensor]]:
+    """
+    Same as `regmean_merge_modules`, for several values of `reduce_non_diagonal_ratio` at once
+    (see `regmean_batched_merge_sweep`).
+
+    Returns:
+        List[Dict[str, Tensor]]: module name -> merged weight, for each ratio.
+    """
+
+    def batched_merge_fn(param_weights, gram_matrices):
+        if isinstance(gram_matrices, LowRankGram):
+            # the Woodbury solve is already cheap, so every ratio is solved separately
+            return [
+                regmean_batched_merge_low_rank(
+                    param_weights,
+                    gram_matrices,
+                    reduce_non_diagonal_ratio=ratio,
+                    weight_transpose=weight_transpose,
+                )
+                for ratio in reduce_non_diagonal_ratios
+            ]
+        return regmean_batched_merge_sweep(
+            param_weights,
+            gram_matrices,
+            reduce_non_diagonal_ratios=reduce_non_diagonal_ratios,
+            weight_transpose=weight_transpose,
+        )
+
+    merged_weights_list = _merge_modules(
+        module_weights,
+        module_gram_matrices,
+        batched_merge_fn,
+        weight_transpose=weight_transpose,
+        device=device,
+    )
+    return merged_weights_list or [{} for _ in reduce_non_diagonal_ratios]
+
+
+def get_dataset_fingerprint(dataset) -> Optional[str]:
+    """
+    Get the fingerprint of a Hugging Face dataset, which changes with its content and every
+    transform applied to it. Returns None for other datasets.
+    """
+    return getattr(dataset, "_fingerprint", None)
+
+
+def rng_state_fingerprint() -> str:
+    """
+    Hash the state of the default torch generator, which determines the shuffling of the dataloaders.
+    """
+    return hashlib.sha256(torch.get_rng_state().numpy()).hexdigest()
+
+
+def _tensor_version(x: Tensor) -> int:
+    # inference tensors do not track the version counter
+    return 0 if x.is_inference() else x._version
+
+
+class GramAccumulator:
+    """
+    Accumulate the Gram matrices `x^T x` of the inputs of linear modules over batches.
+
+    The Gram matrices are summed in place with `addmm_` and divided by the number of
+    rows only once in `finalize`, so no temporary (hidden_dim, hidden_dim) tensors are
+    allocated per batch. The accumulation buffers can use a higher precision than the
+    activations, e.g. float64 while the model runs in bf16/fp16.
+
+    If `share_inputs` is True, modules that receive the very same input tensor in a
+    forward pass (e.g. the `q_proj`, `k_proj` and `v_proj` of an attention block) are
+    detected from the identity of the hook input. Their Gram matrix is computed once
+    and the same tensor is shared by all modules of the group, see `shared_inputs`.
+
+    Examples:
+        >>> accumulator = GramAccumulator(dtype=torch.float64)
+        >>> handles = accumulator.register_forward_hooks(linear_modules_to_merge)
+        >>> _ = model(inputs)
+        >>> for handle in handles:
+        ...     handle.remove()
+        >>> regmean_weights = accumulator.finalize()
+
+    Args:
+        dtype (Optional[str | torch.dtype]): dtype of the accumulation buffers. Defaults to the dtype of the inputs.
+        share_inputs (bool): Whether to share the Gram matrices of modules with the same input.
+    """
+
+    def __init__(
+        self, dtype: Optional[str | torch.dtype] = None, share_inputs: bool = True
+    ):
+        self.dtype = parse_dtype(dtype)
+        self.share_inputs = share_inputs
+        # dictionary, summed x^T x for each linear module inputs
+        self.gram_matrices: Dict[str, Tensor] = {}
+        # dictionary, number of examples (multiplied the sequence length) used for computing regmean matrices
+        self.num_computed_examples: Dict[str, int] = {}
+        # dictionary, number of actual examples used for computing regmean matrices
+        self.num_actual_examples: Dict[str, int] = {}
+        # dictionary, module name -> name of the module whose Gram matrix is shared
+        self.shared_inputs: Dict[str, str] = {}
+        # (input tensor, version, module name) of the last update
+        self._last_input: Optional[Tuple[Tensor, int, str]] = None
+
+    def _find_shared_input(self, module_name: str, x: Tensor) -> Optional[str]:
+        """
+        Return the name of the module that has consumed the same input tensor `x` right before `module_name`.
+        """
+        if not self.share_inputs or self._last_input is None:
+            return None
+        last_x, last_version, last_module_name = self._last_input
+        if x is last_x and _tensor_version(x) == last_version:
+            return self.shared_inputs.get(last_module_name, last_module_name)
+        return None
+
+    def update(self, module_name: str, x: Tensor):
+        """
+        Add the Gram matrix of a batch of inputs.
+
+        Args:
+            module_name (str): Name of the module.
+            x (Tensor): Inputs of shape (batch_size, ..., hidden_dim).
+        """
+        owner_name = self._find_shared_input(module_name, x)
+        if self.share_inputs:
+            self._last_input = (x, _tensor_version(x), module_name)
+
+        if module_name in self.shared_inputs:
+            if owner_name != self.shared_inputs[module_name]:
+                raise RuntimeError(
+                    f"The input of module {module_name} is no longer shared with module "
+                    f"{self.shared_inputs[module_name]}, set `share_inputs=False`."
+                )
+            # already accumulated by the owner of the shared Gram matrix
+            return
+        if owner_name is not None and module_name not in self.num_computed_examples:
+            self.shared_inputs[module_name] = owner_name
+            return
+
+        x = x.detach()
+        batch_num_actual_examples = x.shape[0]
+        # Tensor, shape (batch_size * sequence_length, hidden_dim)
+        x = x.reshape(-1, x.shape[-1])
+        if self.dtype is not None and x.dtype != self.dtype:
+            x = x.to(self.dtype)
+
+        if module_name not in self.num_computed_examples:
+            self.num_computed_examples[module_name] = 0
+            self.num_actual_examples[module_name] = 0
+        self._accumulate(module_name, x)
+        self.num_computed_examples[module_name] += x.shape[0]
+        self.num_actual_examples[module_name] += batch_num_actual_examples
+
+    def _accumulate(self, module_name: str, x: Tensor):
+        if module_name not in self.gram_matrices:
+            self.gram_matrices[module_name] = torch.zeros(
+                x.shape[-1], x.shape[-1], dtype=x.dtype, device=x.device
+            )
+        self.gram_matrices[module_name].addmm_(x.mT, x)
+
+    def _finalize_module(self, module_name: str, device):
+        gram_matrix = self.gram_matrices[module_name]
+        gram_matrix.div_(self.num_computed_examples[module_name])
+        return gram_matrix if device is None else gram_matrix.to(device)
+
+    def hook(self, module_name: str):
+        """
+        Get a forward hook that accumulates the Gram matrix of the module input.
+        """
+
+        def hook(module: nn.Module, input: tuple, output: Tensor):
+            self.update(module_name, cast(Tensor, input[0]))
+
+        return hook
+
+    def register_forward_hooks(
+        self, modules: Dict[str, nn.Module]
+    ) -> List[RemovableHandle]:
+        """
+        Register the forward hooks on the given modules.
+
+        Returns:
+            List[RemovableHandle]: The handles of the registered hooks.
+        """
+        return [
+            module.register_forward_hook(self.hook(module_name))
+            for module_name, module in modules.items()
+        ]
+
+    def finalize(self, device="cpu") -> Dict[str, Tensor]:
+        """
+        Average the accumulated Gram matrices and move them to `device`.
+        If `device` is None, the Gram matrices stay on the device they were accumulated on.
+        Modules with a shared input get the same tensor.
+
+        Returns:
+            Dict[str, Tensor]: The regmean weights for each module.
+        """
+        self._last_input = None
+        regmean_weights = {}
+        for module_name in list(self.num_computed_examples.keys()):
+            regmean_weights[module_name] = self._finalize_module(module_name, device)
+        for module_name, owner_name in self.shared_inputs.items():
+            regmean_weights[module_name] = regmean_weights[owner_name]
+            self.num_computed_examples[module_name] = self.num_computed_examples[
+                owner_name
+            ]
+            self.num_actual_examples[module_name] = self.num_actual_examples[
+                owner_name
+            ]
+        return regmean_weights
+
+
+class LowRankGram(NamedTuple):
+    """
+    Diagonal-plus-low-rank approximation of a Gram matrix,
+    `diag(diagonal - (factor ** 2).sum(-2)) + factor^T factor`, whose diagonal is exact.
+
+    Batches of approximations are represented by stacking both tensors along the leading dimensions.
+    """
+
+    # Tensor, shape (..., hidden_dim), exact diagonal of the Gram matrix
+    diagonal: Tensor
+    # Tensor, shape (..., rank, hidden_dim)
+    factor: Tensor
+
+    def to(self, *args, **kwargs) -> "LowRankGram":
+        return LowRankGram(
+            self.diagonal.to(*args, **kwargs), self.factor.to(*args, **kwargs)
+        )
+
+    def residual_diagonal(self) -> Tensor:
+        """
+        The diagonal of the Gram matrix that is not explained by the low-rank factor.
+        """
+        return (self.diagonal - self.factor.square().sum(dim=-2)).clamp_min(0)
+
+    def dense(self) -> Tensor:
+        """
+        Materialize the approximated Gram matrix.
+        """
+        return torch.diag_embed(self.residual_diagonal()) + self.factor.mT @ self.factor
+
+
+def stack_gram_matrices(gram_matrices: Sequence[Tensor | LowRankGram], device=None):
+    """
+    Stack dense Gram matrices or `LowRankGram` approximations along a new first dimension.
+    """
+    if isinstance(gram_matrices[0], LowRankGram):
+        return LowRankGram(
+            torch.stack([g.diagonal.to(device) for g in gram_matrices]),
+            torch.stack([g.factor.to(device) for g in gram_matrices]),
+        )
+    return torch.stack([g.to(device) for g in gram_matrices])
+
+
+def regmean_batched_merge_low_rank(
+    param_weights: Tensor,
+    gram_matrices: LowRankGram,
+    reduce_non_diagonal_ratio: float = 1.0,
+    weight_transpose: bool = True,
+) -> Tensor:
+    """
+    Same as `regmean_batched_merge`, with diagonal-plus-low-rank approximations of the Gram matrices.
+
+    After reducing the non-diagonal elements by `a`, the summed system is `E + a U^T U`, where
+    `E` is diagonal and `U` stacks the low-rank factors of all the models. It is solved with the
+    Woodbury identity, so only a (num_models * rank, num_models * rank) system is factorized.
+
+    Args:
+        param_weights (Tensor): Stacked weights of shape (..., num_models, out_features, in_features)
+            if `weight_transpose` is True, else (..., num_models, in_features, out_features).
+        gram_matrices (LowRankGram): diagonals of shape (..., num_models, in_features) and
+            factors of shape (..., num_models, rank, in_features).
+        reduce_non_diagonal_ratio (float): Scalar applied to the non-diagonal elements of the Gram matrices.
+        weight_transpose (bool): Whether the weights are stored as (out_features, in_features).
+
+    Returns:
+        Tensor: Merged weights, with the same layout as in `regmean_batched_merge`.
+    """
+    diagonals, factors = gram_matrices
+    *batch_shape, num_models, rank, hidden_dim = factors.shape
+    if num_models * rank >= hidden_dim:
+        # the Woodbury identity does not save anything, solve the materialized system
+        return regmean_batched_merge(
+            param_weights,
+            gram_matrices.dense(),
+            reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
+            weight_transpose=weight_transpose,
+        )
+    if weight_transpose:
+        param_weights = param_weights.transpose(-1, -2)
+    # the Woodbury correction cancels most of `E^{-1} rhs` when the residual diagonal is small,
+    # so it is computed in double precision
+    dtype = factors.dtype
+    diagonals, factors = diagonals.double(), factors.double()
+    param_weights = param_weights.double()
+    ratio = reduce_non_diagonal_ratio
+
+    # diagonal part of each reduced Gram matrix, a * residual + (1 - a) * diagonal
+    diagonal_parts = diagonals - ratio * factors.square().sum(dim=-2)
+    # sum_i E_i P_i + a sum_i B_i^T B_i P_i
+    rhs = (diagonal_parts.unsqueeze(-1) * param_weights).sum(dim=-3) + ratio * (
+        factors.mT @ (factors @ param_weights)
+    ).sum(dim=-3)
+
+    sum_diagonal = diagonal_parts.sum(dim=-2)
+    inv_diagonal = (
+        1 / sum_diagonal.clamp_min(sum_diagonal.amax(dim=-1, keepdim=True) * 1e-6)
+    ).unsqueeze(-1)
+    merged_param = inv_diagonal * rhs
+    if ratio != 0:
+        # (E + a U^T U)^{-1} = E^{-1} - E^{-1} U^T (I + a U E^{-1} U^T)^{-1} a U E^{-1}
+        factors = factors.reshape(*batch_shape, num_models * rank, hidden_dim)
+        capacitance = ratio * (factors * inv_diagonal.mT) @ factors.mT
+        capacitance.diagonal(dim1=-2, dim2=-1).add_(1)
+        correction = solve_regmean_system(
+            capacitance, ratio * (factors @ merged_param)
+        )
+        merged_param = merged_param - inv_diagonal * (factors.mT @ correction)
+    merged_param = merged_param.to(dtype)
+    return merged_param.transpose(-1, -2) if weight_transpose else merged_param
+
+
+class SketchedGramAccumulator(GramAccumulator):
+    """
+    Same as `GramAccumulator`, but keep a diagonal-plus-low-rank summary of the inputs instead
+    of the dense Gram matrices: the exact diagonal and a Frequent Directions sketch `B` of
+    `rank` rows, such that `x^T x - B^T B` is positive semi-definite with a spectral norm of
+    at most `||x||_F^2 / rank`. `finalize` returns `LowRankGram` approximations, which
+    take O(rank * hidden_dim) memory per module instead of O(hidden_dim^2).
+
+    If `track_error` is True, the dense Gram matrices are accumulated as well and the relative
+    Frobenius error of the approximations is logged and stored in `errors` by `finalize`.
+
+    Args:
+        rank (int): The number of rows of the sketches.
+        dtype (Optional[str | torch.dtype]): dtype of the accumulation buffers. Defaults to the dtype
+            of the inputs, or float32 for half-precision inputs.
+        share_inputs (bool): Whether to share the summaries of modules with the same input.
+        track_error (bool): Whether to compare the approximations with the dense Gram matrices.
+    """
+
+    def __init__(
+        self,
+        rank: int,
+        dtype: Optional[str | torch.dtype] = None,
+        share_inputs: bool = True,
+        track_error: bool = False,
+    ):
+        super().__init__(dtype=dtype, share_inputs=share_inputs)
+        self.rank = rank
+        self.track_error = track_error
+        # dictionary, summed squares of the inputs for each linear module
+        self.diagonals: Dict[str, Tensor] = {}
+        # dictionary, Frequent Directions sketch of the inputs for each linear module
+        self.sketches: Dict[str, Tensor] = {}
+        # dictionary, relative Frobenius error of the approximations, filled by `finalize` if `track_error` is True
+        self.errors: Dict[str, float] = {}
+
+    def _accumulate(self, module_name: str, x: Tensor):
+        if x.dtype in (torch.float16, torch.bfloat16):
+            # the SVD does not support half precision
+            x = x.float()
+        if self.track_error:
+            super()._accumulate(module_name, x)
+        if module_name not in self.diagonals:
+            self.diagonals[module_name] = x.square().sum(dim=0)
+            self.sketches[module_name] = x
+        else:
+            self.diagonals[module_name].add_(x.square().sum(dim=0))
+            self.sketches[module_name] = torch.cat([self.sketches[module_name], x])
+        if self.sketches[module_name].shape[0] >= 2 * self.rank:
+            self.sketches[module_name] = self._shrink(self.sketches[module_name])
+
+    def _shrink(self, sketch: Tensor) -> Tensor:
+        """
+        Shrink the sketch to `rank` rows, subtracting the (rank + 1)-th squared singular value from the others.
+        """
+        _, singular_values, vh = torch.linalg.svd(sketch, full_matrices=False)
+        if singular_values.shape[0] <= self.rank:
+            return singular_values.unsqueeze(-1) * vh
+        delta = singular_values[self.rank].square()
+        singular_values = (singular_values[: self.rank].square() - delta).clamp_min(0).sqrt()
+        return singular_values.unsqueeze(-1) * vh[: self.rank]
+
+    def _finalize_module(self, module_name: str, device):
+        sketch = self.sketches[module_name]
+        if sketch.shape[0] > self.rank:
+            sketch = self._shrink(sketch)
+        if sketch.shape[0] < self.rank:
+            # pad with zeros, so that the factors of all the models can be stacked
+            sketch = torch.cat(
+                [sketch, sketch.new_zeros(self.rank - sketch.shape[0], sketch.shape[1])]
+            )
+        num_computed_examples = self.num_computed_examples[module_name]
+        low_rank_gram = LowRankGram(
+            self.diagonals[module_name] / num_computed_examples,
+            sketch / num_computed_examples**0.5,
+        )
+        del self.diagonals[module_name], self.sketches[module_name]
+
+        if self.track_error:
+            gram_matrix = super()._finalize_module(module_name, device=None)
+            del self.gram_matrices[module_name]
+            self.errors[module_name] = (
+                torch.linalg.matrix_norm(low_rank_gram.dense() - gram_matrix)
+                / torch.linalg.matrix_norm(gram_matrix)
+            ).item()
+            log.info(
+                f"relative error of the rank-{self.rank} Gram approximation of {module_name}: "
+                f"{self.errors[module_name]:.4e}"
+            )
+        return low_rank_gram if device is None else low_rank_gram.to(device)
+
+
+def create_gram_accumulator(
+    dtype: Optional[str | torch.dtype] = None,
+    rank: Optional[int] = None,
+    track_error: bool = False,
+) -> GramAccumulator:
+    """
+    Create a `GramAccumulator`, or a `SketchedGramAccumulator` if `rank` is given.
+    """
+    if rank is None:
+        return GramAccumulator(dtype=dtype)
+    return SketchedGramAccumulator(rank, dtype=dtype, track_error=track_error)
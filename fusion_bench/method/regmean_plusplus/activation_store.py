@@ -0,0 +1,250 @@
+"""
+Stores for the activations propagated layer by layer in RegMean++.
+
+The activations of every model are written once per layer and read back (possibly several
+times) when the next layer is processed. `InMemoryActivationStore` keeps them as CPU
+tensors, `DiskActivationStore` writes them to a file and reads them back through a memory
+map, and `SpillingActivationStore` keeps them in memory until a shared `MemoryBudget` is
+exhausted and spills the remaining batches to disk.
+"""
+
+import logging
+import os
+import tempfile
+from abc import ABC, abstractmethod
+from itertools import chain
+from typing import Iterator, List, Optional, Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+log = logging.getLogger(__name__)
+
+__all__ = [
+    "ActivationStore",
+    "InMemoryActivationStore",
+    "DiskActivationStore",
+    "SpillingActivationStore",
+    "MemoryBudget",
+    "create_activation_store",
+]
+
+
+class MemoryBudget:
+    """
+    A byte counter shared by several activation stores.
+
+    Args:
+        max_bytes (int): The maximum number of bytes that can be reserved.
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.used_bytes = 0
+
+    def reserve(self, nbytes: int) -> bool:
+        """
+        Reserve `nbytes` bytes. Returns False if the budget would be exceeded.
+        """
+        if self.used_bytes + nbytes > self.max_bytes:
+            return False
+        self.used_bytes += nbytes
+        return True
+
+    def release(self, nbytes: int):
+        self.used_bytes -= nbytes
+
+
+class ActivationStore(ABC):
+    """
+    An append-only sequence of activation batches.
+    """
+
+    @abstractmethod
+    def append(self, batch: Tensor):
+        """
+        Append a batch of activations to the store.
+        """
+        pass
+
+    @abstractmethod
+    def __iter__(self) -> Iterator[Tensor]:
+        pass
+
+    @abstractmethod
+    def __len__(self) -> int:
+        pass
+
+    @abstractmethod
+    def clear(self):
+        """
+        Remove all the batches and release the underlying resources.
+        """
+        pass
+
+    @property
+    @abstractmethod
+    def nbytes(self) -> int:
+        pass
+
+
+class InMemoryActivationStore(ActivationStore):
+    """
+    Keep the activation batches as CPU tensors in a list.
+    """
+
+    def __init__(self):
+        self._batches: List[Tensor] = []
+
+    def append(self, batch: Tensor):
+        self._batches.append(batch.detach().cpu())
+
+    def __iter__(self) -> Iterator[Tensor]:
+        return iter(self._batches)
+
+    def __len__(self) -> int:
+        return len(self._batches)
+
+    def clear(self):
+        self._batches = []
+
+    @property
+    def nbytes(self) -> int:
+        return sum(batch.nbytes for batch in self._batches)
+
+
+class DiskActivationStore(ActivationStore):
+    """
+    Write the activation batches to a single file and read them back through a memory map.
+
+    The batches are stored back to back as raw bytes, the yielded tensors are views of the
+    memory-mapped file and no copy is made until they are moved to another device.
+
+    Args:
+        directory (str): The directory where the file is created.
+    """
+
+    def __init__(self, directory: str):
+        os.makedirs(directory, exist_ok=True)
+        fd, self.path = tempfile.mkstemp(
+            prefix="activations_", suffix=".bin", dir=directory
+        )
+        self._file = os.fdopen(fd, "wb")
+        # list of (offset, shape, dtype) of each batch
+        self._index: List[Tuple[int, torch.Size, torch.dtype]] = []
+        self._nbytes = 0
+
+    def append(self, batch: Tensor):
+        batch = batch.detach().cpu().contiguous()
+        data = batch.reshape(-1).view(torch.uint8).numpy()
+        data.tofile(self._file)
+        self._index.append((self._nbytes, batch.shape, batch.dtype))
+        self._nbytes += data.nbytes
+
+    def __iter__(self) -> Iterator[Tensor]:
+        if len(self._index) == 0:
+            return
+        self._file.flush()
+        # copy-on-write mode, so that the tensors are writable without modifying the file
+        buffer = np.memmap(self.path, dtype=np.uint8, mode="c")
+        for offset, shape, dtype in self._index:
+            nbytes = shape.numel() * dtype.itemsize
+            yield torch.from_numpy(buffer[offset : offset + nbytes]).view(
+                dtype
+            ).reshape(shape)
+
+    def __len__(self) -> int:
+        return len(self._index)
+
+    def clear(self):
+        self._index = []
+        self._nbytes = 0
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+    @property
+    def nbytes(self) -> int:
+        return self._nbytes
+
+
+class SpillingActivationStore(ActivationStore):
+    """
+    Keep the activation batches in memory while `budget` allows it, and spill the
+    remaining batches to a `DiskActivationStore`.
+
+    Args:
+        budget (MemoryBudget): The memory budget shared with other stores.
+        directory (str): The directory where the spilled batches are written.
+    """
+
+    def __init__(self, budget: MemoryBudget, directory: str):
+        self.budget = budget
+        self.directory = directory
+        self._memory_store = InMemoryActivationStore()
+        self._disk_store: Optional[DiskActivationStore] = None
+
+    def append(self, batch: Tensor):
+        # once spilled, all the following batches go to disk to keep the order
+        if self._disk_store is None and self.budget.reserve(batch.nbytes):
+            self._memory_store.append(batch)
+            return
+        if self._disk_store is None:
+            self._disk_store = DiskActivationStore(self.directory)
+        self._disk_store.append(batch)
+
+    def __iter__(self) -> Iterator[Tensor]:
+        if self._disk_store is None:
+            return iter(self._memory_store)
+        return chain(self._memory_store, self._disk_store)
+
+    def __len__(self) -> int:
+        return len(self._memory_store) + (
+            len(self._disk_store) if self._disk_store is not None else 0
+        )
+
+    def clear(self):
+        self.budget.release(self._memory_store.nbytes)
+        self._memory_store.clear()
+        if self._disk_store is not None:
+            self._disk_store.clear()
+            self._disk_store = None
+
+    @property
+    def nbytes(self) -> int:
+        return self._memory_store.nbytes + (
+            self._disk_store.nbytes if self._disk_store is not None else 0
+        )
+
+
+def create_activation_store(
+    backend: str,
+    directory: Optional[str] = None,
+    budget: Optional[MemoryBudget] = None,
+) -> ActivationStore:
+    """
+    Create an activation store.
+
+    Args:
+        backend (str): "memory", "disk" or "auto". "auto" keeps the activations in memory within `budget`
+            and spills the rest to disk.
+        directory (Optional[str]): The directory for the on-disk backends.
+        budget (Optional[MemoryBudget]): The memory budget for the "auto" backend.
+
+    Returns:
+        ActivationStore: The activation store.
+    """
+    if backend == "memory":
+        return InMemoryActivationStore()
+    elif backend == "disk":
+        assert directory is not None, "directory is required for the disk backend"
+        return DiskActivationStore(directory)
+    elif backend == "auto":
+        assert directory is not None, "directory is required for the auto backend"
+        assert budget is not None, "budget is required for the auto backend"
+        return SpillingActivationStore(budget, directory)
+    else:
+        raise ValueError(f"Unknown activation store backend: {backend}")
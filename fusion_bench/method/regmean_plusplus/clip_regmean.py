@@ -1,6 +1,6 @@
 import logging
 from collections import defaultdict
-from typing import Dict, List, cast  # noqa: F401
+from typing import Dict, Iterable, List, Optional, cast  # noqa: F401
 
 import torch
 import torch.utils.data
@@ -10,9 +10,9 @@ from torch.nn.modules import Module
 from torch.utils.data import DataLoader
 from tqdm.autonotebook import tqdm
 
-from fusion_bench.dataset.clip_dataset import CLIPDataset
 from fusion_bench.mixins import CLIPClassificationMixin
 
+from .activation_store import ActivationStore
 from .regmean import RegMeanAlgorithmPlusPlus
 
 log = logging.getLogger(__name__)
@@ -24,15 +24,35 @@ class RegMeanAlgorithmForCLIPPlusPlus(
 ):
     _config_mapping = {
         "_dataloader_kwargs": "dataloader_kwargs",
+        "preprocessed_cache_dir": "preprocessed_cache_dir",
+        "batched_preprocessing": "batched_preprocessing",
     }
 
-    def __init__(self, *, dataloader_kwargs: DictConfig, **kwargs):
+    def __init__(
+        self,
+        *,
+        dataloader_kwargs: DictConfig,
+        preprocessed_cache_dir: Optional[str] = None,
+        batched_preprocessing: bool = False,
+        **kwargs,
+    ):
         super().__init__(**kwargs)
         self._dataloader_kwargs = dataloader_kwargs
+        self.preprocessed_cache_dir = preprocessed_cache_dir
+        self.batched_preprocessing = batched_preprocessing
 
     def on_regmean_start(self):
         self.setup_zero_shot_classification_head()
 
+    def gram_cache_key_components(self):
+        return {
+            **super().gram_cache_key_components(),
+            "dataloader_kwargs": dict(self._dataloader_kwargs),
+            "image_processor": self.clip_processor.image_processor.to_dict(),
+            # the cached images are stored as float16
+            "preprocessed": self.preprocessed_cache_dir is not None,
+        }
+
     def compute_logits(self, module, batch, task: str) -> Tensor:
         images, _ = batch
         text_embeds = self.zeroshot_weights[task]
@@ -55,66 +75,25 @@ class RegMeanAlgorithmForCLIPPlusPlus(
         self,
         model_name: str,
         layer: Module,
-        batches_input: List[Tensor],
+        batches_input: Iterable[Tensor],
         linear_modules_to_merge: Dict[str, Module],
     ):
-        layer = self.fabric.setup(layer)
-
-        def compute_regmean_weights(module_name: str):
-            """
-            compute the regmean weights, a hook function to deal with each module's input
-            :param module_name: str, module name
-            :return:
-            """
-
-            def hook(module: nn.Module, input: tuple, output: torch.Tensor):
-                # Tensor, shape (batch_size, sequence_length, hidden_dim)
-                x = cast(Tensor, input[0]).detach()
-                batch_num_actual_examples = x.shape[0]
-                # Tensor, shape (batch_size * sequence_length, hidden_dim)
-                x = x.reshape(-1, x.shape[-1])
-                # Tensor, shape (hidden_dim, hidden_dim)
-                xtx = torch.matmul(x.transpose(0, 1), x)
-                # store the averaged weights in regmean_weights
-                if module_name not in regmean_weights.keys():
-                    regmean_weights[module_name] = xtx / x.shape[0]
-                    num_computed_examples[module_name] = x.shape[0]
-                    num_actual_examples[module_name] = batch_num_actual_examples
-                else:
-                    regmean_weights[module_name] = (
-                        regmean_weights[module_name]
-                        * num_computed_examples[module_name]
-                        + xtx
-                    ) / (num_computed_examples[module_name] + x.shape[0])
-                    num_computed_examples[module_name] += x.shape[0]
-                    num_actual_examples[module_name] += batch_num_actual_examples
-
-            return hook
-
-        handles = []
-        # dictionary, regmean matrices for each linear module inputs
-        regmean_weights = {}
-        # dictionary, number of examples (multiplied the sequence length) used for computing regmean matrices
-        num_computed_examples = {}
-        # dictionary, number of actual examples used for computing regmean matrices
-        num_actual_examples = {}
-
-        for module_name, linear_module_to_merge in linear_modules_to_merge.items():
-            # register a hook in the forward process
-            handle = linear_module_to_merge.register_forward_hook(
-                compute_regmean_weights(module_name=module_name)
-            )
-            handles.append(handle)
-        _ = self.layer_batches_forward(layer, batches_input)
+        layer = self.setup_module(layer)
+
+        # accumulate regmean matrices for each linear module inputs
+        accumulator = self.create_gram_accumulator()
+        # register hooks in the forward process
+        handles = accumulator.register_forward_hooks(linear_modules_to_merge)
+        # the outputs are not needed, only the inputs of the linear modules
+        device = next(layer.parameters()).device
+        for batch in batches_input:
+            _ = self.layer_forward(layer, batch.to(device))
 
         # remove the added hook
         for handle in handles:
             handle.remove()
 
-        for module_name in regmean_weights.keys():
-            regmean_weights[module_name] = regmean_weights[module_name].detach().cpu()
-
-        return regmean_weights
+        return accumulator.finalize(device="cpu")
 
     def merge_embedding_layer(self, models_to_merge_dict: Dict[str, nn.Module]):
         models_to_merge_param_dict = defaultdict(list)
@@ -141,14 +120,29 @@ class RegMeanAlgorithmForCLIPPlusPlus(
         return merged_params_dict
         
     
-    def get_input_for_first_layer(self, model: nn.Module, train_dataset):
+    def get_input_for_first_layer(
+        self,
+        model: nn.Module,
+        train_dataset,
+        batches_input: Optional[ActivationStore] = None,
+        dataset_name: Optional[str] = None,
+    ):
         # setup dataloader
-        train_dataset = CLIPDataset(train_dataset, self.clip_processor)
+        train_dataset = self.get_clip_dataset(
+            train_dataset,
+            name=f"{dataset_name}/train" if dataset_name is not None else None,
+        )
         train_dataloader = DataLoader(
-            train_dataset, shuffle=True, **self._dataloader_kwargs
+            train_dataset,
+            shuffle=True,
+            collate_fn=self.get_clip_collate_fn(),
+            **self._dataloader_kwargs,
+        )
+        # every process goes through all the examples of the models it owns
+        train_dataloader = self.fabric.setup_dataloaders(
+            train_dataloader, use_distributed_sampler=False
         )
-        train_dataloader = self.fabric.setup_dataloaders(train_dataloader)
-        model = self.fabric.setup(model)
+        model = self.setup_module(model)
 
         def compute_input(model, batch):
             images, _ = batch
@@ -163,15 +157,24 @@ class RegMeanAlgorithmForCLIPPlusPlus(
         num_computed_examples = 0
         num_regmean_examples = self.num_regmean_examples
 
-        batches_input = []
+        if batches_input is None:
+            batches_input = []
         for batch in train_dataloader:
             if num_computed_examples >= num_regmean_examples:
                 break
+            if batch is None:
+                continue  # all samples in batch were invalid
             batches_input.append(compute_input(model, batch))
             num_computed_examples += batch[0].size(0)
         
         return batches_input
 
+    def setup_module(self, module: nn.Module) -> nn.Module:
+        if self.task_parallel:
+            # wrapping with DDP would overwrite the parameters with the ones of rank 0
+            return self.fabric.to_device(module)
+        return self.fabric.setup(module)
+
     def get_layers(self, model: nn.Module):
         return model.vision_model.encoder.layers
     
@@ -182,11 +185,20 @@ class RegMeanAlgorithmForCLIPPlusPlus(
 
         return merged_params_dict
     
-    def layer_batches_forward(self, layer: nn.Module, batches_input: List[Tensor]) -> Tensor:
-        batches_output = []
+    def layer_forward(self, layer: nn.Module, hidden_states: Tensor) -> Tensor:
+        return layer(hidden_states, attention_mask=None, causal_attention_mask=None)[0]
+
+    def layer_batches_forward(
+        self,
+        layer: nn.Module,
+        batches_input: Iterable[Tensor],
+        batches_output: Optional[ActivationStore] = None,
+    ):
+        if batches_output is None:
+            batches_output = []
         for batch in batches_input:
             device = next(layer.parameters()).device
             batch = batch.to(device)
-            logits = layer(batch, attention_mask=None, causal_attention_mask=None)[0].detach().cpu()
+            logits = self.layer_forward(layer, batch).detach().cpu()
             batches_output.append(logits)
         return batches_output
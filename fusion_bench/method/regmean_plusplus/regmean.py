@@ -5,16 +5,31 @@ modified from https://github.com/yule-BUAA/MergeLM/blob/6d49ad96fd69c92013654b83
 
 import logging
 import re
+import shutil
+import tempfile
 from collections import defaultdict
-from typing import Dict, List, cast
+from itertools import zip_longest
+from typing import Dict, Iterable, Iterator, List, Optional, cast
 
 import torch
 from torch import Tensor, nn
 from tqdm.autonotebook import tqdm
 
 from fusion_bench.method import BaseAlgorithm
-from fusion_bench.mixins import SimpleProfilerMixin
+from fusion_bench.method.regmean.utils import (
+    GramAccumulator,
+    create_gram_accumulator,
+    get_dataset_fingerprint,
+    regmean_batched_merge,
+    regmean_merge_modules,
+    rng_state_fingerprint,
+)
+from fusion_bench.mixins import LightningFabricMixin, SimpleProfilerMixin
 from fusion_bench.modelpool import BaseModelPool
+from fusion_bench.utils.cache_utils import TensorCache, state_dict_fingerprint
+
+from .activation_store import ActivationStore, MemoryBudget, create_activation_store
+from .stacked_forward import StackedLayers, group_batches_by_shape
 
 log = logging.getLogger(__name__)
 
@@ -88,47 +103,22 @@ def regmean_params_merge(
     module_name: str = "",
     device = "cpu"
 ):
-    # two lists with length num_models_to_merge
-    param_multiplied_results, module_regmean_weights_list = [], []
-    for model_idx, module_regmean_weights in enumerate(
-        param_regmean_list
-    ):
-        # reduce non-diagonal elements
-        module_regmean_weights = reduce_non_diagonal_elements(
-            regmean_weights=module_regmean_weights,
-            reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
-        )
-        module_regmean_weights_list.append(module_regmean_weights)
-
-        model_to_merge_param = param_weight_list[model_idx]
-        # since the weight shape of Linear module is (output_size, input_size), we need to transpose it
-        param_multiplied_results.append(
-            torch.matmul(
-                module_regmean_weights,
-                (
-                    model_to_merge_param.transpose(0, 1)
-                    if weight_transpose
-                    else model_to_merge_param
-                ),
-            )
-        )
-
-    # sum up module_regmean_weights and param_multiplied_results over all individual models
-    sum_module_regmean_weights = sum(module_regmean_weights_list)
-    sum_param_multiplied_results = sum(param_multiplied_results)
-
-    # get the inverse matrix
-    inv_sum_module_regmean_weights = torch.inverse(
-        sum_module_regmean_weights
-    )
-    # merge parameters with regmean
-    merged_param = torch.matmul(
-        inv_sum_module_regmean_weights, sum_param_multiplied_results
+    """
+    merge the weights of a single linear module with regmean
+    :param param_weight_list: list, weights of the module for each model that needs to be merged
+    :param param_regmean_list: list, regmean weights (matrix) of the module for each model that needs to be merged
+    :param reduce_non_diagonal_ratio: float, reduce non-diagonal elements in regmean weights by multiplying this scalar
+    :param weight_transpose: bool, whether the weight shape is (output_size, input_size)
+    :return:
+    """
+    param_weights = torch.stack([param.to(device) for param in param_weight_list], dim=0)
+    param_regmean_weights = torch.stack([regmean_weights.to(device) for regmean_weights in param_regmean_list], dim=0)
+    return regmean_batched_merge(
+        param_weights=param_weights,
+        gram_matrices=param_regmean_weights,
+        reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
+        weight_transpose=weight_transpose,
     )
-    # transpose to the original shape of "weight" in Linear module
-    merged_param = merged_param.transpose(0, 1) if weight_transpose else merged_param
-
-    return merged_param
 
 
 def merging_with_regmean_weights(
@@ -149,33 +139,31 @@ def merging_with_regmean_weights(
     # dict, dictionary of model parameters
     merged_params = {}
 
+    # only perform regmean merging on the "weight" parameter of Linear module
+    module_weights, module_regmean_weights = {}, {}
     for param_name, param_value_list in models_to_merge_param_dict.items():
-        merged_by_regmean = False
-        # only perform regmean merging on the "weight" parameter of Linear module
         if param_name.endswith(".weight"):
             module_name = param_name[: -len(".weight")]
             if module_name in models_to_merge_regmean_weights_list[0].keys():
-                # two lists with length num_models_to_merge
-                module_regmean_weights_list = []
-                for model_idx, model_to_merge_regmean_weights in enumerate(
-                    models_to_merge_regmean_weights_list
-                ):
-                    device = param_value_list[model_idx].device
-
-                    # Tensor, shape (hidden_dim, hidden_dim)
-                    module_regmean_weights = model_to_merge_regmean_weights[module_name].to(device)
-                    module_regmean_weights_list.append(module_regmean_weights)
-
-                merged_params[param_name] = regmean_params_merge(param_weight_list=param_value_list,
-                                                                 param_regmean_list=module_regmean_weights_list,
-                                                                 reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
-                                                                 weight_transpose=weight_transpose,
-                                                                 module_name=module_name,
-                                                                 device=device)
+                module_weights[module_name] = param_value_list
+                module_regmean_weights[module_name] = [
+                    model_to_merge_regmean_weights[module_name]
+                    for model_to_merge_regmean_weights in models_to_merge_regmean_weights_list
+                ]
+    # merge all the linear modules of the layer with batched solves
+    merged_weights = regmean_merge_modules(
+        module_weights=module_weights,
+        module_gram_matrices=module_regmean_weights,
+        reduce_non_diagonal_ratio=reduce_non_diagonal_ratio,
+        weight_transpose=weight_transpose,
+    )
 
-                merged_by_regmean = True
+    for param_name, param_value_list in models_to_merge_param_dict.items():
+        module_name = param_name[: -len(".weight")]
+        if param_name.endswith(".weight") and module_name in merged_weights:
+            merged_params[param_name] = merged_weights[module_name]
         # use average merging for parameters whose names are not end with ".weight" or not in Linear module
-        if not merged_by_regmean:
+        else:
             merged_params[param_name] = torch.stack(param_value_list, dim=0).mean(dim=0)
 
     return merged_params
@@ -188,6 +176,16 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
         "exclude_param_names_regex": "exclude_param_names_regex",
         "reduce_non_diagonal_ratio": "reduce_non_diagonal_ratio",
         "weight_transpose": "weight_transpose",
+        "accumulate_dtype": "accumulate_dtype",
+        "activation_store": "activation_store",
+        "activation_store_dir": "activation_store_dir",
+        "activation_memory_budget": "activation_memory_budget",
+        "batched_forward": "batched_forward",
+        "fused_forward": "fused_forward",
+        "gram_cache_dir": "gram_cache_dir",
+        "gram_cache_max_size": "gram_cache_max_size",
+        "gram_rank": "gram_rank",
+        "gram_error_report": "gram_error_report",
     }
 
     def __init__(
@@ -197,12 +195,40 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
         exclude_param_names_regex: list,
         reduce_non_diagonal_ratio: float,
         weight_transpose: bool,
+        accumulate_dtype: Optional[str] = None,
+        activation_store: str = "memory",
+        activation_store_dir: Optional[str] = None,
+        activation_memory_budget: Optional[float] = None,
+        batched_forward: bool = False,
+        fused_forward: bool = False,
+        gram_cache_dir: Optional[str] = None,
+        gram_cache_max_size: Optional[float] = None,
+        gram_rank: Optional[int] = None,
+        gram_error_report: bool = False,
         **kwargs,
     ):
         self.num_regmean_examples = num_regmean_examples
         self.exclude_param_names_regex = exclude_param_names_regex
         self.reduce_non_diagonal_ratio = reduce_non_diagonal_ratio
         self.weight_transpose = weight_transpose
+        # dtype used to accumulate the regmean weights, e.g. "float64"
+        self.accumulate_dtype = accumulate_dtype
+        # backend of the stores of the activations propagated layer by layer, "memory", "disk" or "auto"
+        self.activation_store = activation_store
+        self.activation_store_dir = activation_store_dir
+        # memory budget (in GB) of the activations for the "auto" backend
+        self.activation_memory_budget = activation_memory_budget
+        # whether to forward the layers of all the models at once with `torch.func`
+        self.batched_forward = batched_forward
+        # whether to collect the regmean weights of the next layer while forwarding the merged layer
+        self.fused_forward = fused_forward
+        # directory of the persistent cache of regmean weights, and its maximum size in GB
+        self.gram_cache_dir = gram_cache_dir
+        self.gram_cache_max_size = gram_cache_max_size
+        # rank of the diagonal-plus-low-rank approximation of the regmean weights, None for the dense regmean weights
+        self.gram_rank = gram_rank
+        # whether to log the error of the approximated regmean weights, the dense ones are computed as well
+        self.gram_error_report = gram_error_report
         super().__init__(**kwargs)
 
     def run(self, modelpool: BaseModelPool, **kwargs):
@@ -210,76 +236,93 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
             modelpool = BaseModelPool(modelpool)
         self.modelpool = modelpool
         device = "cuda:0" if torch.cuda.is_available() else "cpu"
+        if self.task_parallel:
+            device = self.fabric.device
         models_to_merge_dict = {name: model.to(device) for name, model in modelpool.named_models()}
+        model_names = list(models_to_merge_dict.keys())
+        # the statistics of these models are collected by this process, see `get_owned_model_names`
+        owned_model_names = self.get_owned_model_names(model_names)
         self.on_regmean_start()
 
         # initialize the merged models as the pretrained model
         merged_model = modelpool.load_pretrained_model().to(device)
         merged_params_dict = {}
+        self.setup_activation_stores()
+        self.setup_gram_cache()
 
         # 1. merge embedding layer
         merged_embedding_dict = self.merge_embedding_layer(models_to_merge_dict=models_to_merge_dict)
         merged_model.load_state_dict(merged_embedding_dict, strict=False)
 
         with torch.no_grad():
-            # 1.1. compute input for the first layer
-            with (
-                self.profile("merging models"),
-                self.profile("computing first layer input"),
-            ):
-                batches_input_dict = defaultdict(list)
-                for name in tqdm(models_to_merge_dict.keys(), desc="computing input for first layer"):
-                    dataset = modelpool.load_train_dataset(name)
-                    
-                    ##################### ONLY FOR EXPERIMENTS #####################
-                    import os
-                    from datasets import concatenate_datasets
-
-
-                    # Sequential Merging
-                    merged_tasks = os.getenv("MERGED_TASKS", None)
-                    if merged_tasks is not None:
-                        if name == "imagenet":
-                            merged_tasks = merged_tasks.split(":")
-
-                            from hydra.utils import instantiate
-                            from omegaconf import OmegaConf
-
-                            seed = 42
-                            n_samples = int(256 / len(merged_tasks))
-                            all_datasets = []
-                            for task in merged_tasks:
-                                config = OmegaConf.load(f"config/dataset/image_classification/train/{task}.yaml")
-                                dataset = instantiate(config)[task]
-
-                                dataset = dataset.train_test_split(test_size=n_samples, seed=seed)["test"]
-                                dataset = dataset.remove_columns("label")
-                                dataset = dataset.map(lambda example: {"label": 1})
-
-                                all_datasets.append(dataset)
-
-                            assert len(all_datasets) == len(merged_tasks)
-                            
-                            all_datasets = concatenate_datasets(all_datasets)
-                            dataset = all_datasets.shuffle(seed=seed)
-                            
-                            assert len(dataset) <= 256 and len(dataset) >= 256-len(merged_tasks)
-
-
-                    # Class Imbalance
-                    class_id = os.getenv("EXP_CLASS_ID")
-                    if class_id is not None:
-                        class_id = int(class_id)
-                        dataset = dataset.filter(lambda example: example['label'] == class_id, 
-                                                 num_proc=4, 
-                                                 load_from_cache_file=False)
+            # 1.1. load the datasets
+            datasets_dict = {}
+            for name in owned_model_names:
+                dataset = modelpool.load_train_dataset(name)
+                
+                ##################### ONLY FOR EXPERIMENTS #####################
+                import os
+                from datasets import concatenate_datasets
+
+
+                # Sequential Merging
+                merged_tasks = os.getenv("MERGED_TASKS", None)
+                if merged_tasks is not None:
+                    if name == "imagenet":
+                        merged_tasks = merged_tasks.split(":")
+
+                        from hydra.utils import instantiate
+                        from omegaconf import OmegaConf
+
+                        seed = 42
+                        n_samples = int(256 / len(merged_tasks))
+                        all_datasets = []
+                        for task in merged_tasks:
+                            config = OmegaConf.load(f"config/dataset/image_classification/train/{task}.yaml")
+                            dataset = instantiate(config)[task]
+
+                            dataset = dataset.train_test_split(test_size=n_samples, seed=seed)["test"]
+                            dataset = dataset.remove_columns("label")
+                            dataset = dataset.map(lambda example: {"label": 1})
+
+                            all_datasets.append(dataset)
+
+                        assert len(all_datasets) == len(merged_tasks)
                         
-                    ##################### ONLY FOR EXPERIMENTS #####################
+                        all_datasets = concatenate_datasets(all_datasets)
+                        dataset = all_datasets.shuffle(seed=seed)
+                        
+                        assert len(dataset) <= 256 and len(dataset) >= 256-len(merged_tasks)
 
-                    batches_input_dict[name] = self.get_input_for_first_layer(
-                        merged_model,
-                        dataset
-                    )
+
+                # Class Imbalance
+                class_id = os.getenv("EXP_CLASS_ID")
+                if class_id is not None:
+                    class_id = int(class_id)
+                    dataset = dataset.filter(lambda example: example['label'] == class_id, 
+                                             num_proc=4, 
+                                             load_from_cache_file=False)
+                    
+                ##################### ONLY FOR EXPERIMENTS #####################
+
+                datasets_dict[name] = dataset
+
+            # fingerprint of everything that determines the inputs of the current layer, used in the keys of the gram cache
+            upstream_fingerprint = None
+            if self.gram_cache is not None:
+                upstream_fingerprint = TensorCache.make_key(
+                    model=state_dict_fingerprint(merged_model.state_dict()),
+                    rng_state=rng_state_fingerprint(),
+                )
+
+            # 1.2. compute input for the first layer, skipped as long as the regmean weights are found in the gram cache
+            batches_input_dict: Optional[Dict[str, ActivationStore]] = None
+            if self.gram_cache is None:
+                with (
+                    self.profile("merging models"),
+                    self.profile("computing first layer input"),
+                ):
+                    batches_input_dict = self.get_layer_inputs(merged_model, datasets_dict, layer_idx=0)
 
             # 2. iteratively merge layer by layer with regmean algorithm
             backbone_layers = self.get_layers(merged_model)
@@ -288,8 +331,11 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
             models_to_merge_layers_dict = defaultdict(list)
             for name, model in models_to_merge_dict.items():
                 models_to_merge_layers_dict[name] = self.get_layers(model)
+            owned_layers_dict = {name: models_to_merge_layers_dict[name] for name in owned_model_names}
 
             param_names_to_merge = None
+            # regmean weights of the current layer collected by the fused pass of the previous layer
+            next_regmean_weights_dict = None
             for layer_idx, backbone_layer in tqdm(enumerate(backbone_layers), 
                                                   desc="merging layers", 
                                                   total=num_layers):
@@ -301,6 +347,7 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
                 # each dictionary records the regmean weights (matrix) of parameters for each model that needs to be merged
                 models_to_merge_regmean_weights_list = []
 
+                linear_modules_to_merge_dict = {}
                 for name, layers_to_merge in models_to_merge_layers_dict.items():
                     layer_to_merge = layers_to_merge[layer_idx]
                     param_dict = layer_to_merge.state_dict()
@@ -323,27 +370,57 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
                         model=layer_to_merge, include_module_types=self._include_module_type
                     )
                     assert len(linear_modules_to_merge) > 0, "No linear modules to merge"
+                    linear_modules_to_merge_dict[name] = linear_modules_to_merge
 
-                    # 2.1. compute regmean weights for each model
-                    with (
-                        self.profile("merging models"),
-                        self.profile("computing regmean weights"),
-                    ):
-                        regmean_weights = self.get_regmean_weights(
-                            name,
-                            layer_to_merge,
-                            batches_input=batches_input_dict[name],
-                            linear_modules_to_merge=linear_modules_to_merge,
-                        )
-
-                        module_subset = get_param_names_to_merge(
-                            input_param_names=list(param_dict.keys()),
-                            exclude_param_names_regex=self.exclude_param_names_regex
-                        )
-                        module_subset = [name.replace(".weight", "").replace(".bias", "") for name in module_subset]
-                        module_subset = list(set(module_subset))
-                        regmean_weights = {module_name: regmean_weights[module_name] for module_name in module_subset if module_name in regmean_weights}
-                        
+                # 2.1. compute regmean weights for each model
+                with (
+                    self.profile("merging models"),
+                    self.profile("computing regmean weights"),
+                ):
+                    gram_cache_keys = None
+                    if self.gram_cache is not None:
+                        gram_cache_keys = {
+                            name: self.get_gram_cache_key(
+                                layers_to_merge[layer_idx].state_dict(),
+                                datasets_dict[name],
+                                upstream=upstream_fingerprint,
+                                modules=sorted(linear_modules_to_merge_dict[name].keys()),
+                            )
+                            for name, layers_to_merge in owned_layers_dict.items()
+                        }
+
+                    regmean_weights_dict = None
+                    if gram_cache_keys is not None and next_regmean_weights_dict is None:
+                        regmean_weights_dict = self.load_cached_regmean_weights(gram_cache_keys)
+
+                    if regmean_weights_dict is None:
+                        if next_regmean_weights_dict is not None:
+                            regmean_weights_dict = next_regmean_weights_dict
+                        else:
+                            if batches_input_dict is None:
+                                batches_input_dict = self.get_layer_inputs(merged_model, datasets_dict, layer_idx=layer_idx)
+                            if self.batched_forward:
+                                regmean_weights_dict = self.get_regmean_weights_batched(
+                                    {name: layers_to_merge[layer_idx] for name, layers_to_merge in owned_layers_dict.items()},
+                                    batches_input_dict=batches_input_dict,
+                                    linear_module_names=list(linear_modules_to_merge.keys()),
+                                )
+                            else:
+                                regmean_weights_dict = {}
+                                for name, layers_to_merge in owned_layers_dict.items():
+                                    regmean_weights_dict[name] = self.get_regmean_weights(
+                                        name,
+                                        layers_to_merge[layer_idx],
+                                        batches_input=batches_input_dict[name],
+                                        linear_modules_to_merge=linear_modules_to_merge_dict[name],
+                                    )
+                        if gram_cache_keys is not None:
+                            self.save_cached_regmean_weights(gram_cache_keys, regmean_weights_dict)
+                    next_regmean_weights_dict = None
+                    regmean_weights_dict = self.gather_regmean_weights(regmean_weights_dict, model_names)
+
+                    for name in models_to_merge_layers_dict.keys():
+                        regmean_weights = self.select_regmean_weights(regmean_weights_dict[name], list(param_dict.keys()))
                         models_to_merge_regmean_weights_list.append(regmean_weights)
 
                 # 2.2. merge parameters with regmean weights
@@ -402,19 +479,365 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
                 ):
                     if layer_idx < num_layers - 1:
                         backbone_layer.load_state_dict(merged_layer_params, strict=False)
-                        batches_output_dict = defaultdict(list)
-                        for name in models_to_merge_dict.keys():
-                            batches_output_dict[name] = self.layer_batches_forward(
-                                backbone_layer, 
-                                batches_input_dict[name]
+                        if upstream_fingerprint is not None:
+                            upstream_fingerprint = TensorCache.make_key(
+                                upstream=upstream_fingerprint,
+                                layer=state_dict_fingerprint(backbone_layer.state_dict()),
                             )
+                    if layer_idx < num_layers - 1 and batches_input_dict is not None:
+                        batches_output_dict: Dict[str, ActivationStore] = {}
+                        if self.fused_forward:
+                            # forward the merged layer and collect the regmean weights of the next layer in a single pass
+                            for name in owned_model_names:
+                                batches_output_dict[name] = self.create_activation_store()
+                            next_regmean_weights_dict = self.forward_and_get_regmean_weights(
+                                backbone_layer,
+                                {name: layers_to_merge[layer_idx + 1] for name, layers_to_merge in owned_layers_dict.items()},
+                                batches_input_dict=batches_input_dict,
+                                batches_output_dict=batches_output_dict,
+                            )
+                            for name in owned_model_names:
+                                batches_input_dict[name].clear()
+                        elif self.batched_forward:
+                            for name in owned_model_names:
+                                batches_output_dict[name] = self.create_activation_store()
+                            self.models_batches_forward(backbone_layer, batches_input_dict, batches_output_dict)
+                            for name in owned_model_names:
+                                batches_input_dict[name].clear()
+                        else:
+                            for name in owned_model_names:
+                                batches_output_dict[name] = self.layer_batches_forward(
+                                    backbone_layer, 
+                                    batches_input_dict[name],
+                                    batches_output=self.create_activation_store(),
+                                )
+                                # the inputs of this layer are no longer needed
+                                batches_input_dict[name].clear()
                         batches_input_dict = batches_output_dict
                 
             # 3. load state dict to the merged model
             merged_model.load_state_dict(merged_params_dict, strict=False)
 
+        if batches_input_dict is not None:
+            for batches_input in batches_input_dict.values():
+                batches_input.clear()
+        self.teardown_activation_stores()
+
         self.print_profile_summary()
         return merged_model
+
+    def get_layer_inputs(
+        self,
+        merged_model: nn.Module,
+        datasets_dict: Dict[str, object],
+        layer_idx: int,
+    ) -> Dict[str, ActivationStore]:
+        """
+        Compute the inputs of the layer `layer_idx` for each dataset, by forwarding the examples
+        through the embedding layer and the layers of `merged_model` before `layer_idx`, which
+        must already hold the merged parameters.
+        """
+        batches_input_dict: Dict[str, ActivationStore] = {}
+        for name, dataset in tqdm(datasets_dict.items(), desc="computing input for first layer"):
+            batches_input_dict[name] = self.get_input_for_first_layer(
+                merged_model,
+                dataset,
+                batches_input=self.create_activation_store(),
+                dataset_name=name,
+            )
+        for layer in self.get_layers(merged_model)[:layer_idx]:
+            for name in datasets_dict.keys():
+                batches_output = self.layer_batches_forward(
+                    layer,
+                    batches_input_dict[name],
+                    batches_output=self.create_activation_store(),
+                )
+                batches_input_dict[name].clear()
+                batches_input_dict[name] = batches_output
+        return batches_input_dict
+
+    @property
+    def task_parallel(self) -> bool:
+        """
+        Whether the models are spread over the processes of a distributed Fabric run.
+        """
+        return isinstance(self, LightningFabricMixin) and self.fabric.world_size > 1
+
+    def get_owned_model_names(self, model_names: List[str]) -> List[str]:
+        """
+        Get the names of the models whose statistics are collected by this process.
+
+        In a distributed Fabric run, the models are assigned to the ranks in a round-robin fashion,
+        every rank computes the activations and the regmean weights of its models only, and the
+        regmean weights are exchanged with `gather_regmean_weights` before merging each layer.
+        """
+        if not self.task_parallel:
+            return model_names
+        assert self.fabric.world_size <= len(model_names), (
+            f"the number of processes ({self.fabric.world_size}) exceeds the number of models ({len(model_names)})"
+        )
+        return model_names[self.fabric.global_rank :: self.fabric.world_size]
+
+    def gather_regmean_weights(
+        self, regmean_weights_dict: Dict[str, Dict[str, Tensor]], model_names: List[str]
+    ) -> Dict[str, Dict[str, Tensor]]:
+        """
+        Share the regmean weights computed by every process with all the processes, so that they all merge the layer
+        with the same statistics. The regmean weights of the i-th model are broadcast from the rank that owns it.
+        """
+        if not self.task_parallel:
+            return regmean_weights_dict
+        gathered_regmean_weights_dict = {}
+        for model_idx, name in enumerate(model_names):
+            src = model_idx % self.fabric.world_size
+            gathered_regmean_weights_dict[name] = self.fabric.broadcast(
+                regmean_weights_dict[name] if self.fabric.global_rank == src else None,
+                src=src,
+            )
+        return gathered_regmean_weights_dict
+
+    def create_gram_accumulator(self) -> GramAccumulator:
+        """
+        Create the accumulator of the regmean weights of one model, a `SketchedGramAccumulator` if `gram_rank` is set.
+        """
+        return create_gram_accumulator(
+            dtype=self.accumulate_dtype,
+            rank=self.gram_rank,
+            track_error=self.gram_error_report,
+        )
+
+    def setup_gram_cache(self):
+        """
+        Open the persistent cache of regmean weights if `gram_cache_dir` is set.
+        """
+        self.gram_cache = None
+        if self.gram_cache_dir is not None:
+            max_size = (
+                int(self.gram_cache_max_size * 1024**3)
+                if self.gram_cache_max_size is not None
+                else None
+            )
+            self.gram_cache = TensorCache(self.gram_cache_dir, max_size=max_size)
+
+    def gram_cache_key_components(self) -> Dict:
+        """
+        Settings other than the layer, its inputs and the dataset that affect the regmean weights, used in the keys of the gram cache.
+        """
+        return {
+            "num_regmean_examples": self.num_regmean_examples,
+            "accumulate_dtype": self.accumulate_dtype,
+        }
+
+    def get_gram_cache_key(
+        self, state_dict: Dict[str, Tensor], train_dataset, **components
+    ) -> Optional[str]:
+        """
+        Build the key of the regmean weights of a layer in the gram cache.
+
+        Returns None if the dataset has no fingerprint.
+        """
+        if self.gram_rank is not None:
+            log.warning("The approximated regmean weights are not cached.")
+            return None
+        dataset_fingerprint = get_dataset_fingerprint(train_dataset)
+        if dataset_fingerprint is None:
+            log.warning(
+                "The dataset has no fingerprint, the regmean weights are not cached."
+            )
+            return None
+        return TensorCache.make_key(
+            algorithm=self.__class__.__name__,
+            layer=state_dict_fingerprint(state_dict),
+            dataset=dataset_fingerprint,
+            **self.gram_cache_key_components(),
+            **components,
+        )
+
+    def load_cached_regmean_weights(
+        self, gram_cache_keys: Dict[str, Optional[str]]
+    ) -> Optional[Dict[str, Dict[str, Tensor]]]:
+        """
+        Load the regmean weights of all the models from the gram cache.
+        Returns None unless all of them are cached, as the activations have to be computed anyway.
+        """
+        if any(key is None or key not in self.gram_cache for key in gram_cache_keys.values()):
+            return None
+        regmean_weights_dict = {}
+        for name, key in gram_cache_keys.items():
+            regmean_weights = self.gram_cache.get(key)
+            if regmean_weights is None:
+                return None
+            regmean_weights_dict[name] = regmean_weights
+        log.info("loaded cached regmean weights")
+        return regmean_weights_dict
+
+    def save_cached_regmean_weights(
+        self,
+        gram_cache_keys: Dict[str, Optional[str]],
+        regmean_weights_dict: Dict[str, Dict[str, Tensor]],
+    ):
+        for name, key in gram_cache_keys.items():
+            if key is not None:
+                self.gram_cache.put(key, regmean_weights_dict[name])
+
+    def select_regmean_weights(self, regmean_weights: Dict[str, Tensor], param_names: List[str]):
+        """
+        Keep the regmean weights of the modules whose parameters are not excluded by `exclude_param_names_regex`.
+        """
+        module_subset = get_param_names_to_merge(
+            input_param_names=param_names,
+            exclude_param_names_regex=self.exclude_param_names_regex
+        )
+        module_subset = [name.replace(".weight", "").replace(".bias", "") for name in module_subset]
+        module_subset = list(set(module_subset))
+        return {module_name: regmean_weights[module_name] for module_name in module_subset if module_name in regmean_weights}
+
+    def get_regmean_weights_batched(
+        self,
+        layers: Dict[str, nn.Module],
+        batches_input_dict: Dict[str, Iterable[Tensor]],
+        linear_module_names: List[str],
+    ) -> Dict[str, Dict[str, Tensor]]:
+        """
+        Compute the regmean weights of the same layer of all the models. The layers are stacked
+        with `StackedLayers` and each calibration batch is forwarded through all of them at once.
+
+        Args:
+            layers (Dict[str, nn.Module]): model name -> layer.
+            batches_input_dict (Dict[str, Iterable[Tensor]]): model name -> input batches of the layer.
+            linear_module_names (List[str]): Names of the linear modules in the layer.
+
+        Returns:
+            Dict[str, Dict[str, Tensor]]: model name -> regmean weights of each linear module.
+        """
+        model_names = list(layers.keys())
+        stacked_layers = StackedLayers(
+            [layers[name] for name in model_names],
+            self.layer_forward,
+            capture_module_names=linear_module_names,
+        )
+        accumulators = {
+            name: self.create_gram_accumulator() for name in model_names
+        }
+        for batches in zip_longest(*(batches_input_dict[name] for name in model_names)):
+            # models with the same batch shape are run together
+            for model_indices, hidden_states in group_batches_by_shape(batches):
+                _, captured = stacked_layers(
+                    torch.stack(hidden_states),
+                    model_indices=None if len(model_indices) == len(model_names) else model_indices,
+                )
+                for i, model_idx in enumerate(model_indices):
+                    accumulator = accumulators[model_names[model_idx]]
+                    for module_name, x in stacked_layers.module_inputs(captured, i):
+                        accumulator.update(module_name, x)
+
+        return {
+            name: accumulator.finalize(device="cpu")
+            for name, accumulator in accumulators.items()
+        }
+
+    def models_batches_forward(
+        self,
+        layer: nn.Module,
+        batches_input_dict: Dict[str, Iterable[Tensor]],
+        batches_output_dict: Dict[str, ActivationStore],
+    ):
+        """
+        Forward the input batches of all the models through the same layer, concatenating
+        the batches of the models along the batch dimension.
+        """
+        model_names = list(batches_input_dict.keys())
+        device = next(layer.parameters()).device
+        for batches in zip_longest(*(batches_input_dict[name] for name in model_names)):
+            for model_indices, hidden_states in group_batches_by_shape(batches, dim=1):
+                outputs = self.layer_forward(layer, torch.cat(hidden_states).to(device))
+                outputs = outputs.split([batch.shape[0] for batch in hidden_states])
+                for model_idx, output in zip(model_indices, outputs):
+                    batches_output_dict[model_names[model_idx]].append(output.detach().cpu())
+
+    def forward_and_get_regmean_weights(
+        self,
+        layer: nn.Module,
+        next_layers: Dict[str, nn.Module],
+        batches_input_dict: Dict[str, Iterable[Tensor]],
+        batches_output_dict: Dict[str, ActivationStore],
+    ) -> Dict[str, Dict[str, Tensor]]:
+        """
+        Forward the input batches of all the models through the merged `layer` and store the outputs
+        in `batches_output_dict`. In the same pass, the outputs are fed to the layers in `next_layers`
+        to collect their regmean weights, so the activations are read only once per layer.
+
+        Returns:
+            Dict[str, Dict[str, Tensor]]: model name -> regmean weights of each linear module of the next layer.
+        """
+        batches_output_iters = {
+            name: self._forward_and_store(layer, batches_input_dict[name], batches_output_dict[name])
+            for name in next_layers.keys()
+        }
+        if self.batched_forward:
+            linear_modules_to_merge = get_modules_to_merge(
+                model=next(iter(next_layers.values())), include_module_types=self._include_module_type
+            )
+            return self.get_regmean_weights_batched(
+                next_layers,
+                batches_input_dict=batches_output_iters,
+                linear_module_names=list(linear_modules_to_merge.keys()),
+            )
+
+        regmean_weights_dict = {}
+        for name, next_layer in next_layers.items():
+            regmean_weights_dict[name] = self.get_regmean_weights(
+                name,
+                next_layer,
+                batches_input=batches_output_iters[name],
+                linear_modules_to_merge=get_modules_to_merge(
+                    model=next_layer, include_module_types=self._include_module_type
+                ),
+            )
+        return regmean_weights_dict
+
+    def _forward_and_store(
+        self, layer: nn.Module, batches_input: Iterable[Tensor], batches_output: ActivationStore
+    ) -> Iterator[Tensor]:
+        device = next(layer.parameters()).device
+        for batch in batches_input:
+            output = self.layer_forward(layer, batch.to(device)).detach()
+            batches_output.append(output.cpu())
+            # the output stays on the device for the next layer
+            yield output
+
+    def setup_activation_stores(self):
+        """
+        Prepare the directory and the memory budget of the activation stores.
+        """
+        self._activation_tmp_dir = None
+        self._activation_store_dir = self.activation_store_dir
+        if self.activation_store != "memory" and self._activation_store_dir is None:
+            self._activation_tmp_dir = tempfile.mkdtemp(prefix="regmean_plusplus_")
+            self._activation_store_dir = self._activation_tmp_dir
+        self._activation_memory_budget = None
+        if self.activation_store == "auto":
+            assert (
+                self.activation_memory_budget is not None
+            ), "activation_memory_budget is required for the auto activation store"
+            self._activation_memory_budget = MemoryBudget(
+                int(self.activation_memory_budget * 1024**3)
+            )
+
+    def teardown_activation_stores(self):
+        if self._activation_tmp_dir is not None:
+            shutil.rmtree(self._activation_tmp_dir, ignore_errors=True)
+            self._activation_tmp_dir = None
+
+    def create_activation_store(self) -> ActivationStore:
+        """
+        Create an activation store for the batches of one model at one layer.
+        """
+        return create_activation_store(
+            self.activation_store,
+            directory=self._activation_store_dir,
+            budget=self._activation_memory_budget,
+        )
     
     def merge_embedding_layer(self, models_to_merge_dict: Dict[str, nn.Module]):
         """
@@ -423,7 +846,13 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
         """
         raise NotImplementedError()
 
-    def get_input_for_first_layer(self, model: nn.Module, train_dataset):
+    def get_input_for_first_layer(
+        self,
+        model: nn.Module,
+        train_dataset,
+        batches_input: Optional[ActivationStore] = None,
+        dataset_name: Optional[str] = None,
+    ):
         raise NotImplementedError
 
     def get_layers(self, model: nn.Module):
@@ -432,7 +861,18 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
     def update_merged_params_dict(self, merged_params_dict, new_merged_params, layer_idx):
         raise NotImplementedError
     
-    def layer_batches_forward(self, layer: nn.Module, batches_input: List[Tensor]):
+    def layer_forward(self, layer: nn.Module, hidden_states: Tensor) -> Tensor:
+        """
+        Compute the output hidden states of a layer.
+        """
+        raise NotImplementedError
+
+    def layer_batches_forward(
+        self,
+        layer: nn.Module,
+        batches_input: Iterable[Tensor],
+        batches_output: Optional[ActivationStore] = None,
+    ):
         raise NotImplementedError
 
     def on_regmean_start(self):
@@ -442,7 +882,7 @@ class RegMeanAlgorithmPlusPlus(BaseAlgorithm, SimpleProfilerMixin):
         self,
         model_name: str,
         layer: nn.Module,
-        batches_input: List[Tensor],
+        batches_input: Iterable[Tensor],
         linear_modules_to_merge: Dict[str, nn.Module],
     ):
         raise NotImplementedError
@@ -0,0 +1,152 @@
+"""
+Run the same layer of several models with a single batched forward pass.
+"""
+
+import copy
+import logging
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from torch import Tensor, nn
+from torch.func import functional_call, stack_module_state, vmap
+
+log = logging.getLogger(__name__)
+
+__all__ = ["StackedLayers", "group_batches_by_shape"]
+
+
+def group_batches_by_shape(
+    batches: Sequence[Optional[Tensor]], dim: int = 0
+) -> List[Tuple[List[int], List[Tensor]]]:
+    """
+    Group the batches with the same shape, starting from dimension `dim`. `None` entries are skipped.
+
+    Returns:
+        List[Tuple[List[int], List[Tensor]]]: (indices of the batches, batches) for each group.
+    """
+    groups: Dict[Tuple, Tuple[List[int], List[Tensor]]] = {}
+    for idx, batch in enumerate(batches):
+        if batch is None:
+            continue
+        key = (tuple(batch.shape[dim:]), batch.dtype)
+        if key not in groups:
+            groups[key] = ([], [])
+        groups[key][0].append(idx)
+        groups[key][1].append(batch)
+    return list(groups.values())
+
+
+class _LayerForward(nn.Module):
+    def __init__(
+        self, layer: nn.Module, forward_fn: Callable[[nn.Module, Tensor], Tensor]
+    ):
+        super().__init__()
+        self.layer = layer
+        self.forward_fn = forward_fn
+
+    def forward(self, hidden_states: Tensor) -> Tensor:
+        return self.forward_fn(self.layer, hidden_states)
+
+
+class StackedLayers:
+    """
+    Stack the parameters of the same layer of several models with `torch.func.stack_module_state`
+    and run all of them with a single `vmap`-ed `functional_call`.
+
+    The inputs of the modules listed in `capture_module_names` are returned along with the
+    outputs, so that statistics can be collected without forward hooks on the original layers.
+    Modules that receive the very same input tensor (e.g. q/k/v projections) share a single
+    returned tensor.
+
+    Examples:
+        >>> stacked_layers = StackedLayers(layers, layer_forward, ["mlp.fc1", "mlp.fc2"])
+        >>> outputs, module_inputs = stacked_layers(hidden_states)  # hidden_states: (num_models, batch_size, ...)
+        >>> module_inputs["mlp.fc1"].shape  # (num_models, batch_size, ..., hidden_dim)
+
+    Args:
+        layers (List[nn.Module]): The layers, one per model, with the same architecture.
+        layer_forward (Callable[[nn.Module, Tensor], Tensor]): Computes the output hidden states of a layer.
+        capture_module_names (Sequence[str]): Names of the submodules whose inputs are returned.
+    """
+
+    def __init__(
+        self,
+        layers: List[nn.Module],
+        layer_forward: Callable[[nn.Module, Tensor], Tensor],
+        capture_module_names: Sequence[str] = (),
+    ):
+        self.num_models = len(layers)
+        params, buffers = stack_module_state(layers)
+        self.params = {f"layer.{name}": value for name, value in params.items()}
+        self.buffers = {f"layer.{name}": value for name, value in buffers.items()}
+        self.device = next(iter(params.values())).device
+        self.base_module = _LayerForward(
+            copy.deepcopy(layers[0]).to("meta"), layer_forward
+        )
+
+        # captured inputs of the current forward pass
+        self._captured: Dict[str, Tensor] = {}
+        # module name -> name of the module with the same input
+        self.shared_inputs: Dict[str, str] = {}
+        # names of the captured modules in the order they are called
+        self.call_order: List[str] = []
+        self.capture_module_names = list(capture_module_names)
+        modules = dict(self.base_module.layer.named_modules())
+        for module_name in self.capture_module_names:
+            modules[module_name].register_forward_hook(self._capture_hook(module_name))
+
+    def _capture_hook(self, module_name: str):
+        def hook(module: nn.Module, input: tuple, output: Tensor):
+            x = input[0]
+            if module_name not in self.call_order:
+                self.call_order.append(module_name)
+            for other_name, other_x in self._captured.items():
+                if other_x is x:
+                    self.shared_inputs[module_name] = other_name
+                    return
+            self._captured[module_name] = x
+
+        return hook
+
+    def _forward(
+        self, params: Dict[str, Tensor], buffers: Dict[str, Tensor], x: Tensor
+    ) -> Tuple[Tensor, Dict[str, Tensor]]:
+        self._captured = {}
+        output = functional_call(self.base_module, (params, buffers), (x,))
+        captured, self._captured = self._captured, {}
+        return output, captured
+
+    def __call__(
+        self, hidden_states: Tensor, model_indices: Optional[List[int]] = None
+    ) -> Tuple[Tensor, Dict[str, Tensor]]:
+        """
+        Forward the stacked hidden states through the layers.
+
+        Args:
+            hidden_states (Tensor): Tensor of shape (num_models, batch_size, ...), or
+                (len(model_indices), batch_size, ...) if `model_indices` is given.
+            model_indices (Optional[List[int]]): Run only the layers of these models. Defaults to all models.
+
+        Returns:
+            Tuple[Tensor, Dict[str, Tensor]]: The outputs of the layers and the inputs of the captured modules,
+                stacked along the first dimension.
+        """
+        hidden_states = hidden_states.to(self.device)
+        if model_indices is None:
+            return vmap(self._forward)(self.params, self.buffers, hidden_states)
+
+        params = {name: value[model_indices] for name, value in self.params.items()}
+        buffers = {name: value[model_indices] for name, value in self.buffers.items()}
+        return vmap(self._forward)(params, buffers, hidden_states)
+
+    def module_inputs(
+        self, captured: Dict[str, Tensor], model_idx: int
+    ) -> List[Tuple[str, Tensor]]:
+        """
+        Get the inputs of the captured modules for one model, in the order they were called.
+        Modules with a shared input get the very same tensor object.
+        """
+        inputs = {name: x[model_idx] for name, x in captured.items()}
+        return [
+            (name, inputs[self.shared_inputs.get(name, name)])
+            for name in self.call_order
+        ]
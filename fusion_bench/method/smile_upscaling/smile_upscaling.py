@@ -1,11 +1,11 @@
 import logging
 import os
 from copy import deepcopy
-from typing import Dict, List, Tuple  # noqa: F401
+from typing import Dict, List, Optional, Tuple  # noqa: F401
 
 import torch
 import torch.nn.functional as F
-from omegaconf import OmegaConf
+from omegaconf import DictConfig, OmegaConf
 from torch import Tensor, nn
 from tqdm.auto import tqdm
 
@@ -21,6 +21,7 @@ from fusion_bench.models.smile_moe.linear_from_module import (
 )
 from fusion_bench.models.utils import get_attr, set_attr
 from fusion_bench.utils.parameters import print_parameters
+from fusion_bench.utils.svd_scheduler import SVDScheduler
 
 log = logging.getLogger(__name__)
 
@@ -40,6 +41,7 @@ class SmileUpscalingAlgorithm(
         "routing_use_diff": "routing_use_diff",
         "average_experts": "average_experts",
         "model_path": "model_path",
+        "svd_scheduler": "svd_scheduler",
     }
 
     def __init__(
@@ -54,6 +56,7 @@ class SmileUpscalingAlgorithm(
         routing_use_diff: bool = True,
         average_experts: bool = False,
         model_path: str = None,
+        svd_scheduler: Optional[DictConfig] = None,
         **kwargs,
     ):
         """
@@ -69,6 +72,7 @@ class SmileUpscalingAlgorithm(
             routing_use_diff (bool): Whether to use weight differences for routing.
             average_experts (bool): Whether to average the experts.
             model_path (str): The path to save/load the model.
+            svd_scheduler (Optional[DictConfig]): The arguments of the `SVDScheduler` that runs the SVDs of the experts of a linear layer.
             **kwargs: Additional arguments.
         """
         super().__init__()
@@ -81,6 +85,7 @@ class SmileUpscalingAlgorithm(
         self.routing_use_diff = routing_use_diff
         self.average_experts = average_experts
         self.model_path = model_path
+        self.svd_scheduler = svd_scheduler
         for key, value in kwargs.items():
             log.warning(f"Unrecognized argument: {key}")
             setattr(self, key, value)
@@ -191,6 +196,7 @@ class SmileUpscalingAlgorithm(
                 routing_use_diff=self.routing_use_diff,
                 full_matrices=self.full_matrices,
                 upscaling_accelerator=self.upscaling_accelerator,
+                svd_scheduler=SVDScheduler(**(self.svd_scheduler or {})),
             )
         except ExpertNotTrainedError:
             print(f"skip {name} because the experts are not trained.")
@@ -0,0 +1,3 @@
+# flake8: noqa F401
+from .executor import StreamingMergeExecutor
+from .streaming_merge import StreamingMergeAlgorithm
@@ -0,0 +1,180 @@
+"""
+Out-of-core merging of checkpoints, one tensor at a time.
+"""
+
+import json
+import logging
+import os
+from typing import Callable, Dict, Iterable, List, Mapping, Optional, Tuple, Union
+
+import torch
+from accelerate.utils.constants import SAFE_WEIGHTS_INDEX_NAME, SAFE_WEIGHTS_NAME
+from safetensors.torch import save_file
+from torch import Tensor
+
+from fusion_bench.utils.dtype import parse_dtype
+
+log = logging.getLogger(__name__)
+
+__all__ = ["StreamingMergeExecutor"]
+
+_SIZE_UNITS = {"KB": 2**10, "MB": 2**20, "GB": 2**30, "TB": 2**40}
+
+
+def _parse_size(size: Union[int, str]) -> int:
+    """
+    Parse a size in bytes, given as an integer or a string such as "500MB" or "2GB".
+    """
+    if isinstance(size, int):
+        return size
+    size = size.strip().upper()
+    for unit, factor in _SIZE_UNITS.items():
+        if size.endswith(unit):
+            return int(float(size[: -len(unit)]) * factor)
+    return int(size)
+
+
+class StreamingMergeExecutor:
+    """
+    Merge checkpoints tensor by tensor and write the result to safetensors shards.
+
+    The executor walks the keys of the checkpoints, reads the tensor of the current key from every
+    checkpoint (e.g. from a `LazyStateDict`, which reads a single tensor with `safe_open`), merges
+    them and appends the result to the current output shard, which is written as soon as it reaches
+    `max_shard_size`. The peak memory is thus O(largest tensor * num_models + max_shard_size)
+    instead of O(model size * num_models).
+
+    The output directory has the layout of `save_pretrained`: a single `model.safetensors` file, or
+    `model-XXXXX-of-XXXXX.safetensors` shards and a `model.safetensors.index.json` weight map.
+
+    Examples:
+        >>> executor = StreamingMergeExecutor("outputs/merged", max_shard_size="2GB")
+        >>> executor.merge(
+        ...     {name: LazyStateDict(path) for name, path in checkpoints.items()},
+        ...     lambda key, tensors: sum(tensors.values()) / len(tensors),
+        ... )
+
+    Args:
+        output_path (str): The directory to write the merged checkpoint to.
+        max_shard_size (Union[int, str]): The maximum size of an output shard, in bytes or as a string such as "2GB".
+        torch_dtype (Optional[Union[str, torch.dtype]]): Cast the merged tensors to this dtype before writing them.
+    """
+
+    def __init__(
+        self,
+        output_path: str,
+        max_shard_size: Union[int, str] = "1GB",
+        torch_dtype: Optional[Union[str, torch.dtype]] = None,
+    ):
+        self.output_path = output_path
+        self.max_shard_size = _parse_size(max_shard_size)
+        self.torch_dtype = parse_dtype(torch_dtype)
+
+    @torch.no_grad()
+    def merge(
+        self,
+        state_dicts: Mapping[str, Mapping[str, Tensor]],
+        merge_fn: Callable[[str, Dict[str, Tensor]], Tensor],
+        keys: Optional[List[str]] = None,
+    ) -> Dict[str, str]:
+        """
+        Merge the state dicts with an element-wise merge function.
+
+        Args:
+            state_dicts (Mapping[str, Mapping[str, Tensor]]): The (lazy) state dicts to merge, by model name.
+            merge_fn (Callable[[str, Dict[str, Tensor]], Tensor]): Called with a key and the tensors of all
+                the state dicts for this key, by model name, and returns the merged tensor.
+            keys (Optional[List[str]]): The keys to merge, in order. Defaults to the keys of the first state dict.
+
+        Returns:
+            Dict[str, str]: The weight map, from the keys to the files they are written to.
+        """
+        if keys is None:
+            keys = list(next(iter(state_dicts.values())).keys())
+
+        def merged_tensors():
+            for key in keys:
+                tensors = {name: state_dict[key] for name, state_dict in state_dicts.items()}
+                merged_tensor = merge_fn(key, tensors)
+                del tensors
+                yield key, merged_tensor
+
+        return self.write(merged_tensors())
+
+    @torch.no_grad()
+    def write(self, named_tensors: Iterable[Tuple[str, Tensor]]) -> Dict[str, str]:
+        """
+        Write the tensors to safetensors shards, consuming them one by one.
+
+        Args:
+            named_tensors (Iterable[Tuple[str, Tensor]]): The keys and the tensors to write.
+
+        Returns:
+            Dict[str, str]: The weight map, from the keys to the files they are written to.
+        """
+        os.makedirs(self.output_path, exist_ok=True)
+        shard_keys: List[List[str]] = []
+        shard: Dict[str, Tensor] = {}
+        shard_size = 0
+        total_size = 0
+
+        def flush():
+            shard_keys.append(list(shard.keys()))
+            save_file(
+                shard,
+                os.path.join(self.output_path, self._shard_name(len(shard_keys))),
+                metadata={"format": "pt"},
+            )
+            shard.clear()
+
+        for key, tensor in named_tensors:
+            tensor = tensor.detach().to("cpu")
+            if self.torch_dtype is not None and tensor.is_floating_point():
+                tensor = tensor.to(self.torch_dtype)
+            # safetensors does not accept views that share their storage with other tensors
+            if (
+                not tensor.is_contiguous()
+                or tensor.untyped_storage().nbytes() != tensor.nbytes
+            ):
+                tensor = tensor.contiguous().clone()
+            if len(shard) > 0 and shard_size + tensor.nbytes > self.max_shard_size:
+                flush()
+                shard_size = 0
+            shard[key] = tensor
+            shard_size += tensor.nbytes
+            total_size += tensor.nbytes
+        if len(shard) > 0 or len(shard_keys) == 0:
+            flush()
+
+        # name the shards as `save_pretrained` does, now that their number is known
+        num_shards = len(shard_keys)
+        weight_map: Dict[str, str] = {}
+        for shard_idx, keys in enumerate(shard_keys, start=1):
+            if num_shards == 1:
+                filename = SAFE_WEIGHTS_NAME
+            else:
+                filename = SAFE_WEIGHTS_NAME.replace(
+                    ".safetensors", f"-{shard_idx:05d}-of-{num_shards:05d}.safetensors"
+                )
+            os.replace(
+                os.path.join(self.output_path, self._shard_name(shard_idx)),
+                os.path.join(self.output_path, filename),
+            )
+            weight_map.update({key: filename for key in keys})
+
+        if num_shards > 1:
+            with open(os.path.join(self.output_path, SAFE_WEIGHTS_INDEX_NAME), "w") as f:
+                json.dump(
+                    {"metadata": {"total_size": total_size}, "weight_map": weight_map},
+                    f,
+                    indent=2,
+                )
+        log.info(
+            f"wrote {len(weight_map)} tensors ({total_size / 2**30:.2f} GiB) "
+            f"in {num_shards} shard(s) to {self.output_path}"
+        )
+        return weight_map
+
+    @staticmethod
+    def _shard_name(shard_idx: int) -> str:
+        return f".streaming-merge-{shard_idx:05d}.safetensors.tmp"
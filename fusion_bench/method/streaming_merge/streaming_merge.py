@@ -0,0 +1,216 @@
+import logging
+from typing import Dict, List, Literal, Mapping, Optional, Union  # noqa: F401
+
+import torch
+from torch import Tensor, nn
+
+from fusion_bench.method.base_algorithm import BaseAlgorithm
+from fusion_bench.method.ties_merging.ties_merging_utils import (
+    iter_ties_merging_streaming,
+)
+from fusion_bench.mixins.simple_profiler import SimpleProfilerMixin
+from fusion_bench.modelpool import BaseModelPool
+from fusion_bench.utils.lazy_state_dict import LazyStateDict
+
+from .executor import StreamingMergeExecutor
+
+log = logging.getLogger(__name__)
+
+
+class StreamingMergeAlgorithm(
+    BaseAlgorithm,
+    SimpleProfilerMixin,
+):
+    """
+    Merge the checkpoints of a model pool without loading whole models, and write the merged
+    checkpoint to `output_path` with a `StreamingMergeExecutor`.
+
+    It is meant for a `LazyStateDictPool`, whose models are `LazyStateDict`s reading one tensor at a
+    time from the checkpoint files, so that the peak memory is about the size of the largest tensor
+    times the number of models. Pools of `nn.Module`s are also accepted.
+
+    Supported merge methods:
+
+    - "simple_average": the average of the fine-tuned models.
+    - "task_arithmetic": pretrained + scaling_factor * sum_i (finetuned_i - pretrained).
+    - "ties_merging": TIES merging with exact per-model top-k thresholds, computed with a few more
+      passes over the checkpoints, see `iter_ties_merging_streaming`.
+
+    Tensors that are not floating-point (e.g. integer buffers) are copied from the pretrained model
+    (or the first model).
+    """
+
+    _config_mapping = BaseAlgorithm._config_mapping | {
+        "merge_method": "merge_method",
+        "output_path": "output_path",
+        "scaling_factor": "scaling_factor",
+        "threshold": "threshold",
+        "merge_func": "merge_func",
+        "remove_keys": "remove_keys",
+        "max_shard_size": "max_shard_size",
+        "torch_dtype": "torch_dtype",
+        "chunk_size": "chunk_size",
+    }
+
+    def __init__(
+        self,
+        merge_method: Literal["simple_average", "task_arithmetic", "ties_merging"],
+        output_path: str,
+        scaling_factor: float = 0.3,
+        threshold: float = 20,
+        merge_func: Literal["sum", "mean", "max"] = "sum",
+        remove_keys: Optional[List[str]] = None,
+        max_shard_size: Union[int, str] = "1GB",
+        torch_dtype: Optional[str] = None,
+        chunk_size: int = 2**24,
+        **kwargs,
+    ):
+        """
+        Args:
+            merge_method (str): The merge method, one of "simple_average", "task_arithmetic" and "ties_merging".
+            output_path (str): The directory to write the merged checkpoint to.
+            scaling_factor (float): The scaling factor of the task vectors, for "task_arithmetic" and "ties_merging".
+            threshold (float): The proportion (or percentage if > 1) of values to keep, for "ties_merging".
+            merge_func (str): The disjoint merge function of "ties_merging".
+            remove_keys (Optional[List[str]]): The keys that are not merged by "ties_merging" and copied from the pretrained model.
+            max_shard_size (Union[int, str]): The maximum size of an output shard, in bytes or as a string such as "2GB".
+            torch_dtype (Optional[str]): The dtype of the merged checkpoint. Defaults to the dtype of the merged tensors.
+            chunk_size (int): The maximum number of elements (over all the models) processed at once by "ties_merging".
+        """
+        if merge_method not in ("simple_average", "task_arithmetic", "ties_merging"):
+            raise ValueError(f"Unknown merge method: {merge_method}")
+        self.merge_method = merge_method
+        self.output_path = output_path
+        self.scaling_factor = scaling_factor
+        self.threshold = threshold
+        self.merge_func = merge_func
+        self.remove_keys = remove_keys
+        self.max_shard_size = max_shard_size
+        self.torch_dtype = torch_dtype
+        self.chunk_size = chunk_size
+        super().__init__(**kwargs)
+
+    @staticmethod
+    def _load_state_dict(
+        modelpool: BaseModelPool, model_name: str
+    ) -> Mapping[str, Tensor]:
+        model = modelpool.load_model(model_name)
+        if isinstance(model, nn.Module):
+            return model.state_dict(keep_vars=True)
+        return model
+
+    @torch.no_grad()
+    def run(self, modelpool: Union[BaseModelPool, Dict[str, nn.Module]]):
+        """
+        Merge the models of the pool and write the merged checkpoint to `output_path`.
+
+        Returns:
+            LazyStateDict: The merged checkpoint, read lazily from `output_path`.
+        """
+        if not isinstance(modelpool, BaseModelPool):
+            modelpool = BaseModelPool(modelpool)
+
+        pretrained_state_dict = (
+            self._load_state_dict(modelpool, "_pretrained_")
+            if modelpool.has_pretrained
+            else None
+        )
+        finetuned_state_dicts = {
+            model_name: self._load_state_dict(modelpool, model_name)
+            for model_name in modelpool.model_names
+        }
+        if self.merge_method != "simple_average" and pretrained_state_dict is None:
+            raise ValueError(f"{self.merge_method} requires a pretrained model")
+        base_state_dict = (
+            pretrained_state_dict
+            if pretrained_state_dict is not None
+            else next(iter(finetuned_state_dicts.values()))
+        )
+
+        executor = StreamingMergeExecutor(
+            self.output_path,
+            max_shard_size=self.max_shard_size,
+            torch_dtype=self.torch_dtype,
+        )
+        log.info(
+            f"Streaming {self.merge_method} of {len(finetuned_state_dicts)} models to {self.output_path}"
+        )
+        with self.profile("merge weights"):
+            if self.merge_method == "ties_merging":
+                executor.write(
+                    self._iter_ties_merging(
+                        pretrained_state_dict, list(finetuned_state_dicts.values())
+                    )
+                )
+            else:
+                state_dicts = dict(finetuned_state_dicts)
+                if pretrained_state_dict is not None:
+                    state_dicts["_pretrained_"] = pretrained_state_dict
+                executor.merge(
+                    state_dicts,
+                    (
+                        self._simple_average
+                        if self.merge_method == "simple_average"
+                        else self._task_arithmetic
+                    ),
+                    keys=list(base_state_dict.keys()),
+                )
+
+        if isinstance(base_state_dict, LazyStateDict):
+            try:
+                base_state_dict.config.save_pretrained(self.output_path)
+            except Exception as e:
+                log.warning(f"Could not save the model config: {e}")
+        self.print_profile_summary()
+        return LazyStateDict(self.output_path)
+
+    def _simple_average(self, key: str, tensors: Dict[str, Tensor]) -> Tensor:
+        finetuned = [tensor for name, tensor in tensors.items() if name != "_pretrained_"]
+        if not finetuned[0].is_floating_point():
+            return tensors.get("_pretrained_", finetuned[0])
+        merged = torch.zeros_like(finetuned[0])
+        for tensor in finetuned:
+            merged += tensor
+        return merged.div_(len(finetuned))
+
+    def _task_arithmetic(self, key: str, tensors: Dict[str, Tensor]) -> Tensor:
+        pretrained = tensors["_pretrained_"]
+        if not pretrained.is_floating_point():
+            return pretrained
+        task_vector = None
+        for name, tensor in tensors.items():
+            if name == "_pretrained_":
+                continue
+            if task_vector is None:
+                task_vector = tensor - pretrained
+            else:
+                task_vector += tensor - pretrained
+        return pretrained + self.scaling_factor * task_vector
+
+    def _iter_ties_merging(
+        self,
+        pretrained_state_dict: Mapping[str, Tensor],
+        finetuned_state_dicts: List[Mapping[str, Tensor]],
+    ):
+        remove_keys = list(self.remove_keys or [])
+        # the integer tensors are not merged
+        remove_keys += [
+            key
+            for key in pretrained_state_dict.keys()
+            if key not in remove_keys
+            and not pretrained_state_dict[key].is_floating_point()
+        ]
+        for key, merged_tv in iter_ties_merging_streaming(
+            finetuned_state_dicts,
+            self.threshold,
+            merge_func=self.merge_func,
+            pretrained_checkpoint=pretrained_state_dict,
+            remove_keys=remove_keys,
+            chunk_size=self.chunk_size,
+        ):
+            pretrained = pretrained_state_dict[key]
+            yield key, (pretrained + self.scaling_factor * merged_tv).to(
+                pretrained.dtype
+            )
+        for key in remove_keys:
+            yield key, pretrained_state_dict[key]
@@ -14,12 +14,8 @@ from torch import nn
 from fusion_bench.method.base_algorithm import BaseAlgorithm
 from fusion_bench.mixins.simple_profiler import SimpleProfilerMixin
 from fusion_bench.modelpool import BaseModelPool
-from fusion_bench.utils.state_dict_arithmetic import (
-    state_dict_add,
-    state_dict_mul,
-    state_dict_sub,
-)
-from fusion_bench.utils.type import StateDictType, TorchModelType
+from fusion_bench.utils.state_dict_arithmetic import FlatStateDict
+from fusion_bench.utils.type import TorchModelType
 
 log = logging.getLogger(__name__)
 
@@ -46,31 +42,24 @@ def task_arithmetic_merge(
     """
     if not inplace:
         pretrained_model = deepcopy(pretrained_model)
-    task_vector: Optional[StateDictType] = None
+    pretrained_state_dict = FlatStateDict.from_state_dict(
+        pretrained_model.state_dict(keep_vars=True)
+    )
+    task_vector: Optional[FlatStateDict] = None
+    # the task vector of each model is computed in the same buffer
+    model_task_vector = FlatStateDict.empty_like(pretrained_state_dict)
     # Calculate the total task vector
     for model in finetuned_models:
+        model_task_vector.copy_(model.state_dict(keep_vars=True)).sub_(
+            pretrained_state_dict
+        )
         if task_vector is None:
-            # calculate the task vector for the first model
-            task_vector = state_dict_sub(
-                model.state_dict(keep_vars=True),
-                pretrained_model.state_dict(keep_vars=True),
-            )
+            task_vector = model_task_vector.clone()
         else:
-            # calculate the task vector for the remaining models
-            task_vector = state_dict_add(
-                task_vector,
-                state_dict_sub(
-                    model.state_dict(keep_vars=True),
-                    pretrained_model.state_dict(keep_vars=True),
-                ),
-            )
-    # scale the task vector
-    task_vector = state_dict_mul(task_vector, scaling_factor)
-    # add the task vector to the pretrained model
-    state_dict = state_dict_add(
-        pretrained_model.state_dict(keep_vars=True), task_vector
-    )
-    pretrained_model.load_state_dict(state_dict)
+            task_vector.add_(model_task_vector)
+    # scale the task vector and add it to the pretrained model
+    state_dict = task_vector.mul_(scaling_factor).add_(pretrained_state_dict)
+    pretrained_model.load_state_dict(state_dict.to_state_dict())
     return pretrained_model
 
 
@@ -118,34 +107,31 @@ class TaskArithmeticAlgorithm(
             modelpool = BaseModelPool(modelpool)
 
         log.info("Fusing models using task arithmetic.")
-        task_vector = None
+        task_vector: Optional[FlatStateDict] = None
         with self.profile("load model"):
             pretrained_model = modelpool.load_model("_pretrained_")
+        pretrained_state_dict = FlatStateDict.from_state_dict(
+            pretrained_model.state_dict(keep_vars=True)
+        )
+        # the task vector of each model is computed in the same buffer
+        model_task_vector = FlatStateDict.empty_like(pretrained_state_dict)
 
         # Calculate the total task vector
         for model_name in modelpool.model_names:
             with self.profile("load model"):
                 model = modelpool.load_model(model_name)
             with self.profile("merge weights"):
+                model_task_vector.copy_(model.state_dict(keep_vars=True)).sub_(
+                    pretrained_state_dict
+                )
                 if task_vector is None:
-                    task_vector = state_dict_sub(
-                        model.state_dict(keep_vars=True),
-                        pretrained_model.state_dict(keep_vars=True),
-                    )
+                    task_vector = model_task_vector.clone()
                 else:
-                    task_vector = state_dict_add(
-                        task_vector,
-                        state_dict_sub(
-                            model.state_dict(keep_vars=True),
-                            pretrained_model.state_dict(keep_vars=True),
-                        ),
-                    )
+                    task_vector.add_(model_task_vector)
         with self.profile("merge weights"):
-            # scale the task vector
-            task_vector = state_dict_mul(task_vector, self.config.scaling_factor)
-            # add the task vector to the pretrained model
-            state_dict = state_dict_add(
-                pretrained_model.state_dict(keep_vars=True), task_vector
+            # scale the task vector and add it to the pretrained model
+            state_dict = task_vector.mul_(self.config.scaling_factor).add_(
+                pretrained_state_dict
             )
 
 
@@ -213,5 +199,5 @@ class TaskArithmeticAlgorithm(
 
 
         self.print_profile_summary()
-        pretrained_model.load_state_dict(state_dict)
+        pretrained_model.load_state_dict(dict(state_dict))
         return pretrained_model
@@ -45,13 +45,13 @@ from copy import deepcopy
 from typing import Iterable, List, Optional, Union
 
 import torch
-from omegaconf import ListConfig
+from omegaconf import DictConfig, ListConfig
 from torch import Tensor, nn
 
 import fusion_bench as fb
 from fusion_bench import BaseAlgorithm
 from fusion_bench.mixins import LightningFabricMixin
-from fusion_bench.utils import timeit_context
+from fusion_bench.utils import SVDScheduler, timeit_context
 from fusion_bench.utils.state_dict_arithmetic import (
     state_dict_add,
     state_dict_mul,
@@ -100,6 +100,10 @@ class TaskSingularVectorMerging(BaseAlgorithm, LightningFabricMixin):
         alpha: Optional[Union[float, Iterable[float]]] = None,
         exclude_keys: Optional[List[str]] = None,
         return_single_task_models: bool = False,
+        svd_backend: TSVM_utils.SVDBackend = "full",
+        svd_oversampling: Optional[int] = None,
+        svd_niter: int = 4,
+        svd_scheduler: Optional[DictConfig] = None,
         **kwargs,
     ):
         """
@@ -139,6 +143,23 @@ class TaskSingularVectorMerging(BaseAlgorithm, LightningFabricMixin):
                 This is useful for analysis or when you need access to intermediate results.
                 Defaults to False.
 
+            svd_backend (str, optional): How the top `1 / num_tasks` singular vectors of each task vector are computed.
+
+                - "full": Full `torch.linalg.svd`, truncated afterwards (exact).
+                - "lowrank": `torch.svd_lowrank`, which computes only the needed rank.
+                - "randomized": Randomized range finder with re-orthonormalized power iterations.
+
+                The approximate backends are much faster for many tasks, where the kept rank is small.
+                Defaults to "full".
+
+            svd_oversampling (int, optional): Number of additional random directions used by the
+                approximate SVD backends. Defaults to the kept rank.
+
+            svd_niter (int, optional): Number of power iterations of the approximate SVD backends. Defaults to 4.
+
+            svd_scheduler (DictConfig, optional): Arguments of the `SVDScheduler` that runs the SVDs of each
+                layer, e.g. `{"mode": "threads", "num_workers": 8}`. Defaults to sequential SVDs.
+
             **kwargs: Additional arguments passed to the parent BaseAlgorithm class.
 
         Note:
@@ -149,6 +170,10 @@ class TaskSingularVectorMerging(BaseAlgorithm, LightningFabricMixin):
         self.alpha = alpha
         self.exclude_keys = exclude_keys if exclude_keys is not None else []
         self.return_single_task_models = return_single_task_models
+        self.svd_backend = svd_backend
+        self.svd_oversampling = svd_oversampling
+        self.svd_niter = svd_niter
+        self.svd_scheduler = svd_scheduler
         super().__init__(**kwargs)
 
     def load_pretrained_model_and_task_vectors(self, modelpool: fb.BaseModelPool):
@@ -254,6 +279,10 @@ class TaskSingularVectorMerging(BaseAlgorithm, LightningFabricMixin):
             exclude_keys=self.exclude_keys,  # Skip certain parameters from SVD
             accelerator=accelerator,  # Use GPU if available
             return_single_task_models=self.return_single_task_models,
+            svd_backend=self.svd_backend,
+            svd_oversampling=self.svd_oversampling,
+            svd_niter=self.svd_niter,
+            svd_scheduler=SVDScheduler(**(self.svd_scheduler or {})),
         )
 
         # Handle the case where individual transformed task vectors are also returned
@@ -1,12 +1,97 @@
 import collections
+import functools
 import math
-from typing import Dict, List, Optional
+from typing import Dict, List, Literal, Optional, Tuple
 
 import torch
 from torch import Tensor, nn
 
+from fusion_bench.utils.svd_scheduler import SVDScheduler
 from fusion_bench.utils.type import StateDictType
 
+SVDBackend = Literal["full", "lowrank", "randomized"]
+
+
+def randomized_svd(
+    matrix: Tensor,
+    rank: int,
+    oversampling: int = 10,
+    niter: int = 2,
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Compute the top-`rank` singular triplets of `matrix` with a randomized range finder
+    (Halko et al., 2011), re-orthonormalizing between the power iterations.
+
+    Args:
+        matrix (Tensor): The matrix of shape (..., m, n) to decompose.
+        rank (int): The number of singular triplets to return.
+        oversampling (int): The number of additional random directions used to capture the range.
+        niter (int): The number of power iterations.
+
+    Returns:
+        Tuple[Tensor, Tensor, Tensor]: `u` of shape (..., m, rank), `s` of shape (..., rank) and `vh` of shape (..., rank, n).
+    """
+    transpose = matrix.shape[-2] < matrix.shape[-1]
+    if transpose:
+        matrix = matrix.mT
+    num_samples = min(rank + oversampling, matrix.shape[-1])
+
+    omega = torch.randn(
+        *matrix.shape[:-2],
+        matrix.shape[-1],
+        num_samples,
+        dtype=matrix.dtype,
+        device=matrix.device,
+    )
+    q = torch.linalg.qr(matrix @ omega).Q
+    for _ in range(niter):
+        q = torch.linalg.qr(matrix.mT @ q).Q
+        q = torch.linalg.qr(matrix @ q).Q
+    u, s, vh = torch.linalg.svd(q.mT @ matrix, full_matrices=False)
+    u = q @ u
+
+    u, s, vh = u[..., :rank], s[..., :rank], vh[..., :rank, :]
+    if transpose:
+        u, vh = vh.mT, u.mT
+    return u, s, vh
+
+
+def truncated_svd(
+    matrix: Tensor,
+    rank: int,
+    svd_backend: SVDBackend = "full",
+    oversampling: Optional[int] = None,
+    niter: int = 4,
+) -> Tuple[Tensor, Tensor, Tensor]:
+    """
+    Compute the top-`rank` singular triplets of `matrix`.
+
+    Args:
+        matrix (Tensor): The matrix of shape (..., m, n) to decompose.
+        rank (int): The number of singular triplets to return.
+        svd_backend (SVDBackend): "full" computes the full `torch.linalg.svd` and truncates it,
+            "lowrank" uses `torch.svd_lowrank` and "randomized" uses `randomized_svd`.
+            The approximate backends fall back to "full" when `rank + oversampling` is not smaller than `min(m, n)`.
+        oversampling (Optional[int]): The oversampling of the approximate backends. Defaults to `rank`, the
+            orthogonalization in TSVM is sensitive to the accuracy of the trailing singular vectors.
+        niter (int): The number of power iterations of the approximate backends.
+
+    Returns:
+        Tuple[Tensor, Tensor, Tensor]: `u` of shape (..., m, rank), `s` of shape (..., rank) and `vh` of shape (..., rank, n).
+    """
+    if oversampling is None:
+        oversampling = rank
+    if svd_backend == "full" or rank + oversampling >= min(matrix.shape[-2:]):
+        u, s, vh = torch.linalg.svd(matrix, full_matrices=False)
+        return u[..., :rank], s[..., :rank], vh[..., :rank, :]
+    elif svd_backend == "lowrank":
+        u, s, v = torch.svd_lowrank(matrix, q=rank + oversampling, niter=niter)
+        return u[..., :rank], s[..., :rank], v[..., :rank].mT
+    elif svd_backend == "randomized":
+        return randomized_svd(matrix, rank, oversampling=oversampling, niter=niter)
+    else:
+        raise ValueError(f"Unknown SVD backend: {svd_backend}")
+
 
 def compute_svd_dict(task_vectors, config):
     """
@@ -317,6 +402,10 @@ def compute_and_sum_svd_mem_reduction(
     exclude_keys: Optional[List[str]] = None,
     accelerator: torch.device = "cuda" if torch.cuda.is_available() else "cpu",
     return_single_task_models: bool = False,
+    svd_backend: SVDBackend = "full",
+    svd_oversampling: Optional[int] = None,
+    svd_niter: int = 4,
+    svd_scheduler: Optional[SVDScheduler] = None,
 ):
     """
     Computes the Singular Value Decomposition (SVD) for each vector in the task_vectors,
@@ -324,18 +413,29 @@ def compute_and_sum_svd_mem_reduction(
     the low-rank matrices. If the vector is not a 2D tensor or is "text_projection", it computes the mean of the vectors.
     Computation of the SVD is performed also for the second operation.
 
+    Only the top `1 / num_tasks` singular triplets of each task vector are computed (see `truncated_svd`),
+    and they are concatenated into compact (m, r * num_tasks), (r * num_tasks,) and (r * num_tasks, n)
+    matrices instead of being zero-padded to the full size of the SVD.
+
     Args:
         task_vectors (list): A list of task vector objects, where each object contains a
                             dictionary of vectors.
         exclude_keys (list): A list of keys to exclude from the TSVM.
         accelerator (torch.device): The device to use for the computation.
         return_single_task_models (bool): Whether to return the single task models after the TSVM.
+        svd_backend (SVDBackend): The backend used for the SVD of the task vectors, see `truncated_svd`.
+        svd_oversampling (Optional[int]): The oversampling of the approximate SVD backends, defaults to the kept rank.
+        svd_niter (int): The number of power iterations of the approximate SVD backends.
+        svd_scheduler (Optional[SVDScheduler]): Runs the SVDs of the task vectors of each layer, and the two
+            orthogonalization SVDs. Defaults to a sequential scheduler.
 
     Returns:
         dict: A dictionary containing the new vectors after SVD computation and merging.
     """
     if exclude_keys is None:
         exclude_keys = []
+    if svd_scheduler is None:
+        svd_scheduler = SVDScheduler()
     num_tasks = len(task_vectors)
     sv_reduction = 1 / num_tasks
 
@@ -345,55 +445,66 @@ def compute_and_sum_svd_mem_reduction(
     for key in task_vectors[0]:
         original_device = task_vectors[0][key].device
         original_dtype = task_vectors[0][key].dtype
-
-        for i, task_vector in enumerate(task_vectors):
-            vec = task_vector[key].to(device=accelerator, non_blocking=True)
-            if len(task_vector[key].shape) == 2 and key not in exclude_keys:
-                # at current, the SVD is not supported for half precision, so we need to convert to float32
-                if not (
-                    original_dtype == torch.float32 or original_dtype == torch.float64
-                ):
-                    vec = vec.to(dtype=torch.float32)
-
-                # vec = u @ torch.diag(s) @ vh
-                u, s, vh = torch.linalg.svd(vec, full_matrices=False)
-
+        is_2d_matrix = len(task_vectors[0][key].shape) == 2 and key not in exclude_keys
+
+        if is_2d_matrix:
+
+            def task_matrices():
+                for i, task_vector in enumerate(task_vectors):
+                    vec = task_vector[key].to(device=accelerator, non_blocking=True)
+                    # at current, the SVD is not supported for half precision, so we need to convert to float32
+                    if not (
+                        original_dtype == torch.float32
+                        or original_dtype == torch.float64
+                    ):
+                        vec = vec.to(dtype=torch.float32)
+                    yield i, vec
+
+            reduced_index_s = int(min(task_vectors[0][key].shape) * sv_reduction)
+            # vec ~= u @ torch.diag(s) @ vh, with the first reduced_index_s singular triplets only
+            svd_fn = functools.partial(
+                truncated_svd,
+                rank=reduced_index_s,
+                svd_backend=svd_backend,
+                oversampling=svd_oversampling,
+                niter=svd_niter,
+            )
+            for i, (u, s, vh) in svd_scheduler.imap(task_matrices(), svd_fn=svd_fn):
                 if i == 0:
                     print(f"Computed SVD for {key}...")
-                    sum_u = torch.zeros_like(u, device=accelerator)
-                    sum_s = torch.zeros_like(s, device=accelerator)
-                    sum_vh = torch.zeros_like(vh, device=accelerator)
-                reduced_index_s = int(s.shape[0] * sv_reduction)
-
-                # select only the first reduced_index_s columns of u and place them
-                sum_u[:, i * reduced_index_s : (i + 1) * reduced_index_s] = u[
-                    :, :reduced_index_s
-                ]
-                sum_s[i * reduced_index_s : (i + 1) * reduced_index_s] = s[
-                    :reduced_index_s
-                ]
-                # select only the first reduced_index_s rows of v and place them
-                sum_vh[i * reduced_index_s : (i + 1) * reduced_index_s, :] = vh[
-                    :reduced_index_s, :
-                ]
-            else:
+                    sum_u = u.new_empty(u.shape[0], reduced_index_s * num_tasks)
+                    sum_s = s.new_empty(reduced_index_s * num_tasks)
+                    sum_vh = vh.new_empty(reduced_index_s * num_tasks, vh.shape[1])
+
+                # place the columns of u, the singular values and the rows of vh of the i-th task
+                sum_u[:, i * reduced_index_s : (i + 1) * reduced_index_s] = u
+                sum_s[i * reduced_index_s : (i + 1) * reduced_index_s] = s
+                sum_vh[i * reduced_index_s : (i + 1) * reduced_index_s, :] = vh
+        else:
+            for i, task_vector in enumerate(task_vectors):
+                vec = task_vector[key].to(device=accelerator, non_blocking=True)
                 # if the vector is not a 2D tensor or is in exclude_keys, compute the mean
                 if i == 0:
                     new_vector[key] = vec.clone()
                 else:
                     new_vector[key] += (vec - new_vector[key]) / (i + 1)
 
-        if len(task_vector[key].shape) == 2 and key not in exclude_keys:
-            u_u, s_u, vh_u = torch.linalg.svd(sum_u, full_matrices=False)
-            u_vh, s_vh, vh_vh = torch.linalg.svd(sum_vh, full_matrices=False)
+        if is_2d_matrix:
+            if sum_s.numel() > 0:
+                orthogonalized = svd_scheduler.map({"u": sum_u, "vh": sum_vh})
+                u_u, s_u, vh_u = orthogonalized["u"]
+                u_vh, s_vh, vh_vh = orthogonalized["vh"]
+                new_u = u_u @ vh_u
+                new_vh = u_vh @ vh_vh
+            else:
+                # the matrix has fewer singular values than tasks, nothing is kept
+                new_u, new_vh = sum_u, sum_vh
 
             new_vector[key] = torch.linalg.multi_dot(
                 (
-                    u_u,
-                    vh_u,
+                    new_u,
                     torch.diag(sum_s),
-                    u_vh,
-                    vh_vh,
+                    new_vh,
                 )
             )
             new_vector[key] = new_vector[key].to(
@@ -401,8 +512,6 @@ def compute_and_sum_svd_mem_reduction(
             )
             if return_single_task_models:
                 reduced_index_s = int(sum_s.shape[0] * sv_reduction)
-                new_u = u_u @ vh_u
-                new_vh = u_vh @ vh_vh
                 for i in range(num_tasks):
                     single_task_models[i][key] = torch.linalg.multi_dot(
                         (
@@ -434,6 +543,9 @@ def compute_and_sum_svd_mem_reduction(
 def compute_and_sum_svd_mem_reduction_2(
     task_vectors: List[StateDictType],
     accelerator: torch.device = "cuda" if torch.cuda.is_available() else "cpu",
+    svd_backend: SVDBackend = "full",
+    svd_oversampling: Optional[int] = None,
+    svd_niter: int = 4,
 ):
     """
     Computes the Singular Value Decomposition (SVD) for each vector in the task_vectors,
@@ -445,6 +557,9 @@ def compute_and_sum_svd_mem_reduction_2(
         task_vectors (list): A list of task vector objects, where each object contains a
                              dictionary of vectors.
         accelerator (torch.device): The device to use for the computation.
+        svd_backend (SVDBackend): The backend used for the SVD of the task vectors, see `truncated_svd`.
+        svd_oversampling (Optional[int]): The oversampling of the approximate SVD backends, defaults to the kept rank.
+        svd_niter (int): The number of power iterations of the approximate SVD backends.
 
     Returns:
         dict: A dictionary containing the new vectors after SVD computation and merging.
@@ -461,26 +576,26 @@ def compute_and_sum_svd_mem_reduction_2(
                 vec = task_vector[key].to(accelerator)
 
                 if len(task_vector[key].shape) == 2 and "text_projection" not in key:
-                    u, s, v = torch.linalg.svd(vec, full_matrices=False)
+                    reduced_index_s = int(min(vec.shape) * sv_reduction)
+                    u, s, v = truncated_svd(
+                        vec,
+                        reduced_index_s,
+                        svd_backend=svd_backend,
+                        oversampling=svd_oversampling,
+                        niter=svd_niter,
+                    )
 
                     if i == 0:
                         print(f"Computed SVD for {key}...")
-                        sum_u = torch.zeros_like(u, device=accelerator)
-                        sum_s = torch.zeros_like(s, device=accelerator)
-                        sum_v = torch.zeros_like(v, device=accelerator)
-                    reduced_index_s = int(s.shape[0] * sv_reduction)
+                        num_tasks = len(task_vectors)
+                        sum_u = vec.new_empty(vec.shape[0], reduced_index_s * num_tasks)
+                        sum_s = vec.new_empty(reduced_index_s * num_tasks)
+                        sum_v = vec.new_empty(reduced_index_s * num_tasks, vec.shape[1])
 
-                    # select only the first reduced_index_s columns of u and place them
-                    sum_u[:, i * reduced_index_s : (i + 1) * reduced_index_s] = u[
-                        :, :reduced_index_s
-                    ]
-                    sum_s[i * reduced_index_s : (i + 1) * reduced_index_s] = s[
-                        :reduced_index_s
-                    ]
-                    # select only the first reduced_index_s rows of v and place them
-                    sum_v[i * reduced_index_s : (i + 1) * reduced_index_s, :] = v[
-                        :reduced_index_s, :
-                    ]
+                    # place the columns of u, the singular values and the rows of v of the i-th task
+                    sum_u[:, i * reduced_index_s : (i + 1) * reduced_index_s] = u
+                    sum_s[i * reduced_index_s : (i + 1) * reduced_index_s] = s
+                    sum_v[i * reduced_index_s : (i + 1) * reduced_index_s, :] = v
 
                 else:
                     if i == 0:
@@ -527,6 +642,9 @@ def compute_and_sum_svd_mem_reduction_2(
 def compute_and_sum_svd_mem_reduction_rank_reduction(
     task_vectors: List[StateDictType],
     accelerator: torch.device = "cuda" if torch.cuda.is_available() else "cpu",
+    svd_backend: SVDBackend = "full",
+    svd_oversampling: Optional[int] = None,
+    svd_niter: int = 4,
 ):
     """
     Compute and sum the Singular Value Decomposition (SVD) of task vectors with rank reduction.
@@ -538,6 +656,9 @@ def compute_and_sum_svd_mem_reduction_rank_reduction(
         task_vectors (list): A list of task vector objects. Each object should have a `vector` attribute
                              which is a dictionary where keys are vector names and values are tensors.
         accelerator (torch.device): The device to use for the computation.
+        svd_backend (SVDBackend): The backend used for the SVD of the task vectors, see `truncated_svd`.
+        svd_oversampling (Optional[int]): The oversampling of the approximate SVD backends, defaults to the kept rank.
+        svd_niter (int): The number of power iterations of the approximate SVD backends.
 
     Returns:
         dict: A dictionary containing the new vectors after SVD computation and summation.
@@ -553,26 +674,26 @@ def compute_and_sum_svd_mem_reduction_rank_reduction(
                 vec = task_vector[key].to(accelerator)
 
                 if len(task_vector[key].shape) == 2 and "text_projection" not in key:
-                    u, s, v = torch.linalg.svd(vec, full_matrices=False)
+                    reduced_index_s = int(min(vec.shape) * sv_reduction)
+                    u, s, v = truncated_svd(
+                        vec,
+                        reduced_index_s,
+                        svd_backend=svd_backend,
+                        oversampling=svd_oversampling,
+                        niter=svd_niter,
+                    )
 
                     if i == 0:
                         print(f"Computed SVD for {key}...")
-                        sum_u = torch.zeros_like(u, device=accelerator)
-                        sum_s = torch.zeros_like(s, device=accelerator)
-                        sum_v = torch.zeros_like(v, device=accelerator)
-                    reduced_index_s = int(s.shape[0] * sv_reduction)
-
-                    # select only the first reduced_index_s columns of u and place them
-                    sum_u[:, i * reduced_index_s : (i + 1) * reduced_index_s] = u[
-                        :, :reduced_index_s
-                    ]
-                    sum_s[i * reduced_index_s : (i + 1) * reduced_index_s] = s[
-                        :reduced_index_s
-                    ]
-                    # select only the first reduced_index_s rows of v and place them
-                    sum_v[i * reduced_index_s : (i + 1) * reduced_index_s, :] = v[
-                        :reduced_index_s, :
-                    ]
+                        num_tasks = len(task_vectors)
+                        sum_u = vec.new_empty(vec.shape[0], reduced_index_s * num_tasks)
+                        sum_s = vec.new_empty(reduced_index_s * num_tasks)
+                        sum_v = vec.new_empty(reduced_index_s * num_tasks, vec.shape[1])
+
+                    # place the columns of u, the singular values and the rows of v of the i-th task
+                    sum_u[:, i * reduced_index_s : (i + 1) * reduced_index_s] = u
+                    sum_s[i * reduced_index_s : (i + 1) * reduced_index_s] = s
+                    sum_v[i * reduced_index_s : (i + 1) * reduced_index_s, :] = v
 
                 else:
                     if i == 0:
@@ -20,7 +20,13 @@ from fusion_bench.mixins import SimpleProfilerMixin
 from fusion_bench.modelpool import BaseModelPool
 from fusion_bench.utils.type import StateDictType
 
-from .ties_merging_utils import state_dict_to_vector, ties_merging, vector_to_state_dict
+from .ties_merging_utils import (
+    merged_task_vector_to_state_dict,
+    state_dict_to_vector,
+    ties_merging,
+    ties_merging_streaming,
+    vector_to_state_dict,
+)
 
 log = logging.getLogger(__name__)
 
@@ -34,6 +40,9 @@ class TiesMergingAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
         threshold (float): The threshold for resetting values in the task vector.
         remove_keys (List[str]): List of keys to remove from the state dictionary.
         merge_func (Literal["sum", "mean", "max"]): The merge function to use for disjoint merging.
+        streaming (bool): Merge the task vectors tensor by tensor instead of flattening them into a single matrix.
+        threshold_mode (Literal["model", "global"]): Compute the top-k threshold per task vector or over all task vectors.
+        chunk_size (int): The maximum number of elements processed at once in streaming mode.
     """
 
     _config_mapping = BaseAlgorithm._config_mapping | {
@@ -41,6 +50,9 @@ class TiesMergingAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
         "threshold": "threshold",
         "remove_keys": "remove_keys",
         "merge_func": "merge_func",
+        "streaming": "streaming",
+        "threshold_mode": "threshold_mode",
+        "chunk_size": "chunk_size",
     }
 
     def __init__(
@@ -49,6 +61,9 @@ class TiesMergingAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
         threshold: float,
         remove_keys: List[str],
         merge_func: Literal["sum", "mean", "max"],
+        streaming: bool = False,
+        threshold_mode: Literal["model", "global"] = "model",
+        chunk_size: int = 2**24,
         **kwargs,
     ):
         """
@@ -59,12 +74,20 @@ class TiesMergingAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
             threshold (float): The threshold for resetting values in the task vector.
             remove_keys (List[str]): List of keys to remove from the state dictionary.
             merge_func (Literal["sum", "mean", "max"]): The merge function to use for disjoint merging.
+            streaming (bool): Merge the task vectors tensor by tensor with a peak memory bounded by `chunk_size`,
+                instead of flattening them into a (num_models, num_params) matrix. The result is the same.
+            threshold_mode (Literal["model", "global"]): Keep the top-k values of each task vector ("model"),
+                or of all the task vectors together ("global"). "global" always uses the streaming implementation.
+            chunk_size (int): The maximum number of elements (over all the models) processed at once in streaming mode.
             **kwargs: Additional keyword arguments for the base class.
         """
         self.scaling_factor = scaling_factor
         self.threshold = threshold
         self.remove_keys = remove_keys
         self.merge_func = merge_func
+        self.streaming = streaming
+        self.threshold_mode = threshold_mode
+        self.chunk_size = chunk_size
         super().__init__(**kwargs)
 
     @torch.no_grad()
@@ -82,8 +105,6 @@ class TiesMergingAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
         modelpool = to_modelpool(modelpool)
         remove_keys = self.config.get("remove_keys", [])
         merge_func = self.config.get("merge_func", "sum")
-        scaling_factor = self.scaling_factor
-        threshold = self.threshold
 
         with self.profile("loading models"):
             # Load the pretrained model
@@ -97,24 +118,14 @@ class TiesMergingAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
             ptm_check: StateDictType = pretrained_model.state_dict(keep_vars=True)
 
         with self.profile("merging models"):
-            # Compute the task vectors
-            flat_ft: Tensor = torch.vstack(
-                [state_dict_to_vector(check, remove_keys) for check in ft_checks]
-            )
-            flat_ptm: Tensor = state_dict_to_vector(ptm_check, remove_keys)
-            tv_flat_checks = flat_ft - flat_ptm
-
-            # Perform TIES Merging
-            merged_tv = ties_merging(
-                tv_flat_checks,
-                reset_thresh=threshold,
-                merge_func=merge_func,
-            )
-            merged_check = flat_ptm + scaling_factor * merged_tv
-            merged_state_dict = vector_to_state_dict(
-                merged_check, ptm_check, remove_keys=remove_keys
-            )
-
+            if self.streaming or self.threshold_mode != "model":
+                merged_state_dict = self.merge_streaming(
+                    ft_checks, ptm_check, remove_keys, merge_func
+                )
+            else:
+                merged_state_dict = self.merge_flat(
+                    ft_checks, ptm_check, remove_keys, merge_func
+                )
 
 
             ##################### ONLY FOR EXPERIMENTS #####################
@@ -185,3 +196,55 @@ class TiesMergingAlgorithm(BaseAlgorithm, SimpleProfilerMixin):
 
         self.print_profile_summary()
         return pretrained_model
+
+    def merge_flat(
+        self,
+        ft_checks: List[StateDictType],
+        ptm_check: StateDictType,
+        remove_keys: List[str],
+        merge_func: str,
+    ) -> StateDictType:
+        """
+        Flatten the checkpoints into vectors and merge them with `ties_merging`.
+        """
+        # Compute the task vectors
+        flat_ft: Tensor = torch.vstack(
+            [state_dict_to_vector(check, remove_keys) for check in ft_checks]
+        )
+        flat_ptm: Tensor = state_dict_to_vector(ptm_check, remove_keys)
+        tv_flat_checks = flat_ft - flat_ptm
+
+        # Perform TIES Merging
+        merged_tv = ties_merging(
+            tv_flat_checks,
+            reset_thresh=self.threshold,
+            merge_func=merge_func,
+        )
+        merged_check = flat_ptm + self.scaling_factor * merged_tv
+        merged_state_dict = vector_to_state_dict(
+            merged_check, ptm_check, remove_keys=remove_keys
+        )
+        return merged_state_dict
+
+    def merge_streaming(
+        self,
+        ft_checks: List[StateDictType],
+        ptm_check: StateDictType,
+        remove_keys: List[str],
+        merge_func: str,
+    ) -> StateDictType:
+        """
+        Merge the checkpoints tensor by tensor with `ties_merging_streaming`.
+        """
+        merged_tv = ties_merging_streaming(
+            ft_checks,
+            reset_thresh=self.threshold,
+            merge_func=merge_func,
+            pretrained_checkpoint=ptm_check,
+            remove_keys=remove_keys,
+            threshold_mode=self.threshold_mode,
+            chunk_size=self.chunk_size,
+        )
+        return merged_task_vector_to_state_dict(
+            merged_tv, ptm_check, self.scaling_factor, remove_keys=remove_keys
+        )
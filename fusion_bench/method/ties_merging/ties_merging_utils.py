@@ -3,14 +3,28 @@ This is modified based on https://github.com/EnnengYang/AdaMerging/blob/main/src
 """
 
 import copy
+import functools
+import logging
 from collections import OrderedDict
-from typing import List
+from typing import (
+    Callable,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Optional,
+    Tuple,
+    Union,
+)
 
 import torch
 from torch import Tensor, nn
 
 from fusion_bench.utils.type import StateDictType
 
+log = logging.getLogger(__name__)
+
 
 # Model conversion utils
 def state_dict_to_vector(state_dict, remove_keys=[]):
@@ -242,6 +256,77 @@ def disjoint_merge(v: Tensor, merge_func: str, sign_to_mult):
     return disjoint_aggs
 
 
+def _elect_sign_disjoint_merge(
+    v: Tensor, merge_func: str, majority_sign: Optional[Union[Tensor, float]]
+) -> Tensor:
+    sign_to_mult = torch.sign(v.sum(dim=0))
+    if majority_sign is None:
+        majority_sign = torch.sign(sign_to_mult.sum())
+    sign_to_mult = torch.where(sign_to_mult == 0, majority_sign, sign_to_mult)
+
+    # `v > 0` where the elected sign is positive, `v < 0` elsewhere (including a zero elected sign,
+    # as in `disjoint_merge`), computed in place on a single boolean tensor
+    rows_to_keep = v > 0
+    rows_to_keep.ne_(sign_to_mult <= 0)
+    rows_to_keep.logical_and_(v != 0)
+    selected_entries = v * rows_to_keep
+
+    if merge_func == "mean":
+        # the selected entries are non-zero, so `rows_to_keep` counts them.
+        # summing the booleans as uint8 avoids casting the whole mask to int64.
+        if v.shape[0] < 256:
+            non_zero_counts = rows_to_keep.view(torch.uint8).sum(
+                dim=0, dtype=torch.uint8
+            )
+        else:
+            non_zero_counts = rows_to_keep.sum(dim=0)
+        non_zero_counts = non_zero_counts.float()
+        return selected_entries.sum(dim=0) / torch.clamp(non_zero_counts, min=1)
+    elif merge_func == "sum":
+        return selected_entries.sum(dim=0)
+    else:
+        return selected_entries.abs_().amax(dim=0) * sign_to_mult
+
+
+@functools.lru_cache(maxsize=None)
+def _compiled_elect_sign_disjoint_merge():
+    return torch.compile(_elect_sign_disjoint_merge, dynamic=True)
+
+
+def elect_sign_disjoint_merge(
+    v: Tensor,
+    merge_func: str,
+    majority_sign: Optional[Union[Tensor, float]] = None,
+    compile: bool = False,
+) -> Tensor:
+    """
+    Compute the elected signs, the agreement mask and the disjoint aggregation of the trimmed
+    task vectors in a single pass, with the same result as `resolve_sign` followed by `disjoint_merge`.
+
+    The intermediate tensors of `resolve_zero_signs` and `disjoint_merge` (the boolean masks
+    of both signs, the count of non-zero entries) are not materialized. With `compile=True`,
+    the function is compiled with `torch.compile` and the element-wise operations and
+    reductions are fused into a few vectorized loops.
+
+    Args:
+        v (Tensor): The trimmed task vectors, of shape (num_models, num_params).
+        merge_func (str): The merge function to use ("mean", "sum", or "max").
+        majority_sign (Optional[Union[Tensor, float]]): The sign assigned to the parameters whose elected sign is zero.
+            Defaults to the majority of the elected signs of `v`, as in `resolve_sign`.
+        compile (bool): Whether to use the `torch.compile`-d kernel.
+
+    Returns:
+        Tensor: The merged tensor, of shape (num_params,).
+    """
+    merge_func = merge_func.split("-")[-1]
+    if merge_func not in ("mean", "sum", "max"):
+        raise ValueError(f"Merge method {merge_func} is not defined.")
+
+    if compile:
+        return _compiled_elect_sign_disjoint_merge()(v, merge_func, majority_sign)
+    return _elect_sign_disjoint_merge(v, merge_func, majority_sign)
+
+
 def ties_merging(
     flat_task_checks,
     reset_thresh=None,
@@ -258,14 +343,13 @@ def ties_merging(
     Returns:
         Tensor: The merged tensor.
     """
-    all_checks = flat_task_checks.clone()
-    updated_checks, *_ = topk_values_mask(all_checks, K=reset_thresh, return_mask=False)
+    # `topk_values_mask` does not modify its input, no need to clone it
+    updated_checks, *_ = topk_values_mask(
+        flat_task_checks, K=reset_thresh, return_mask=False
+    )
     print("RESOLVING SIGN")
-    final_signs = resolve_sign(updated_checks)
-    assert final_signs is not None
-
     print(f"Disjoint AGGREGATION: {merge_func}")
-    merged_tv = disjoint_merge(updated_checks, merge_func, final_signs)
+    merged_tv = elect_sign_disjoint_merge(updated_checks, merge_func)
 
     return merged_tv
 
@@ -329,3 +413,271 @@ def ties_merging_split(
     )
 
     return selected_entries, merged_tv
+
+
+# STREAMING TIES MERGING UTILS
+#
+# The functions below compute the same result as `ties_merging` without building the
+# (num_models, num_params) matrix: the task vectors are visited tensor by tensor, in
+# chunks of at most `chunk_size` elements, and the top-k thresholds are found exactly
+# by a radix select over the bit patterns of the magnitudes.
+
+_FLOAT_TO_INT_DTYPE = {
+    torch.float16: torch.int16,
+    torch.bfloat16: torch.int16,
+    torch.float32: torch.int32,
+    torch.float64: torch.int64,
+}
+
+
+def _iter_task_vector_chunks(
+    checkpoints: List[StateDictType],
+    keys: List[str],
+    pretrained_checkpoint: Optional[StateDictType],
+    dtype: torch.dtype,
+    chunk_size: int,
+) -> Iterator[Tuple[str, int, Tensor]]:
+    """
+    Yield `(key, start, chunk)` with `chunk` of shape (num_models, num_elements), where
+    `chunk[i]` is `checkpoints[i][key].flatten()[start:start + num_elements]` minus the
+    corresponding slice of `pretrained_checkpoint` (if given).
+    """
+    num_models = len(checkpoints)
+    step = max(chunk_size // num_models, 1)
+    for key in keys:
+        # read each tensor once, lazy state dicts load it from disk on every access
+        tensors = [check[key].detach().reshape(-1) for check in checkpoints]
+        pretrained_tensor = (
+            pretrained_checkpoint[key].detach().reshape(-1)
+            if pretrained_checkpoint is not None
+            else None
+        )
+        numel = tensors[0].numel()
+        for start in range(0, numel, step):
+            end = min(start + step, numel)
+            chunk = torch.stack([tensor[start:end].to(dtype) for tensor in tensors])
+            if pretrained_tensor is not None:
+                chunk = chunk - pretrained_tensor[start:end].to(dtype)
+            yield key, start, chunk
+        del tensors, pretrained_tensor
+
+
+def kth_smallest_abs(
+    chunks: Callable[[], Iterable[Tensor]],
+    k: Union[int, List[int]],
+    num_rows: int,
+    dtype: torch.dtype,
+    bits_per_pass: int = 16,
+) -> Tensor:
+    """
+    Find the exact k-th smallest magnitude of each row of a matrix that is only available
+    as a sequence of column chunks.
+
+    The magnitudes are non-negative, so their bit patterns reinterpreted as integers have the
+    same order as the values. The k-th smallest bit pattern is selected digit by digit
+    (most significant first) by a histogram over the elements that match the digits found so
+    far, which takes one pass over the chunks per digit.
+
+    Args:
+        chunks (Callable[[], Iterable[Tensor]]): Returns a new iterator over the chunks, each of shape (num_rows, num_columns).
+        k (Union[int, List[int]]): The 1-based rank, for all rows or for each row.
+        num_rows (int): The number of rows.
+        dtype (torch.dtype): The floating point type of the chunks.
+        bits_per_pass (int): The number of bits of the digit resolved by each pass.
+
+    Returns:
+        Tensor: The k-th smallest magnitude of each row, of shape (num_rows, 1).
+    """
+    if dtype not in _FLOAT_TO_INT_DTYPE:
+        raise ValueError(f"Unsupported dtype for top-k selection: {dtype}")
+    int_dtype = _FLOAT_TO_INT_DTYPE[dtype]
+
+    remaining_k = torch.as_tensor(k, dtype=torch.int64).expand(num_rows).clone()
+    prefix = torch.zeros(num_rows, dtype=torch.int64)
+    # the sign bit of a magnitude is always zero
+    remaining_bits = dtype.itemsize * 8 - 1
+    while remaining_bits > 0:
+        digit_bits = min(bits_per_pass, remaining_bits)
+        shift = remaining_bits - digit_bits
+        num_bins = 1 << digit_bits
+        hist = torch.zeros(num_rows * num_bins, dtype=torch.int64)
+        for chunk in chunks():
+            bits = chunk.abs().view(int_dtype).to(torch.int64)
+            rows = torch.arange(num_rows, device=bits.device).unsqueeze(1)
+            match = (bits >> (shift + digit_bits)) == prefix.to(bits.device).unsqueeze(
+                1
+            )
+            digits = (bits >> shift) & (num_bins - 1)
+            bins = (rows * num_bins + digits)[match]
+            hist += torch.bincount(bins, minlength=num_rows * num_bins).cpu()
+        cumsum = hist.view(num_rows, num_bins).cumsum(dim=1)
+        digit = torch.searchsorted(cumsum, remaining_k.unsqueeze(1)).squeeze(1)
+        if (digit >= num_bins).any():
+            raise ValueError("k is larger than the number of elements.")
+        below = torch.where(
+            digit > 0,
+            cumsum.gather(1, (digit - 1).clamp(min=0).unsqueeze(1)).squeeze(1),
+            torch.zeros_like(digit),
+        )
+        remaining_k -= below
+        prefix = (prefix << digit_bits) | digit
+        remaining_bits = shift
+
+    return prefix.to(int_dtype).view(dtype).unsqueeze(1)
+
+
+@torch.no_grad()
+def ties_merging_streaming(
+    checkpoints: List[StateDictType],
+    reset_thresh: float,
+    merge_func: str = "",
+    pretrained_checkpoint: Optional[StateDictType] = None,
+    remove_keys: List[str] = [],
+    threshold_mode: Literal["model", "global"] = "model",
+    chunk_size: int = 2**24,
+) -> Dict[str, Tensor]:
+    """
+    Perform TIES merging tensor by tensor, with a peak memory bounded by `chunk_size`.
+    See `iter_ties_merging_streaming`.
+
+    Returns:
+        Dict[str, Tensor]: The merged task vector, with the same keys (except `remove_keys`) and shapes as the checkpoints.
+    """
+    return dict(
+        iter_ties_merging_streaming(
+            checkpoints,
+            reset_thresh,
+            merge_func=merge_func,
+            pretrained_checkpoint=pretrained_checkpoint,
+            remove_keys=remove_keys,
+            threshold_mode=threshold_mode,
+            chunk_size=chunk_size,
+        )
+    )
+
+
+def merged_task_vector_to_state_dict(
+    merged_tv: Dict[str, Tensor],
+    pretrained_checkpoint: StateDictType,
+    scaling_factor: float,
+    remove_keys: List[str] = [],
+) -> Dict[str, Tensor]:
+    """
+    Add the scaled merged task vector of `ties_merging_streaming` to the pretrained checkpoint.
+    As in `vector_to_state_dict`, the keys of `remove_keys` are added back as the shared embedding
+    weights if the model has `transformer.shared.weight` (e.g. T5).
+
+    Returns:
+        Dict[str, Tensor]: The merged state dict, with the dtypes of the pretrained checkpoint.
+    """
+    merged_state_dict = {}
+    for key, value in merged_tv.items():
+        merged_state_dict[key] = (
+            pretrained_checkpoint[key].detach() + scaling_factor * value
+        ).to(pretrained_checkpoint[key].dtype)
+    # add back the encoder and decoder embedding weights.
+    if "transformer.shared.weight" in merged_state_dict:
+        for key in remove_keys:
+            merged_state_dict[key] = merged_state_dict["transformer.shared.weight"]
+    return merged_state_dict
+
+
+@torch.no_grad()
+def iter_ties_merging_streaming(
+    checkpoints: List[StateDictType],
+    reset_thresh: float,
+    merge_func: str = "",
+    pretrained_checkpoint: Optional[StateDictType] = None,
+    remove_keys: List[str] = [],
+    threshold_mode: Literal["model", "global"] = "model",
+    chunk_size: int = 2**24,
+) -> Iterator[Tuple[str, Tensor]]:
+    """
+    Perform TIES merging tensor by tensor, yielding the merged task vector one tensor at a time,
+    so that the peak memory is bounded by `chunk_size` and the size of the largest tensor.
+
+    With `threshold_mode="model"` the result is the same as flattening the task vectors with
+    `state_dict_to_vector` and calling `ties_merging`: the top-k threshold of each task
+    vector is computed exactly by `kth_smallest_abs`, the elected signs are computed chunk by
+    chunk, and the zero signs are resolved with the majority sign of the whole model.
+    With `threshold_mode="global"` a single threshold is computed over all the task vectors,
+    so that the top `reset_thresh` of all the parameters are kept.
+
+    Args:
+        checkpoints (List[StateDictType]): The task vectors, or the fine-tuned checkpoints if `pretrained_checkpoint` is given.
+        reset_thresh (float): The proportion (or percentage if > 1) of values to keep.
+        merge_func (str): The merge function to use ("mean", "sum", or "max").
+        pretrained_checkpoint (Optional[StateDictType]): If given, it is subtracted from the checkpoints to obtain the task vectors.
+        remove_keys (List[str]): List of keys to skip.
+        threshold_mode (Literal["model", "global"]): Compute the top-k threshold per task vector or over all task vectors.
+        chunk_size (int): The maximum number of elements (over all the models) processed at once.
+
+    Yields:
+        Tuple[str, Tensor]: The keys (except `remove_keys`, in sorted order) and the tensors of the merged task vector.
+    """
+    check_parameterNamesMatch(checkpoints)
+    keys = sorted(key for key in checkpoints[0].keys() if key not in remove_keys)
+    num_models = len(checkpoints)
+    # same type promotion as `torch.cat` in `state_dict_to_vector`
+    dtype = functools.reduce(
+        torch.promote_types, (checkpoints[0][key].dtype for key in keys)
+    )
+    if pretrained_checkpoint is not None:
+        dtype = functools.reduce(
+            torch.promote_types,
+            (pretrained_checkpoint[key].dtype for key in keys),
+            dtype,
+        )
+
+    def chunks():
+        return _iter_task_vector_chunks(
+            checkpoints, keys, pretrained_checkpoint, dtype, chunk_size
+        )
+
+    K = reset_thresh / 100 if reset_thresh > 1 else reset_thresh
+    d = sum(checkpoints[0][key].numel() for key in keys)
+
+    # 1. Trim: find the magnitude threshold
+    if threshold_mode == "model":
+        k = d - int(d * K)
+        thresholds = kth_smallest_abs(
+            lambda: (chunk for _, _, chunk in chunks()), k, num_models, dtype
+        )
+    elif threshold_mode == "global":
+        k = num_models * d - int(num_models * d * K)
+        thresholds = kth_smallest_abs(
+            lambda: (chunk.reshape(1, -1) for _, _, chunk in chunks()), k, 1, dtype
+        ).expand(num_models, 1)
+    else:
+        raise ValueError(f"Unknown threshold mode: {threshold_mode}")
+
+    def trimmed_chunks():
+        for key, start, chunk in chunks():
+            yield key, start, chunk * (chunk.abs() >= thresholds.to(chunk.device))
+
+    # 2. Elect: the zero signs are resolved with the majority sign of all the parameters
+    log.info("RESOLVING SIGN")
+    sign_count = 0
+    for _, _, chunk in trimmed_chunks():
+        sign_count += torch.sign(chunk.sum(dim=0)).to(torch.int64).sum().item()
+    majority_sign = float((sign_count > 0) - (sign_count < 0))
+
+    # 3. Disjoint merge
+    log.info(f"Disjoint AGGREGATION: {merge_func}")
+    for key in keys:
+        shape = checkpoints[0][key].shape
+        merged_tensor = None
+        for _, start, chunk in _iter_task_vector_chunks(
+            checkpoints, [key], pretrained_checkpoint, dtype, chunk_size
+        ):
+            chunk = chunk * (chunk.abs() >= thresholds.to(chunk.device))
+            merged_chunk = elect_sign_disjoint_merge(chunk, merge_func, majority_sign)
+            if merged_tensor is None:
+                merged_tensor = torch.empty(
+                    shape, dtype=merged_chunk.dtype, device=merged_chunk.device
+                )
+            merged_tensor.view(-1)[start : start + merged_chunk.numel()] = merged_chunk
+        if merged_tensor is None:
+            # the tensor has no elements
+            merged_tensor = checkpoints[0][key].new_empty(shape)
+        yield key, merged_tensor
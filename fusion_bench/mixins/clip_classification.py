@@ -21,10 +21,14 @@ from torch.utils.data import DataLoader
 from tqdm.auto import tqdm
 from transformers import CLIPModel, CLIPProcessor, CLIPVisionModel
 
-from fusion_bench.dataset.clip_dataset import CLIPDataset
+from fusion_bench.dataset.clip_dataset import (
+    CLIPCollator,
+    CLIPDataset,
+    PreprocessedCLIPDataset,
+)
 from fusion_bench.mixins import LightningFabricMixin
 from fusion_bench.modelpool import CLIPVisionModelPool
-from fusion_bench.models.hf_clip import HFCLIPClassifier
+from fusion_bench.models.hf_clip import HFCLIPClassifier, ZeroShotHeadCache
 from fusion_bench.tasks.clip_classification import get_classnames_and_templates
 from fusion_bench.utils.data import InfiniteDataLoader
 from fusion_bench.taskpool.clip_vision.taskpool import skip_none_collate_fn
@@ -47,6 +51,8 @@ class CLIPClassificationMixin(LightningFabricMixin):
     - `_dataloader_kwargs` (Dict[str, Any]): Keyword arguments for the dataloader.
     - `modelpool` (CLIPVisionModelPool): The model pool containing the CLIP models.
     - `zeroshot_weights_cache_dir` (Optional[str]): The directory to cache the zero-shot weights.
+    - `preprocessed_cache_dir` (Optional[str]): The directory to cache the preprocessed images.
+    - `batched_preprocessing` (bool): Whether to preprocess the images by batch in the collate function.
     """
 
     _dataloader_kwargs: Dict[str, Any] = {}
@@ -56,6 +62,8 @@ class CLIPClassificationMixin(LightningFabricMixin):
     # a dict of zeroshot weights for each task, each key is the task name
     zeroshot_weights_cache_dir: str = "outputs/cache/clip_zeroshot_weights"
     zeroshot_weights: Dict[str, torch.Tensor] = {}
+    preprocessed_cache_dir: Optional[str] = None
+    batched_preprocessing: bool = False
     whether_setup_zero_shot_classification_head = False
 
     @property
@@ -65,6 +73,36 @@ class CLIPClassificationMixin(LightningFabricMixin):
             self._clip_processor = self.modelpool.load_processor()
         return self._clip_processor
 
+    def get_clip_dataset(self, dataset, name: Optional[str] = None) -> CLIPDataset:
+        """
+        Wrap a dataset of images and labels into a `CLIPDataset`. If `preprocessed_cache_dir` is set,
+        the images are preprocessed once and read from the cache afterwards (see `PreprocessedCLIPDataset`).
+        Otherwise, if `batched_preprocessing` is set, the dataset returns the raw images, which are
+        preprocessed by the collate function of `get_clip_collate_fn`.
+
+        Args:
+            dataset: The dataset to wrap.
+            name (Optional[str]): A name identifying the dataset in the cache, e.g. "mnist/test".
+        """
+        if self.preprocessed_cache_dir is not None:
+            return PreprocessedCLIPDataset(
+                dataset,
+                self.clip_processor,
+                cache_dir=self.preprocessed_cache_dir,
+                name=name,
+            )
+        if self.batched_preprocessing:
+            return CLIPDataset(dataset, None)
+        return CLIPDataset(dataset, self.clip_processor)
+
+    def get_clip_collate_fn(self):
+        """
+        Get the collate function for the datasets returned by `get_clip_dataset`.
+        """
+        if self.preprocessed_cache_dir is None and self.batched_preprocessing:
+            return CLIPCollator(self.clip_processor)
+        return skip_none_collate_fn
+
     @functools.cache
     def get_shuffled_test_loader_iter(
         self,
@@ -99,13 +137,13 @@ class CLIPClassificationMixin(LightningFabricMixin):
         dataloader_kwargs.update(loader_kwargs)
 
         # get the test dataset
-        clip_dataset = CLIPDataset(
-            self.modelpool.load_test_dataset(task), self.clip_processor
+        clip_dataset = self.get_clip_dataset(
+            self.modelpool.load_test_dataset(task), name=f"{task}/test"
         )
         # create the dataloader
         loader = DataLoader(clip_dataset, 
                             **dataloader_kwargs, 
-                            collate_fn=skip_none_collate_fn)
+                            collate_fn=self.get_clip_collate_fn())
         loader = self.fabric.setup_dataloaders(loader)
         return iter(InfiniteDataLoader(loader))
 
@@ -133,26 +171,12 @@ class CLIPClassificationMixin(LightningFabricMixin):
         self.visual_projection = self.fabric.to_device(self.visual_projection)
         self.logit_scale_exp = self.fabric.to_device(self.logit_scale_exp)
 
-        # get cache directory
-        if self.modelpool.has_pretrained:
-            model_name = self.modelpool.get_model_config("_pretrained_")
-            if not isinstance(model_name, str):
-                model_name = model_name.pretrained_model_name_or_path
-        else:
-            model_name = self.modelpool.get_model_config(self.modelpool.model_names[0])
-            if not isinstance(model_name, str):
-                model_name = model_name.pretrained_model_name_or_path
-        cache_dir = os.path.join(
-            self.zeroshot_weights_cache_dir,
-            os.path.normpath(model_name.split("/")[-1]),
+        cache = ZeroShotHeadCache(self.zeroshot_weights_cache_dir).for_text_encoder(
+            clip_model
+        )
+        log.info(
+            f"cache directory for zero-shot classification head: {self.zeroshot_weights_cache_dir}"
         )
-        if not os.path.exists(cache_dir):
-            log.info(
-                f"Creating cache directory for zero-shot classification head at {cache_dir}"
-            )
-            os.makedirs(cache_dir)
-
-        log.info(f"cache directory for zero-shot classification head: {cache_dir}")
         for task in tqdm(
             self.modelpool.model_names if task_names is None else task_names,
             "Setting up zero-shot classification head",
@@ -160,27 +184,9 @@ class CLIPClassificationMixin(LightningFabricMixin):
         ):
             zeroshot_weights = None
             if self.fabric.is_global_zero:
-                cache_file = os.path.join(
-                    cache_dir, os.path.normpath(f"{task}_zeroshot_weights.pt")
-                )
-                if os.path.exists(cache_file):
-                    zeroshot_weights = torch.load(
-                        cache_file,
-                        map_location="cpu",
-                        weights_only=True,
-                    ).detach()
-                    log.info(
-                        f"Loadded cached zeroshot weights for task: {task}, shape: {zeroshot_weights.shape}"
-                    )
-                else:
-                    log.info(
-                        f"Construct zero shot classification head for task: {task}"
-                    )
-                    classnames, templates = get_classnames_and_templates(task)
-                    clip_classifier.set_classification_task(classnames, templates)
-                    zeroshot_weights = clip_classifier.zeroshot_weights.detach().clone()
-                    log.info(f"save zeroshot weights to {cache_file}")
-                    torch.save(zeroshot_weights, cache_file)
+                classnames, templates = get_classnames_and_templates(task)
+                clip_classifier.set_classification_task(classnames, templates, cache=cache)
+                zeroshot_weights = clip_classifier.zeroshot_weights.detach().clone()
 
             self.fabric.barrier()
             self.zeroshot_weights[task] = self.fabric.broadcast(zeroshot_weights, src=0)
@@ -1,11 +1,14 @@
+import copy
 import logging
-from typing import TYPE_CHECKING, Callable, Iterable, List  # noqa: F401
+from pathlib import Path
+from typing import TYPE_CHECKING, Callable, Dict, Iterable, List, Optional, Union  # noqa: F401
 
 import torch
 from torch import Tensor, nn
 from transformers import CLIPModel, CLIPProcessor
 from transformers.models.clip.modeling_clip import BaseModelOutputWithPooling
 
+from fusion_bench.utils.cache_utils import TensorCache, state_dict_fingerprint
 from fusion_bench.utils.devices import get_device
 
 if TYPE_CHECKING:
@@ -18,6 +21,158 @@ default_templates = [
 ]
 
 
+@torch.no_grad()
+def compute_zero_shot_weights(
+    clip_model: CLIPModel,
+    processor: CLIPProcessor,
+    classnames: List[str],
+    templates: List[Callable[[str], str]] = default_templates,
+    batch_size: int = 1024,
+) -> Tensor:
+    """
+    Compute the zero-shot classification head, i.e. the normalized average of the normalized
+    text embeddings of the templates, for each class.
+
+    All the prompts of the task are tokenized with a single padded processor call and encoded
+    by the text tower in batches of `batch_size` prompts.
+
+    Returns:
+        Tensor: The zero-shot weights of shape (num_classes, projection_dim).
+    """
+    texts = [template(classname) for classname in classnames for template in templates]
+    inputs = processor(text=texts, return_tensors="pt", padding=True)
+    device = get_device(clip_model.text_model)
+
+    embeddings = []
+    for start in range(0, len(texts), batch_size):
+        batch = {k: v[start : start + batch_size].to(device) for k, v in inputs.items()}
+        batch_embeddings = clip_model.text_model(**batch)[1]
+        embeddings.append(clip_model.text_projection(batch_embeddings))
+    embeddings = torch.cat(embeddings, dim=0)
+
+    # normalize embeddings
+    embeddings = embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
+
+    embeddings = embeddings.view(len(classnames), len(templates), -1).mean(dim=1)
+    embeddings = embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
+    return embeddings
+
+
+class ZeroShotHeadCache:
+    """
+    A cache of zero-shot classification heads, keyed by the weights of the text encoder
+    (the text tower and the text projection), the tokenizer, the class names and the templates.
+
+    The heads are kept in memory, shared by all the instances in the process, and on disk
+    in a `TensorCache` if `cache_dir` is given.
+
+    The weights of the text encoder are hashed at every lookup, as they may have been modified in place.
+    When several heads are looked up for the same, unchanged text encoder, `for_text_encoder` returns
+    a view of the cache that hashes them once.
+
+    Examples:
+        >>> cache = ZeroShotHeadCache("outputs/cache/clip_zeroshot_weights")
+        >>> zeroshot_weights = cache.get_or_compute(clip_model, processor, classnames, templates)
+        >>> task_cache = cache.for_text_encoder(clip_model)
+        >>> heads = [task_cache.get_or_compute(clip_model, processor, c, t) for c, t in tasks]
+
+    Args:
+        cache_dir (Optional[Union[str, Path]]): The directory of the on-disk cache. Memory only if None.
+        max_size (Optional[int]): The maximum total size of the on-disk cache in bytes.
+    """
+
+    _memory_cache: Dict[str, Tensor] = {}
+    # (text tower, fingerprint) set by `for_text_encoder`
+    _pinned_text_encoder: Optional[tuple] = None
+
+    def __init__(
+        self,
+        cache_dir: Optional[Union[str, Path]] = None,
+        max_size: Optional[int] = None,
+    ):
+        self.disk_cache = (
+            TensorCache(cache_dir, max_size=max_size) if cache_dir is not None else None
+        )
+
+    @staticmethod
+    def text_encoder_fingerprint(clip_model: CLIPModel) -> str:
+        """
+        Content hash of the text tower and the text projection of `clip_model`.
+        """
+        text_encoder = nn.ModuleList([clip_model.text_model, clip_model.text_projection])
+        return state_dict_fingerprint(text_encoder.state_dict())
+
+    def for_text_encoder(self, clip_model: CLIPModel) -> "ZeroShotHeadCache":
+        """
+        Return a view of the cache that hashes the text encoder of `clip_model` once, for a series
+        of lookups during which its weights are not modified.
+        """
+        cache = copy.copy(self)
+        cache._pinned_text_encoder = (
+            clip_model.text_model,
+            self.text_encoder_fingerprint(clip_model),
+        )
+        return cache
+
+    def _text_encoder_fingerprint(self, clip_model: CLIPModel) -> str:
+        if (
+            self._pinned_text_encoder is not None
+            and self._pinned_text_encoder[0] is clip_model.text_model
+        ):
+            return self._pinned_text_encoder[1]
+        return self.text_encoder_fingerprint(clip_model)
+
+    def make_key(
+        self,
+        clip_model: CLIPModel,
+        processor: CLIPProcessor,
+        classnames: List[str],
+        templates: List[Callable[[str], str]],
+    ) -> str:
+        tokenizer = processor.tokenizer
+        return TensorCache.make_key(
+            text_encoder=self._text_encoder_fingerprint(clip_model),
+            tokenizer=[type(tokenizer).__name__, tokenizer.name_or_path],
+            classnames=list(classnames),
+            # the templates are functions, they are identified by the prompt of a placeholder class
+            templates=[template("{}") for template in templates],
+        )
+
+    def get_or_compute(
+        self,
+        clip_model: CLIPModel,
+        processor: CLIPProcessor,
+        classnames: List[str],
+        templates: List[Callable[[str], str]] = default_templates,
+    ) -> Tensor:
+        """
+        Return the cached zero-shot weights, computing and caching them if needed.
+
+        Returns:
+            Tensor: The zero-shot weights of shape (num_classes, projection_dim), on the CPU.
+                A copy of the cached tensor, which can be modified.
+        """
+        key = self.make_key(clip_model, processor, classnames, templates)
+        if key in self._memory_cache:
+            return self._memory_cache[key].clone()
+
+        zeroshot_weights = None
+        if self.disk_cache is not None:
+            entry = self.disk_cache.get(key)
+            if entry is not None:
+                zeroshot_weights = entry["zeroshot_weights"]
+                log.info(f"Loaded cached zero-shot weights, shape: {zeroshot_weights.shape}")
+        if zeroshot_weights is None:
+            zeroshot_weights = compute_zero_shot_weights(
+                clip_model, processor, classnames, templates
+            ).cpu()
+            if self.disk_cache is not None:
+                self.disk_cache.put(key, {"zeroshot_weights": zeroshot_weights})
+
+        self._memory_cache[key] = zeroshot_weights
+        return zeroshot_weights.clone()
+
+
 class HFCLIPClassifier(nn.Module):
     """
     A classifier based on the CLIP (Contrastive Language-Image Pre-training) model.
@@ -83,6 +238,7 @@ class HFCLIPClassifier(nn.Module):
         self,
         classnames: List[str],
         templates: List[Callable[[str], str]] = default_templates,
+        cache: Optional[ZeroShotHeadCache] = None,
     ):
         """
         Set up the zero-shot classification task.
@@ -95,34 +251,20 @@ class HFCLIPClassifier(nn.Module):
             templates (List[Callable[[str], str]], optional): List of template functions
                 for generating text prompts. Defaults to `default_templates`, i.e.
                 ["a photo of a {classname}"].
+            cache (Optional[ZeroShotHeadCache]): The cache of zero-shot heads to look up first.
         """
-        processor = self.processor
-
         self.classnames = classnames
         self.templates = templates
 
-        with torch.no_grad():
-            zeroshot_weights = []
-            for classname in classnames:
-                text = [template(classname) for template in templates]
-                inputs = processor(text=text, return_tensors="pt", padding=True)
-                inputs = {
-                    k: v.to(get_device(self.text_model)) for k, v in inputs.items()
-                }
-                embeddings = self.text_model(**inputs)[1]
-                embeddings = self.clip_model.text_projection(embeddings)
-
-                # normalize embeddings
-                embeddings = embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
-
-                embeddings = embeddings.mean(dim=0)
-                embeddings = embeddings / embeddings.norm(p=2, dim=-1, keepdim=True)
-
-                zeroshot_weights.append(embeddings)
-
-            zeroshot_weights = torch.stack(zeroshot_weights, dim=0)
-
-        self.zeroshot_weights = zeroshot_weights
+        if cache is not None:
+            zeroshot_weights = cache.get_or_compute(
+                self.clip_model, self.processor, classnames, templates
+            )
+        else:
+            zeroshot_weights = compute_zero_shot_weights(
+                self.clip_model, self.processor, classnames, templates
+            )
+        self.zeroshot_weights = zeroshot_weights.to(get_device(self.text_model))
 
     def forward(
         self,
@@ -151,7 +293,6 @@ class HFCLIPClassifier(nn.Module):
         """
         if self.zeroshot_weights is None:
             raise ValueError("Must set classification task before forward pass")
-        text_embeds = self.zeroshot_weights
 
         image_embeds = self.get_image_features(images)
         # normalize embeddings
@@ -169,10 +310,7 @@ class HFCLIPClassifier(nn.Module):
                 image_embeds, dataset_name=task_name
             )
 
-        # cosine similarity
-        logit_scale = self.clip_model.logit_scale.exp()
-        logits_per_text = torch.matmul(text_embeds, image_embeds.t()) * logit_scale
-        logits_per_image = logits_per_text.t()
+        logits_per_image = self.compute_logits(image_embeds)
 
         if return_dict:
             ret = {"logits": logits_per_image}
@@ -185,6 +323,15 @@ class HFCLIPClassifier(nn.Module):
             else:
                 return logits_per_image
 
+    def compute_logits(self, image_embeds: Tensor) -> Tensor:
+        """
+        Compute the classification logits from normalized image embeddings, as the cosine similarity
+        with the zero-shot weights scaled by the logit scale.
+        """
+        logit_scale = self.clip_model.logit_scale.exp()
+        logits_per_text = torch.matmul(self.zeroshot_weights, image_embeds.t()) * logit_scale
+        return logits_per_text.t()
+
     def get_image_features(self, images: Tensor) -> Tensor:
         """
         Compute the image embeddings.
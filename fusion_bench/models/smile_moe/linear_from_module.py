@@ -1,3 +1,4 @@
+import functools
 import logging
 from typing import Dict, List, Optional, Tuple, Union  # noqa: F401
 
@@ -5,6 +6,8 @@ import torch
 import torch.nn.functional as F
 from torch import Tensor, nn
 
+from fusion_bench.utils.svd_scheduler import SVDScheduler
+
 from .utils import _is_all_zeros, svd
 
 log = logging.getLogger(__name__)
@@ -171,6 +174,7 @@ class SmileMoELinear(nn.Module):
         full_matrices=True,
         upscaling_accelerator=None,
         routing_use_diff=True,
+        svd_scheduler: Optional[SVDScheduler] = None,
     ):
         """
         Initialize the SmileMoELinear module.
@@ -184,6 +188,8 @@ class SmileMoELinear(nn.Module):
             full_matrices (bool): Whether to compute the full-sized U and V matrices.
             upscaling_accelerator (str): The device to perform the computation on.
             routing_use_diff (bool): Whether to use weight differences for routing.
+            svd_scheduler (Optional[SVDScheduler]): The scheduler of the SVDs of the weight differences.
+                Defaults to computing them one after the other.
         """
         super().__init__()
         self.num_experts = len(finetuned_models)
@@ -199,9 +205,18 @@ class SmileMoELinear(nn.Module):
             raise ExpertNotTrainedError()
 
         if routing_use_diff or k > 0:
+            if svd_scheduler is None:
+                svd_scheduler = SVDScheduler()
+            svd_results = svd_scheduler.map(
+                enumerate(w_diff_list),
+                svd_fn=functools.partial(
+                    svd,
+                    full_matrices=full_matrices,
+                    accelerator=upscaling_accelerator,
+                ),
+            )
             svd_cache_list = [
-                svd(w, full_matrices=full_matrices, accelerator=upscaling_accelerator)
-                for w in w_diff_list
+                svd_results[i] for i in range(len(w_diff_list))
             ]  # the svd cache list to avoid recomputing
 
         # construct the gate network
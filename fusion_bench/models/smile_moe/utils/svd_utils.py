@@ -18,7 +18,7 @@ def _svd(w: Tensor, full_matrices: bool = True) -> Tuple[Tensor, Tensor, Tensor]
     u, s, vh = torch.linalg.svd(
         w, full_matrices=full_matrices, driver="gesvd" if w.is_cuda else None
     )
-    v = vh.T
+    v = vh.mT
     return u, s, v
 
 
@@ -188,6 +188,8 @@ class WeightEnsemblingMoE(nn.Module):
         for m in expert_models:
             m.requires_grad_(False)
         self.task_vectors = nn.ModuleList(expert_models)
+        # names of the linear modules of the base model, if the task vectors only contain parameters of linear modules
+        self._routed_linear_names = self._get_routed_linear_names()
 
     @property
     def forward_model(self):
@@ -205,6 +207,75 @@ class WeightEnsemblingMoE(nn.Module):
         self._merged_state_dict = state_dict
         return state_dict
 
+    def _get_routed_linear_names(self):
+        linear_names = [
+            name
+            for name, module in self.base_model.named_modules()
+            if isinstance(module, nn.Linear)
+        ]
+        linear_param_names = {
+            f"{name}.{param_name}"
+            for name in linear_names
+            for param_name in ("weight", "bias")
+        }
+        for task_vector in self.task_vectors:
+            for name, _ in task_vector.named_parameters():
+                if name not in linear_param_names:
+                    return None
+        return linear_names
+
+    def _routed_linear_hook(self, module_name: str, gate_weights: Tensor):
+        """
+        Forward hook that adds `sum_k g_k (x @ dW_k^T + db_k)` to the output of a linear module of the base model,
+        which is the output of the linear module with the per-sample merged weights.
+        """
+        task_vector_linears = [
+            get_attr(task_vector, module_name.split("."))
+            for task_vector in self.task_vectors
+        ]
+
+        def hook(module: nn.Linear, args, output: Tensor):
+            x = args[0]
+            # shape of the routing weights of one expert, broadcast over all the dimensions except the batch dimension
+            shape = [1] * x.dim()
+            shape[0 if self.batch_first else 1] = gate_weights.shape[0]
+            for expert_idx, task_vector_linear in enumerate(task_vector_linears):
+                weight = getattr(task_vector_linear, "weight", None)
+                bias = getattr(task_vector_linear, "bias", None)
+                if weight is None and bias is None:
+                    continue
+                if weight is None:
+                    expert_output = bias.expand_as(output)
+                else:
+                    expert_output = F.linear(x, weight, bias)
+                output = output + gate_weights[:, expert_idx].view(shape) * expert_output
+            return output
+
+        return hook
+
+    def routed_forward(self, hidden_states: Tensor, gate_weights: Tensor) -> Tensor:
+        """
+        Forward the samples with per-sample merged weights in a single pass, without materializing the merged weights:
+        each linear module of the base model computes its base output plus the outputs of the task vectors,
+        weighted by the routing weights of each sample.
+
+        Args:
+            hidden_states (Tensor): The input hidden states.
+            gate_weights (Tensor): The routing weights of shape (batch_size, num_experts).
+        """
+        modules = dict(self.base_model.named_modules())
+        handles = [
+            modules[name].register_forward_hook(
+                self._routed_linear_hook(name, gate_weights)
+            )
+            for name in self._routed_linear_names
+        ]
+        try:
+            return self.base_model(hidden_states)
+        finally:
+            for handle in handles:
+                handle.remove()
+
     def forward(self, hidden_states: Tensor):
         if self.gate.num_hidden_layers == 0:
             gate_weights = self.gate()
@@ -224,6 +295,8 @@ class WeightEnsemblingMoE(nn.Module):
             gate_weights = gate_weights.mean(dim=0)
             self.merge_weights(gate_weights)
             output_hidden_states = self.forward_model(hidden_states)
+        elif self._routed_linear_names is not None:
+            output_hidden_states = self.routed_forward(hidden_states, gate_weights)
         else:
             output_hidden_states = []
             for sample_idx, weights in enumerate(gate_weights):
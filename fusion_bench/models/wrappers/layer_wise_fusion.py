@@ -8,8 +8,10 @@ from typing import (  # noqa: F401
     Generic,
     Iterator,
     List,
+    Literal,
     Optional,
     TypeVar,
+    Union,
 )
 
 import torch
@@ -49,13 +51,14 @@ def get_layer_wise_weights(
     return torch.full((num_models, num_layers), init_values, dtype=dtype)
 
 
-def _fuse_weights(layer_wise_weight: Tensor, tensors: List[Tensor]):
+def _fuse_weights(layer_wise_weight: Tensor, tensors: Union[List[Tensor], Tensor]):
     """
     Fuse the layer-wise weights with the given state dictionaries.
 
     Args:
         layer_wise_weight (Tensor): A tensor of shape (num_models,) containing the layer-wise weights.
-        state_dicts (List[Tensor]): A list of state dictionaries, each containing the weights for a single layer.
+        state_dicts (Union[List[Tensor], Tensor]): A list of state dictionaries, each containing the weights for a single layer,
+            or these weights stacked into a tensor of shape (num_models, *shape).
 
     Returns:
         Tensor: A tensor of shape (num_params,) containing the fused weights.
@@ -63,6 +66,13 @@ def _fuse_weights(layer_wise_weight: Tensor, tensors: List[Tensor]):
     assert len(layer_wise_weight) == len(
         tensors
     ), f"layer_wise_weight.shape={layer_wise_weight.shape}, len(tensors)={len(tensors)}"
+    if isinstance(tensors, Tensor):
+        # a single contraction over the model dimension
+        return torch.tensordot(
+            layer_wise_weight.to(tensors.dtype),
+            tensors.to(layer_wise_weight.device),
+            dims=1,
+        )
     return sum(
         layer_wise_weight[i] * w.to(layer_wise_weight.device)
         for i, w in enumerate(tensors)
@@ -98,6 +108,7 @@ def fuse_weights(
 
 class LayerWiseMergedModel(nn.Module, Generic[TorchModelType]):
     _merged_state_dict: StateDictType = None
+    _stacked_task_vectors: Optional[Dict[str, Tensor]] = None
 
     def __init__(
         self,
@@ -109,6 +120,7 @@ class LayerWiseMergedModel(nn.Module, Generic[TorchModelType]):
         strict: bool = True,
         sparsity_ratio: Optional[float] = None,
         normalized_merging_weights: bool = False,
+        task_vector_layout: Literal["models", "stacked", "arena"] = "models",
     ):
         R"""
         This class wraps a pretrained model and a list of finetuned models, and merges the weights of the finetuned models into the pretrained model using layer-wise fusion.
@@ -126,6 +138,11 @@ class LayerWiseMergedModel(nn.Module, Generic[TorchModelType]):
             strict (bool, optional): This option passes the `strict` argument to the `functional_call` function. Defaults to True.
             sparsity_ratio (float, optional): If `sparsity_ratio` is provided, the task vector will be pruned before merging. A high spasity level can save the memory usage during merging.
             normalized_merging_weights (bool, optional): If True, the layer-wise weights will be normalized for each layer, so that the sum of weights across models for each layer is 1. Defaults to False.
+            task_vector_layout (str, optional): How the task vectors are stored for `merge_weights`.
+                "models" keeps them in the finetuned models and fuses them model by model.
+                "stacked" stacks the task vectors of each parameter into a contiguous tensor of shape (num_models, *shape), so that each parameter is fused with a single matrix-vector product.
+                "arena" additionally places all the stacked task vectors with the same dtype and device in one flat buffer.
+                In the last two cases, the parameters of the finetuned models are views of the stacked task vectors. Defaults to "models".
         """
         super().__init__()
         self.clamp_weights = clamp_weights
@@ -171,6 +188,76 @@ class LayerWiseMergedModel(nn.Module, Generic[TorchModelType]):
                     nn.Parameter(pruned_param.to_sparse(), requires_grad=False),
                 )
 
+        if task_vector_layout not in ("models", "stacked", "arena"):
+            raise ValueError(f"Unknown task vector layout: {task_vector_layout}")
+        if task_vector_layout != "models" and sparsity_ratio is not None:
+            raise ValueError(
+                "The sparse task vectors can not be stacked, set `task_vector_layout` to 'models'."
+            )
+        self.task_vector_layout = task_vector_layout
+        if task_vector_layout != "models":
+            self._stack_task_vectors()
+
+    @torch.no_grad()
+    def _stack_task_vectors(self):
+        """
+        Stack the task vectors of each parameter into a tensor of shape (num_models, *shape),
+        and make the parameters of the finetuned models views of them.
+        """
+        num_models = len(self.task_vectors)
+        named_params = list(self.task_vectors[0].named_parameters())
+        stacked_task_vectors: Dict[str, Tensor] = {}
+        if self.task_vector_layout == "arena":
+            # one flat buffer of shape (num_models, total_numel) for each dtype and device
+            groups: Dict[tuple, List[str]] = {}
+            for name, param in named_params:
+                groups.setdefault((param.dtype, param.device), []).append(name)
+            for (dtype, device), names in groups.items():
+                params = [
+                    [get_attr(m, name.split(".")) for name in names]
+                    for m in self.task_vectors
+                ]
+                numels = [param.numel() for param in params[0]]
+                arena = torch.empty(
+                    num_models, sum(numels), dtype=dtype, device=device
+                )
+                for model_idx in range(num_models):
+                    torch.cat(
+                        [param.reshape(-1) for param in params[model_idx]],
+                        out=arena[model_idx],
+                    )
+                for name, param, chunk in zip(
+                    names, params[0], arena.split(numels, dim=1)
+                ):
+                    stacked_task_vectors[name] = chunk.view(num_models, *param.shape)
+        else:
+            for name, _ in named_params:
+                stacked_task_vectors[name] = torch.stack(
+                    [get_attr(m, name.split(".")) for m in self.task_vectors]
+                )
+
+        # keep the task vectors only once in memory, in the stacked tensors
+        for name, _ in named_params:
+            for model_idx, m in enumerate(self.task_vectors):
+                set_attr(
+                    m,
+                    name.split("."),
+                    nn.Parameter(
+                        stacked_task_vectors[name][model_idx], requires_grad=False
+                    ),
+                )
+        # the dict keeps the order of `task_vector.named_parameters()`, i.e. of the columns of `merge_weight`
+        self._stacked_task_vectors = {
+            name: stacked_task_vectors[name] for name, _ in named_params
+        }
+
+    def _apply(self, fn, recurse=True):
+        module = super()._apply(fn, recurse=recurse)
+        if self._stacked_task_vectors is not None:
+            # `.to()`, `.cuda()`, ... replace the parameters of the finetuned models, stack them again
+            self._stack_task_vectors()
+        return module
+
     @property
     def forward_model(self):
         return functools.partial(
@@ -200,6 +287,26 @@ class LayerWiseMergedModel(nn.Module, Generic[TorchModelType]):
             layer_wise_weight = layer_wise_weight.softmax(dim=0)
 
         state_dict = self.pretrained_model.state_dict(keep_vars=True)
+        if self._stacked_task_vectors is not None:
+            # shape of layer_wise_weight.T: (num_layers, num_models)
+            assert len(self._stacked_task_vectors) == layer_wise_weight.size(1)
+            for w, (name, stacked) in zip(
+                layer_wise_weight.T, self._stacked_task_vectors.items()
+            ):
+                if task_vector_mask is not None:
+                    state_dict[name] = state_dict[name] + task_vector_mask[
+                        name
+                    ] * _fuse_weights(w, stacked)
+                else:
+                    # merged = pretrained + stacked^T @ w, as a single matrix-vector product
+                    state_dict[name] = torch.addmv(
+                        state_dict[name].reshape(-1),
+                        stacked.reshape(stacked.size(0), -1).T,
+                        w.to(stacked.dtype),
+                    ).view_as(state_dict[name])
+            self._merged_state_dict = state_dict
+            return state_dict
+
         # shape of layer_wise_weight: (num_models, num_layers)
         for weight, task_vector in zip(layer_wise_weight, self.task_vectors):
             assert len(list(task_vector.named_parameters())) == weight.size(0)
@@ -136,6 +136,9 @@ class FabricModelFusionProgram(
     def save_merged_model(self, merged_model):
         """
         Saves the merged model to the specified path.
+
+        If the method returns a dictionary of models (e.g. one merged model per value of a sweep),
+        each model is saved under `<merged_model_save_path>/<key>`, and the other items are skipped.
         """
         if self.merged_model_save_path is not None:
             # path to save the merged model, use "{log_dir}" to refer to the logger directory
@@ -143,23 +146,31 @@ class FabricModelFusionProgram(
             if "{log_dir}" in save_path and self.log_dir is not None:
                 save_path = save_path.format(log_dir=self.log_dir)
 
-            if os.path.dirname(save_path):
-                os.makedirs(os.path.dirname(save_path), exist_ok=True)
-
-            # save the merged model
-            if self.merged_model_save_kwargs is not None:
-                merged_model_save_kwargs = self.merged_model_save_kwargs
+            if isinstance(merged_model, Dict):
+                for key, item in merged_model.items():
+                    if isinstance(item, nn.Module):
+                        self._save_model(item, os.path.join(save_path, key))
             else:
-                merged_model_save_kwargs = {}
-            with timeit_context(f"Saving the merged model to {save_path}"):
-                self.modelpool.save_model(
-                    merged_model,
-                    save_path,
-                    **merged_model_save_kwargs,
-                )
+                self._save_model(merged_model, save_path)
         else:
             print("No save path specified for the merged model. Skipping saving.")
 
+    def _save_model(self, model: nn.Module, save_path: str):
+        if os.path.dirname(save_path):
+            os.makedirs(os.path.dirname(save_path), exist_ok=True)
+
+        # save the merged model
+        if self.merged_model_save_kwargs is not None:
+            merged_model_save_kwargs = self.merged_model_save_kwargs
+        else:
+            merged_model_save_kwargs = {}
+        with timeit_context(f"Saving the merged model to {save_path}"):
+            self.modelpool.save_model(
+                model,
+                save_path,
+                **merged_model_save_kwargs,
+            )
+
     def evaluate_merged_model(
         self,
         taskpool: BaseTaskPool,
@@ -1,14 +1,19 @@
+import hashlib
 import itertools
 import json
 import logging
 import os
+from collections import OrderedDict
 from pathlib import Path
 from typing import (  # noqa: F401
     TYPE_CHECKING,
     Any,
     Callable,
     Dict,
+    Iterable,
+    Iterator,
     List,
+    Mapping,
     Optional,
     Tuple,
     Union,
@@ -28,12 +33,13 @@ from tqdm.autonotebook import tqdm
 from transformers import CLIPModel, CLIPProcessor, CLIPVisionModel
 from transformers.models.clip.modeling_clip import CLIPVisionTransformer
 
-from fusion_bench.dataset import CLIPDataset
+from fusion_bench.dataset import CLIPCollator, CLIPDataset, PreprocessedCLIPDataset
 from fusion_bench.mixins import LightningFabricMixin
-from fusion_bench.models.hf_clip import HFCLIPClassifier
+from fusion_bench.models.hf_clip import HFCLIPClassifier, ZeroShotHeadCache
 from fusion_bench.taskpool import BaseTaskPool
 from fusion_bench.tasks.clip_classification import get_classnames_and_templates
 from fusion_bench.utils import count_parameters, instantiate
+from fusion_bench.utils.cache_utils import TensorCache, state_dict_fingerprint
 
 if TYPE_CHECKING:
     from fusion_bench.models.surgery.surgerymodelwrapper import SurgeryModelWrapper
@@ -107,6 +113,18 @@ class CLIPVisionModelTaskPool(
         layer_wise_feature_save_path (Optional[str]): Path to save the layer-wise features.
         layer_wise_feature_first_token_only (bool): Boolean indicating whether to save only the first token of the features.
         layer_wise_feature_max_num (Optional[int]): Maximum number of features to save.
+        zeroshot_weights_cache_dir (Optional[str]): Directory to cache the zero-shot classification heads on disk.
+            The heads are always cached in memory, keyed by the weights of the text encoder.
+        preprocessed_cache_dir (Optional[str]): Directory to cache the preprocessed test images, which are
+            then read from a memory-mapped file instead of being preprocessed at every evaluation.
+        batched_preprocessing (bool): Whether to preprocess the test images with one processor call per batch,
+            in the collate function, instead of one call per image. Ignored if `preprocessed_cache_dir` is set.
+        feature_cache_layers (Optional[List[int]]): Indices of the encoder layers whose outputs (the hidden states of
+            all the test images) are cached in memory, keyed by the fingerprint of the vision model up to that layer.
+            A model that shares its embeddings and layers 0..k with a previously evaluated model resumes the forward
+            pass after layer k. Disabled if None, and for surgery models or when layer-wise features are saved.
+        feature_cache_max_size (Optional[int]): The maximum total size of the cached features in bytes,
+            the least recently used entries are evicted beyond it. No limit if None.
         fast_dev_run (bool): Boolean indicating whether to run in fast development mode.
     """
 
@@ -115,6 +133,8 @@ class CLIPVisionModelTaskPool(
     # hooks and handles for saving layer-wise features
     _layer_wise_feature_save_hooks: Dict[int, LayerWiseFeatureSaver] = {}
     _layer_wise_feature_save_hook_handles: Dict[int, RemovableHandle] = {}
+    # prefix fingerprints of the vision model being evaluated, computed once per call to `evaluate`
+    _prefix_fingerprints_memo: Optional[List[str]] = None
 
     _config_mapping = BaseTaskPool._config_mapping | {
         "_test_datasets": "test_datasets",
@@ -123,6 +143,11 @@ class CLIPVisionModelTaskPool(
         "_clip_model": "clip_model",
         "_dataloader_kwargs": "dataloader_kwargs",
         "_layer_wise_feature_save_path": "layer_wise_feature_save_path",
+        "zeroshot_weights_cache_dir": "zeroshot_weights_cache_dir",
+        "preprocessed_cache_dir": "preprocessed_cache_dir",
+        "batched_preprocessing": "batched_preprocessing",
+        "feature_cache_layers": "feature_cache_layers",
+        "feature_cache_max_size": "feature_cache_max_size",
         "fast_dev_run": "fast_dev_run",
     }
 
@@ -137,6 +162,11 @@ class CLIPVisionModelTaskPool(
         layer_wise_feature_save_path: Optional[str] = None,
         layer_wise_feature_first_token_only: bool = True,
         layer_wise_feature_max_num: Optional[int] = None,
+        zeroshot_weights_cache_dir: Optional[str] = None,
+        preprocessed_cache_dir: Optional[str] = None,
+        batched_preprocessing: bool = False,
+        feature_cache_layers: Optional[List[int]] = None,
+        feature_cache_max_size: Optional[int] = None,
         fast_dev_run: bool = False,
         **kwargs,
     ):
@@ -159,6 +189,20 @@ class CLIPVisionModelTaskPool(
         self.layer_wise_feature_first_token_only = layer_wise_feature_first_token_only
         self.layer_wise_feature_max_num = layer_wise_feature_max_num
 
+        self.zeroshot_weights_cache_dir = zeroshot_weights_cache_dir
+        self.zeroshot_head_cache = ZeroShotHeadCache(zeroshot_weights_cache_dir)
+        self.preprocessed_cache_dir = preprocessed_cache_dir
+        self.batched_preprocessing = batched_preprocessing
+
+        # layer-wise feature cache, key -> (hidden states, targets) of the batches
+        self.feature_cache_layers = (
+            list(feature_cache_layers) if feature_cache_layers is not None else None
+        )
+        self.feature_cache_max_size = feature_cache_max_size
+        self._feature_cache: "OrderedDict[str, Tuple[List[Tensor], List[Tensor]]]" = (
+            OrderedDict()
+        )
+
         self.fast_dev_run = fast_dev_run
         super().__init__(**kwargs)
 
@@ -191,18 +235,39 @@ class CLIPVisionModelTaskPool(
             name: instantiate(dataset) if isinstance(dataset, DictConfig) else dataset
             for name, dataset in self._test_datasets.items()
         }
-        self.test_datasets = {
-            name: CLIPDataset(dataset, self.data_processor)
-            for name, dataset in self.test_datasets.items()
-        }
+        collate_fn = (
+            raw_image_collate_fn if self.data_processor is None else skip_none_collate_fn
+        )
+        if self.data_processor is not None and self.preprocessed_cache_dir is not None:
+            self.test_datasets = {
+                name: PreprocessedCLIPDataset(
+                    dataset,
+                    self.data_processor,
+                    cache_dir=self.preprocessed_cache_dir,
+                    name=f"{name}/test",
+                )
+                for name, dataset in self.test_datasets.items()
+            }
+        elif self.data_processor is not None and self.batched_preprocessing:
+            # the datasets return the raw images, which are preprocessed by batch in the collate function
+            self.test_datasets = {
+                name: CLIPDataset(dataset, None)
+                for name, dataset in self.test_datasets.items()
+            }
+            collate_fn = CLIPCollator(self.data_processor)
+            for dataset in self.test_datasets.values():
+                collate_fn.check(dataset)
+        else:
+            self.test_datasets = {
+                name: CLIPDataset(dataset, self.data_processor)
+                for name, dataset in self.test_datasets.items()
+            }
         # Setup the dataloaders
         self.test_dataloaders = {
             name: DataLoader(
                 dataset,
                 **self._dataloader_kwargs,
-                collate_fn=(
-                    raw_image_collate_fn if self.data_processor is None else skip_none_collate_fn
-                ),
+                collate_fn=collate_fn,
             )
             for name, dataset in self.test_datasets.items()
         }
@@ -245,24 +310,21 @@ class CLIPVisionModelTaskPool(
         else:
             test_loader = test_loader
 
+        vision_model = self._get_feature_cacheable_vision_model(classifier)
+        if vision_model is None:
+            batches = self._iter_logits(classifier, test_loader, task_name)
+        else:
+            batches = self._iter_logits_with_feature_cache(
+                classifier, vision_model, test_loader, task_name
+            )
+
         pbar = tqdm(
-            test_loader,
+            batches,
             desc=f"Evaluating {task_name}",
             leave=False,
             dynamic_ncols=True,
         )
-        for batch in pbar:
-            if batch is None:
-                continue  # all samples in batch were invalid
-            inputs, targets = batch
-            outputs = classifier(
-                inputs,
-                return_image_embeds=True,
-                return_dict=True,
-                task_name=task_name,
-            )
-            logits: Tensor = outputs["logits"]
-
+        for logits, targets in pbar:
             loss = F.cross_entropy(logits, targets)
             loss_metric.update(loss.detach().cpu())
             acc = accuracy(logits.detach().cpu(), targets.detach().cpu())
@@ -278,6 +340,160 @@ class CLIPVisionModelTaskPool(
         results = {"accuracy": acc, "loss": loss}
         return results
 
+    def _iter_logits(
+        self,
+        classifier: HFCLIPClassifier,
+        test_loader: Iterable,
+        task_name: str,
+    ) -> Iterator[Tuple[Tensor, Tensor]]:
+        """
+        Yield the logits and the targets of each batch of the test dataset.
+        """
+        for batch in test_loader:
+            if batch is None:
+                continue  # all samples in batch were invalid
+            inputs, targets = batch
+            outputs = classifier(
+                inputs,
+                return_image_embeds=True,
+                return_dict=True,
+                task_name=task_name,
+            )
+            yield outputs["logits"], targets
+
+    def _get_feature_cacheable_vision_model(
+        self, classifier: HFCLIPClassifier
+    ) -> Optional[CLIPVisionTransformer]:
+        """
+        Return the vision transformer of the classifier if the layer-wise feature cache applies to it, else None.
+        """
+        if self.feature_cache_layers is None or self.layer_wise_feature_save_path is not None:
+            return None
+        vision_model = classifier.clip_model.vision_model
+        if isinstance(vision_model, CLIPVisionModel):
+            vision_model = vision_model.vision_model
+        if not isinstance(vision_model, CLIPVisionTransformer):
+            log.warning(
+                f"The layer-wise feature cache does not support {type(vision_model).__name__}, it is disabled."
+            )
+            return None
+        return vision_model
+
+    @staticmethod
+    def _prefix_fingerprints(
+        vision_model: CLIPVisionTransformer, num_layers: int
+    ) -> List[str]:
+        """
+        Fingerprints of the vision model up to each of its first `num_layers` encoder layers,
+        i.e. the i-th fingerprint covers the embeddings, the pre-layernorm and the layers 0..i.
+        """
+        h = hashlib.sha256()
+        h.update(state_dict_fingerprint(vision_model.embeddings.state_dict()).encode())
+        h.update(
+            state_dict_fingerprint(vision_model.pre_layrnorm.state_dict()).encode()
+        )
+        fingerprints = []
+        for layer in vision_model.encoder.layers[:num_layers]:
+            h.update(state_dict_fingerprint(layer.state_dict()).encode())
+            fingerprints.append(h.hexdigest())
+        return fingerprints
+
+    def _iter_logits_with_feature_cache(
+        self,
+        classifier: HFCLIPClassifier,
+        vision_model: CLIPVisionTransformer,
+        test_loader: Iterable,
+        task_name: str,
+    ) -> Iterator[Tuple[Tensor, Tensor]]:
+        """
+        Same as `_iter_logits`, resuming the forward pass from the deepest cached layer output
+        of the same vision model prefix, and caching the outputs of the other layers of `feature_cache_layers`.
+        """
+        layers = vision_model.encoder.layers
+        cache_layers = sorted(
+            {layer_idx for layer_idx in self.feature_cache_layers if layer_idx < len(layers)}
+        )
+        if len(cache_layers) == 0:
+            yield from self._iter_logits(classifier, test_loader, task_name)
+            return
+        # the weights are hashed at every evaluation, as they may have been modified in place
+        # (possibly through `.data`, which is not tracked), but only once for all the tasks
+        fingerprints = self._prefix_fingerprints_memo
+        if fingerprints is None or len(fingerprints) <= cache_layers[-1]:
+            fingerprints = self._prefix_fingerprints(vision_model, cache_layers[-1] + 1)
+            if self._prefix_fingerprints_memo is not None:
+                self._prefix_fingerprints_memo = fingerprints
+        keys = {
+            layer_idx: TensorCache.make_key(
+                task=task_name,
+                layer=layer_idx,
+                model_prefix=fingerprints[layer_idx],
+                fast_dev_run=self.fast_dev_run,
+            )
+            for layer_idx in cache_layers
+        }
+        cached_layers = [idx for idx in cache_layers if keys[idx] in self._feature_cache]
+        resume_layer = cached_layers[-1] if len(cached_layers) > 0 else None
+
+        # save the outputs of the deeper layers with forward hooks
+        savers: Dict[int, LayerWiseFeatureSaver] = {}
+        handles: List[RemovableHandle] = []
+        for layer_idx in cache_layers:
+            if resume_layer is not None and layer_idx <= resume_layer:
+                continue
+            savers[layer_idx] = LayerWiseFeatureSaver(None, first_token_only=False)
+            handles.append(layers[layer_idx].register_forward_hook(savers[layer_idx]))
+
+        try:
+            if resume_layer is None:
+                log.info(f"Layer-wise feature cache miss for task {task_name}")
+                targets_list = []
+                for logits, targets in self._iter_logits(
+                    classifier, test_loader, task_name
+                ):
+                    targets_list.append(targets.detach().cpu())
+                    yield logits, targets
+            else:
+                log.info(
+                    f"Resuming the evaluation of task {task_name} from the cached outputs of layer {resume_layer}"
+                )
+                self._feature_cache.move_to_end(keys[resume_layer])
+                hidden_states_list, targets_list = self._feature_cache[keys[resume_layer]]
+                device = next(vision_model.parameters()).device
+                for hidden_states, targets in zip(hidden_states_list, targets_list):
+                    hidden_states = hidden_states.to(device)
+                    for layer in layers[resume_layer + 1 :]:
+                        hidden_states = layer(
+                            hidden_states, attention_mask=None, causal_attention_mask=None
+                        )[0]
+                    pooled_output = vision_model.post_layernorm(hidden_states[:, 0, :])
+                    image_embeds = classifier.clip_model.visual_projection(pooled_output)
+                    image_embeds = image_embeds / image_embeds.norm(
+                        p=2, dim=-1, keepdim=True
+                    )
+                    yield classifier.compute_logits(image_embeds), targets.to(device)
+        finally:
+            for handle in handles:
+                handle.remove()
+
+        # only reached if all the batches have been evaluated
+        for layer_idx, saver in savers.items():
+            self._put_features(keys[layer_idx], (saver.features, targets_list))
+
+    def _put_features(self, key: str, entry: Tuple[List[Tensor], List[Tensor]]):
+        self._feature_cache[key] = entry
+        if self.feature_cache_max_size is None:
+            return
+
+        def entry_size(entry):
+            return sum(t.nbytes for tensors in entry for t in tensors)
+
+        total_size = sum(entry_size(e) for e in self._feature_cache.values())
+        while total_size > self.feature_cache_max_size and len(self._feature_cache) > 1:
+            evicted_key, evicted_entry = self._feature_cache.popitem(last=False)
+            total_size -= entry_size(evicted_entry)
+            log.info(f"Evicted layer-wise feature cache entry {evicted_key}")
+
     def evaluate(
         self,
         model: Union[CLIPVisionModel, CLIPVisionTransformer],
@@ -312,34 +528,157 @@ class CLIPVisionModelTaskPool(
         )
         classifier = cast(HFCLIPClassifier, self.fabric.to_device(classifier))
         # collect basic model information
+        report["model_info"] = self._get_model_info(model, name)
+
+        # the text encoder is hashed once for all the tasks
+        zeroshot_head_cache = self.zeroshot_head_cache.for_text_encoder(self.clip_model)
+
+        # evaluate on each task
+        # the prefix fingerprints of the model are computed at the first task and reused by the others
+        self._prefix_fingerprints_memo = []
+        try:
+            pbar = tqdm(
+                self.test_dataloaders.items(),
+                desc="Evaluating tasks",
+                total=len(self.test_dataloaders),
+            )
+            for task_name, test_dataloader in pbar:
+                classnames, templates = get_classnames_and_templates(task_name)
+                self.on_task_evaluation_begin(classifier, task_name)
+                classifier.set_classification_task(
+                    classnames, templates, cache=zeroshot_head_cache
+                )
+                result = self._evaluate(
+                    classifier,
+                    test_dataloader,
+                    num_classes=len(classnames),
+                    task_name=task_name,
+                )
+                report[task_name] = result
+                self.on_task_evaluation_end()
+        finally:
+            self._prefix_fingerprints_memo = None
+
+        self._add_average_to_report(report)
+        log.info(f"Evaluation Result: {report}")
+        self._save_report(report)
+        return report
+
+    @torch.no_grad()
+    def evaluate_many(
+        self,
+        models: Union[
+            List[Union[CLIPVisionModel, CLIPVisionTransformer]],
+            Dict[str, Union[CLIPVisionModel, CLIPVisionTransformer]],
+        ],
+    ) -> List[Dict[str, Any]]:
+        """
+        Evaluate several models on the image classification tasks, iterating over each test dataloader once.
+
+        Every batch is preprocessed once and fed to all the vision models in turn, and the zero-shot
+        classification head of each task is computed once. The reports are the same as the ones of `evaluate`.
+        The hooks of `on_task_evaluation_begin` and `on_task_evaluation_end` are not called, so the
+        layer-wise features are not saved.
+
+        Args:
+            models (Union[List, Dict[str, Any]]): The models to evaluate. If a dict, its keys are logged
+                into the reports as the names of the models.
+
+        Returns:
+            List[Dict[str, Any]]: The evaluation report of each model, in the order of `models`.
+        """
+        if not self._is_setup:
+            self.setup()
+        if isinstance(models, Mapping):
+            names, models = list(models.keys()), list(models.values())
+        else:
+            names, models = [None] * len(models), list(models)
+        if self.layer_wise_feature_save_path is not None:
+            log.warning("Layer-wise features are not saved by `evaluate_many`.")
+
+        reports = [
+            {"model_info": self._get_model_info(model, name)}
+            for model, name in zip(models, names)
+        ]
+        original_vision_model = self.clip_model.vision_model
+        classifier = HFCLIPClassifier(self.clip_model, processor=self.processor)
+        classifier = cast(HFCLIPClassifier, self.fabric.to_device(classifier))
+        classifier.eval()
+        zeroshot_head_cache = self.zeroshot_head_cache.for_text_encoder(self.clip_model)
+        models = [self.fabric.to_device(model) for model in models]
+        for model in models:
+            model.eval()
+
+        try:
+            for task_name, test_loader in tqdm(
+                self.test_dataloaders.items(),
+                desc="Evaluating tasks",
+                total=len(self.test_dataloaders),
+            ):
+                classnames, templates = get_classnames_and_templates(task_name)
+                classifier.set_classification_task(
+                    classnames, templates, cache=zeroshot_head_cache
+                )
+                accuracies: List[MulticlassAccuracy] = [
+                    Accuracy(task="multiclass", num_classes=len(classnames))
+                    for _ in models
+                ]
+                loss_metrics = [MeanMetric() for _ in models]
+                if self.fast_dev_run:
+                    log.info(
+                        "Running under fast_dev_run mode, evaluating on a single batch."
+                    )
+                    test_loader = itertools.islice(test_loader, 1)
+
+                for batch in tqdm(
+                    test_loader,
+                    desc=f"Evaluating {task_name}",
+                    leave=False,
+                    dynamic_ncols=True,
+                ):
+                    if batch is None:
+                        continue  # all samples in batch were invalid
+                    inputs, targets = batch
+                    for model, accuracy, loss_metric in zip(
+                        models, accuracies, loss_metrics
+                    ):
+                        # the vision models share the text encoder of the classifier
+                        classifier.clip_model.vision_model = model
+                        logits: Tensor = classifier(inputs, task_name=task_name)
+                        loss = F.cross_entropy(logits, targets)
+                        loss_metric.update(loss.detach().cpu())
+                        accuracy(logits.detach().cpu(), targets.detach().cpu())
+
+                for report, accuracy, loss_metric in zip(
+                    reports, accuracies, loss_metrics
+                ):
+                    report[task_name] = {
+                        "accuracy": accuracy.compute().item(),
+                        "loss": loss_metric.compute().item(),
+                    }
+        finally:
+            self.clip_model.vision_model = original_vision_model
+
+        for report in reports:
+            self._add_average_to_report(report)
+            log.info(f"Evaluation Result: {report}")
+            self._save_report(report)
+        return reports
+
+    @staticmethod
+    def _get_model_info(model: nn.Module, name: Optional[str] = None) -> Dict[str, Any]:
         training_params, all_params = count_parameters(model)
-        report["model_info"] = {
+        model_info = {
             "trainable_params": training_params,
             "all_params": all_params,
             "trainable_percentage": training_params / all_params,
         }
         if name is not None:
-            report["model_info"]["name"] = name
-
-        # evaluate on each task
-        pbar = tqdm(
-            self.test_dataloaders.items(),
-            desc="Evaluating tasks",
-            total=len(self.test_dataloaders),
-        )
-        for task_name, test_dataloader in pbar:
-            classnames, templates = get_classnames_and_templates(task_name)
-            self.on_task_evaluation_begin(classifier, task_name)
-            classifier.set_classification_task(classnames, templates)
-            result = self._evaluate(
-                classifier,
-                test_dataloader,
-                num_classes=len(classnames),
-                task_name=task_name,
-            )
-            report[task_name] = result
-            self.on_task_evaluation_end()
+            model_info["name"] = name
+        return model_info
 
+    @staticmethod
+    def _add_average_to_report(report: Dict[str, Any]):
         # calculate the average accuracy and loss
         if "average" not in report:
             report["average"] = {}
@@ -356,7 +695,7 @@ class CLIPVisionModelTaskPool(
                 average_loss = sum(losses) / len(losses)
                 report["average"]["loss"] = average_loss
 
-        log.info(f"Evaluation Result: {report}")
+    def _save_report(self, report: Dict[str, Any]):
         if self.fabric.is_global_zero and len(self.fabric._loggers) > 0:
             save_path = os.path.join(self.log_dir, "report.json")
             for version in itertools.count(1):
@@ -367,7 +706,6 @@ class CLIPVisionModelTaskPool(
             with open(save_path, "w") as fp:
                 json.dump(report, fp)
             log.info(f"Evaluation report saved to {save_path}")
-        return report
 
     def on_task_evaluation_begin(self, classifier: HFCLIPClassifier, task_name: str):
         """
@@ -11,5 +11,6 @@ from .instantiate_utils import instantiate, is_instantiable
 from .misc import *
 from .packages import import_object
 from .parameters import *
+from .svd_scheduler import SVDScheduler
 from .timer import timeit_context
 from .lazy_state_dict import LazyStateDict
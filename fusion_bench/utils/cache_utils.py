@@ -1,11 +1,17 @@
+import hashlib
+import json
 import logging
 import os
 import pickle
+from contextlib import contextmanager
 from functools import wraps
 from pathlib import Path
-from typing import Any, Callable, Union
+from typing import Any, Callable, Dict, Mapping, Optional, Union
 
-__all__ = ["cache_to_disk"]
+import torch
+from torch import Tensor
+
+__all__ = ["cache_to_disk", "TensorCache", "state_dict_fingerprint"]
 
 
 log = logging.getLogger(__name__)
@@ -56,3 +62,156 @@ def cache_to_disk(file_path: Union[str, Path]) -> Callable:
         return wrapper
 
     return decorator
+
+
+def state_dict_fingerprint(state_dict: Mapping[str, Tensor]) -> str:
+    """
+    Compute a content hash of a state dict, including the names, dtypes, shapes and values of the tensors.
+
+    Args:
+        state_dict (Mapping[str, Tensor]): The state dict.
+
+    Returns:
+        str: The hexadecimal SHA-256 digest.
+    """
+    h = hashlib.sha256()
+    for name in sorted(state_dict.keys()):
+        tensor = state_dict[name].detach().cpu().contiguous()
+        h.update(f"{name}:{tensor.dtype}:{tuple(tensor.shape)}".encode())
+        h.update(tensor.reshape(-1).view(torch.uint8).numpy())
+    return h.hexdigest()
+
+
+class TensorCache:
+    """
+    A content-addressed on-disk cache of tensor dictionaries.
+
+    Every entry is stored as a safetensors file named after its key, which is written atomically,
+    so that several processes can share the cache. The size and the last access time of an entry are
+    the size and the modification time of its file, which is touched when the entry is loaded.
+    When `max_size` is set, the least recently used entries are evicted once the total size exceeds it.
+    Tensors that are shared by several names in an entry are stored once and shared again
+    when the entry is loaded.
+
+    ## Example usage
+
+    ```python
+    cache = TensorCache("outputs/cache/gram", max_size=20 * 1024**3)
+    key = TensorCache.make_key(model=model_hash, dataset=dataset_fingerprint, seed=42)
+    tensors = cache.get(key)
+    if tensors is None:
+        tensors = compute_tensors()
+        cache.put(key, tensors)
+    ```
+
+    Args:
+        cache_dir (str | Path): The directory of the cache.
+        max_size (Optional[int]): The maximum total size of the cache in bytes. No eviction if None.
+    """
+
+    LOCK_FILE = ".lock"
+
+    def __init__(self, cache_dir: Union[str, Path], max_size: Optional[int] = None):
+        self.cache_dir = Path(cache_dir)
+        self.max_size = max_size
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+    @staticmethod
+    def make_key(*args: Any, **kwargs: Any) -> str:
+        """
+        Build a key from JSON-serializable components. Non-serializable values are converted with `str`.
+        """
+        content = json.dumps([args, kwargs], sort_keys=True, default=str)
+        return hashlib.sha256(content.encode()).hexdigest()
+
+    def _entry_path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.safetensors"
+
+    def __contains__(self, key: str) -> bool:
+        return self._entry_path(key).exists()
+
+    def get(self, key: str) -> Optional[Dict[str, Tensor]]:
+        """
+        Load the entry `key`, or return None if it is not cached.
+        """
+        from safetensors import safe_open
+
+        path = self._entry_path(key)
+        tensors = {}
+        try:
+            with safe_open(path, framework="pt") as f:
+                for name in f.keys():
+                    tensors[name] = f.get_tensor(name)
+                metadata = f.metadata() or {}
+            # record the access for the eviction
+            os.utime(path)
+        except FileNotFoundError:
+            # not cached, or evicted by another process
+            return None
+        for name, owner_name in json.loads(metadata.get("shared", "{}")).items():
+            tensors[name] = tensors[owner_name]
+
+        log.debug(f"Loaded cached tensors from {path}")
+        return tensors
+
+    def put(self, key: str, tensors: Mapping[str, Tensor]):
+        """
+        Save `tensors` as the entry `key` and evict the least recently used entries if needed.
+        """
+        from safetensors.torch import save_file
+
+        unique_tensors, shared = {}, {}
+        owners: Dict[int, str] = {}
+        for name, tensor in tensors.items():
+            if id(tensor) in owners:
+                shared[name] = owners[id(tensor)]
+            else:
+                owners[id(tensor)] = name
+                unique_tensors[name] = tensor.detach().cpu().contiguous()
+
+        path = self._entry_path(key)
+        tmp_path = self.cache_dir / f"{key}.safetensors.{os.getpid()}.tmp"
+        save_file(unique_tensors, tmp_path, metadata={"shared": json.dumps(shared)})
+        os.replace(tmp_path, path)
+
+        if self.max_size is not None:
+            with self._lock():
+                self._evict(keep=key)
+
+    @contextmanager
+    def _lock(self):
+        """
+        Exclusive lock of the cache directory between processes, where `fcntl` is available.
+        """
+        try:
+            import fcntl
+        except ImportError:
+            yield
+            return
+        with open(self.cache_dir / self.LOCK_FILE, "w") as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def _evict(self, keep: Optional[str] = None):
+        entries = []
+        for path in self.cache_dir.glob("*.safetensors"):
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        total_size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries, key=lambda entry: entry[0]):
+            if total_size <= self.max_size:
+                break
+            if path == self._entry_path(keep):
+                continue
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            total_size -= size
+            log.info(f"Evicted cache entry {path.stem} from {self.cache_dir}")
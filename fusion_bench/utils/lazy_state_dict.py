@@ -1,6 +1,7 @@
 import json
 import logging
 import os
+import struct
 from typing import TYPE_CHECKING, Dict, Iterator, List, Optional, Tuple
 
 import torch
@@ -19,6 +20,45 @@ log = logging.getLogger(__name__)
 
 __all__ = ["resolve_checkpoint_path", "LazyStateDict"]
 
+# dtype names used in the header of safetensors files
+_SAFETENSORS_DTYPES = {
+    "F64": torch.float64,
+    "F32": torch.float32,
+    "F16": torch.float16,
+    "BF16": torch.bfloat16,
+    "I64": torch.int64,
+    "I32": torch.int32,
+    "I16": torch.int16,
+    "I8": torch.int8,
+    "U8": torch.uint8,
+    "BOOL": torch.bool,
+}
+if hasattr(torch, "float8_e4m3fn"):
+    _SAFETENSORS_DTYPES["F8_E4M3"] = torch.float8_e4m3fn
+if hasattr(torch, "float8_e5m2"):
+    _SAFETENSORS_DTYPES["F8_E5M2"] = torch.float8_e5m2
+
+
+def _mmap_safetensors(checkpoint_file: str) -> Tuple[torch.Tensor, Dict, int]:
+    """
+    Memory-map a safetensors file.
+
+    Returns:
+        Tuple[torch.Tensor, Dict, int]: A uint8 tensor backed by the mapped file, the header of the file
+            and the offset of the tensor data in the file.
+    """
+    with open(checkpoint_file, "rb") as f:
+        (header_size,) = struct.unpack("<Q", f.read(8))
+        header = json.loads(f.read(header_size))
+    header.pop("__metadata__", None)
+    # `shared=False` maps the file copy-on-write, the pages are read from the page cache on access
+    # and are shared with the other processes mapping the same file.
+    storage = torch.UntypedStorage.from_file(
+        checkpoint_file, shared=False, nbytes=os.path.getsize(checkpoint_file)
+    )
+    buffer = torch.empty(0, dtype=torch.uint8).set_(storage)
+    return buffer, header, 8 + header_size
+
 
 def resolve_checkpoint_path(
     checkpoint: str,
@@ -48,6 +88,12 @@ def resolve_checkpoint_path(
 class LazyStateDict:
     """
     Dictionary-like object that lazily loads a state dict from a checkpoint path.
+
+    With `mmap=True`, the tensors are views of the memory-mapped checkpoint files instead of copies:
+    no data is read until a tensor is accessed, only the accessed pages are read, and the pages are
+    shared through the page cache by all the processes loading the same checkpoint.
+    If `torch_dtype` is None, the tensors keep the dtype of the checkpoint, so consumers can convert
+    them block by block (e.g. `tensor.flatten()[start:end].float()`) without materializing a converted copy.
     """
 
     _local_path: str
@@ -65,6 +111,7 @@ class LazyStateDict:
         hf_revision: Optional[str] = None,
         hf_cache_dir: Optional[str] = None,
         hf_proxies: Optional[Dict] = None,
+        mmap: bool = False,
     ):
         self._checkpoint = checkpoint
         self._local_path = resolve_checkpoint_path(
@@ -85,6 +132,18 @@ class LazyStateDict:
 
         self._torch_dtype = parse_dtype(torch_dtype)
         self._device = device
+        self._mmap = mmap
+        # checkpoint file -> (mapped buffer, header, data offset)
+        self._mmap_files: Dict[str, Tuple[torch.Tensor, Dict, int]] = {}
+        # checkpoint file (.bin) -> memory-mapped state dict
+        self._mmap_state_dicts: Dict[str, Dict[str, torch.Tensor]] = {}
+
+    def __getstate__(self):
+        # the mapped files are not pickled, each process maps them again
+        state = self.__dict__.copy()
+        state["_mmap_files"] = {}
+        state["_mmap_state_dicts"] = {}
+        return state
 
     @property
     def checkpoint(self) -> str:
@@ -101,6 +160,7 @@ class LazyStateDict:
         # reference: https://huggingface.co/docs/accelerate/v0.17.1/en/usage_guides/big_modeling
         checkpoint_files = None
         index_filename = None
+        index = None
         if os.path.isfile(checkpoint):
             if str(checkpoint).endswith(".json"):
                 index_filename = checkpoint
@@ -157,6 +217,14 @@ class LazyStateDict:
     def _load_tensor_from_checkpoint_file(
         self, checkpoint_file: str, key: str, update_cache: bool = True
     ) -> torch.Tensor:
+        if self._mmap:
+            tensor = self._load_mmap_tensor(checkpoint_file, key, update_cache)
+            if self._torch_dtype is not None:
+                tensor = tensor.to(self._torch_dtype)
+            tensor = tensor.to(self._device)
+            if update_cache and self._state_dict_cache is not None:
+                self._state_dict_cache[key] = tensor
+            return tensor
         if checkpoint_file.endswith(".safetensors"):
             with safe_open(checkpoint_file, framework="pt", device=self._device) as f:
                 tensor = f.get_tensor(key)
@@ -176,6 +244,31 @@ class LazyStateDict:
                     )
             return state_dict[key]
 
+    def _load_mmap_tensor(
+        self, checkpoint_file: str, key: str, update_cache: bool
+    ) -> torch.Tensor:
+        if not checkpoint_file.endswith(".safetensors"):
+            if checkpoint_file not in self._mmap_state_dicts:
+                self._mmap_state_dicts[checkpoint_file] = torch.load(
+                    checkpoint_file, map_location="cpu", mmap=True, weights_only=True
+                )
+            state_dict = self._mmap_state_dicts[checkpoint_file]
+            if update_cache and self._state_dict_cache is not None:
+                self._state_dict_cache.update(state_dict)
+            return state_dict[key]
+
+        if checkpoint_file not in self._mmap_files:
+            self._mmap_files[checkpoint_file] = _mmap_safetensors(checkpoint_file)
+        buffer, header, data_offset = self._mmap_files[checkpoint_file]
+        info = header[key]
+        dtype = _SAFETENSORS_DTYPES[info["dtype"]]
+        start, end = info["data_offsets"]
+        data = buffer[data_offset + start : data_offset + end]
+        if (data_offset + start) % torch.empty(0, dtype=dtype).element_size() != 0:
+            # safetensors does not guarantee aligned offsets, a misaligned tensor is copied
+            data = data.clone()
+        return data.view(dtype).view(info["shape"])
+
     def __getitem__(self, key: str) -> torch.Tensor:
         if self._state_dict_cache is not None and key in self._state_dict_cache:
             return self._state_dict_cache[key]
@@ -227,6 +320,16 @@ class LazyStateDict:
                 return False
         return False
 
+    def _bin_checkpoint_keys(self, checkpoint_file: str) -> Tuple[str, ...]:
+        # memory-map the file to list its keys without reading the tensors
+        if checkpoint_file in self._mmap_state_dicts:
+            return tuple(self._mmap_state_dicts[checkpoint_file].keys())
+        return tuple(
+            torch.load(
+                checkpoint_file, map_location="cpu", mmap=True, weights_only=True
+            ).keys()
+        )
+
     def __len__(self) -> int:
         if self._index is not None:
             return len(self._index)
@@ -238,9 +341,7 @@ class LazyStateDict:
                 with safe_open(checkpoint_file, framework="pt", device="cpu") as f:
                     return len(tuple(f.keys()))
             else:
-                return len(
-                    tuple(torch.load(checkpoint_file, map_location="cpu").keys())
-                )
+                return len(self._bin_checkpoint_keys(checkpoint_file))
         raise RuntimeError(
             "Unexpected error: cannot determine the number of keys in the state dict."
         )
@@ -248,6 +349,15 @@ class LazyStateDict:
     def __iter__(self) -> Iterator[str]:
         if self._index is not None:
             return iter(self._index)
+        if len(self._checkpoint_files) == 1 and os.path.isfile(
+            self._checkpoint_files[0]
+        ):
+            checkpoint_file = self._checkpoint_files[0]
+            if checkpoint_file.endswith(".safetensors"):
+                with safe_open(checkpoint_file, framework="pt", device="cpu") as f:
+                    return iter(tuple(f.keys()))
+            else:
+                return iter(self._bin_checkpoint_keys(checkpoint_file))
         return iter(self._checkpoint_files)
 
     def keys(self) -> List[str]:
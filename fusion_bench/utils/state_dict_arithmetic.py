@@ -1,6 +1,18 @@
+import functools
 from collections import OrderedDict
 from numbers import Number
-from typing import Callable, Dict, List, Literal, Union, cast
+from typing import (
+    Callable,
+    Dict,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Tuple,
+    Union,
+    cast,
+)
 
 import torch
 from torch import Tensor
@@ -367,3 +379,320 @@ def state_dict_hadmard_product(a: StateDictType, b: StateDictType) -> StateDictT
     for key in a:
         ans[key] = a[key] * b[key]
     return ans
+
+
+class FlatStateDict(Mapping[str, Tensor]):
+    """
+    A state dict whose tensors are views of one contiguous flat buffer.
+
+    The tensors are stored one after the other in `buffer`, and `index` maps each key to the offset
+    and the shape of its tensor. Arithmetic between flat state dicts with the same keys and shapes runs
+    as a single vectorized operation on the buffers, and every operation has an in-place version
+    (e.g. `add_`) and an out-of-place version with an optional `out` argument to reuse a buffer.
+    A flat state dict can be used wherever a `Mapping[str, Tensor]` is expected, e.g. `load_state_dict`.
+
+    Examples:
+        >>> pretrained = FlatStateDict.from_state_dict(pretrained_model.state_dict())
+        >>> merged = FlatStateDict.zeros_like(pretrained)
+        >>> for model in finetuned_models:
+        ...     merged.add_(model.state_dict())
+        >>> # pretrained + scaling_factor * sum_i (finetuned_i - pretrained)
+        >>> merged.sub_(pretrained, alpha=len(finetuned_models)).mul_(scaling_factor).add_(pretrained)
+        >>> pretrained_model.load_state_dict(merged)
+    """
+
+    def __init__(
+        self,
+        buffer: Tensor,
+        index: "OrderedDict[str, Tuple[int, torch.Size]]",
+    ):
+        """
+        Args:
+            buffer (Tensor): The one-dimensional buffer holding all the tensors.
+            index (OrderedDict[str, Tuple[int, torch.Size]]): The offset and the shape of each tensor in the buffer.
+        """
+        assert buffer.dim() == 1, "The buffer of a FlatStateDict must be one-dimensional"
+        self.buffer = buffer
+        self.index = index
+
+    @classmethod
+    def from_state_dict(
+        cls,
+        state_dict: Mapping[str, Tensor],
+        dtype: Optional[torch.dtype] = None,
+        device: Optional[Union[torch.device, str]] = None,
+    ) -> "FlatStateDict":
+        """
+        Copy a state dict into a new flat buffer.
+
+        Args:
+            state_dict (Mapping[str, Tensor]): The state dict to copy.
+            dtype (Optional[torch.dtype]): The dtype of the buffer. Defaults to the promoted dtype of all the tensors,
+                and at least float32 if some tensors are not floating-point (e.g. integer buffers), so that they are
+                represented exactly up to 2**24.
+            device (Optional[Union[torch.device, str]]): The device of the buffer. Defaults to the device of the first tensor.
+
+        Returns:
+            FlatStateDict: The flat copy of the state dict.
+        """
+        assert len(state_dict) > 0, "The state dict must not be empty"
+        tensors = list(state_dict.values())
+        if dtype is None:
+            dtype = functools.reduce(
+                torch.promote_types, (tensor.dtype for tensor in tensors)
+            )
+            if not all(tensor.is_floating_point() for tensor in tensors):
+                dtype = torch.promote_types(dtype, torch.float32)
+        if device is None:
+            device = tensors[0].device
+
+        index = OrderedDict()
+        offset = 0
+        for key, tensor in state_dict.items():
+            index[key] = (offset, tensor.shape)
+            offset += tensor.numel()
+        flat_state_dict = cls(torch.empty(offset, dtype=dtype, device=device), index)
+        return flat_state_dict.copy_(state_dict)
+
+    @classmethod
+    def empty_like(
+        cls, other: "FlatStateDict", dtype: Optional[torch.dtype] = None
+    ) -> "FlatStateDict":
+        """Return an uninitialized flat state dict with the same keys and shapes as `other`."""
+        return cls(torch.empty_like(other.buffer, dtype=dtype), other.index)
+
+    @classmethod
+    def zeros_like(
+        cls, other: "FlatStateDict", dtype: Optional[torch.dtype] = None
+    ) -> "FlatStateDict":
+        """Return a flat state dict of zeros with the same keys and shapes as `other`."""
+        return cls(torch.zeros_like(other.buffer, dtype=dtype), other.index)
+
+    def __getitem__(self, key: str) -> Tensor:
+        offset, shape = self.index[key]
+        return self.buffer[offset : offset + shape.numel()].view(shape)
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.index)
+
+    def __len__(self) -> int:
+        return len(self.index)
+
+    def __repr__(self) -> str:
+        return (
+            f"{type(self).__name__}(num_tensors={len(self)}, numel={self.buffer.numel()}, "
+            f"dtype={self.buffer.dtype}, device={self.buffer.device})"
+        )
+
+    def to_state_dict(self) -> StateDictType:
+        """Return an ordered dict of views of the buffer."""
+        return OrderedDict((key, self[key]) for key in self.index)
+
+    def clone(self) -> "FlatStateDict":
+        return type(self)(self.buffer.clone(), self.index)
+
+    def to(self, *args, **kwargs) -> "FlatStateDict":
+        """Move or cast the buffer, see `torch.Tensor.to`."""
+        return type(self)(self.buffer.to(*args, **kwargs), self.index)
+
+    def _same_layout(self, other: "FlatStateDict") -> bool:
+        return other.index is self.index or other.index == self.index
+
+    def _other_buffer(self, other: Union["FlatStateDict", Tensor, Number]):
+        if isinstance(other, FlatStateDict):
+            if not self._same_layout(other):
+                raise ValueError(
+                    "The flat state dicts must have the same keys and shapes"
+                )
+            return other.buffer
+        return other
+
+    def _out(self, out: Optional["FlatStateDict"], dtype=None) -> "FlatStateDict":
+        if out is None:
+            return FlatStateDict.empty_like(self, dtype=dtype)
+        if not self._same_layout(out):
+            raise ValueError("`out` must have the same keys and shapes")
+        return out
+
+    # ---------- in-place operations ----------
+
+    @torch.no_grad()
+    def copy_(self, other: Mapping[str, Tensor]) -> "FlatStateDict":
+        """Copy the tensors of `other` into the buffer."""
+        if isinstance(other, FlatStateDict):
+            self.buffer.copy_(self._other_buffer(other), non_blocking=True)
+        else:
+            for key in self.index:
+                self[key].copy_(other[key], non_blocking=True)
+        return self
+
+    def add_(
+        self,
+        other: Union[Mapping[str, Tensor], Number],
+        alpha: Number = 1,
+    ) -> "FlatStateDict":
+        """`self += alpha * other`, where `other` is a state dict or a scalar."""
+        if isinstance(other, Mapping) and not isinstance(other, FlatStateDict):
+            for key in self.index:
+                self[key].add_(other[key], alpha=alpha)
+        else:
+            self.buffer.add_(self._other_buffer(other), alpha=alpha)
+        return self
+
+    def sub_(
+        self,
+        other: Union[Mapping[str, Tensor], Number],
+        alpha: Number = 1,
+    ) -> "FlatStateDict":
+        """`self -= alpha * other`, where `other` is a state dict or a scalar."""
+        return self.add_(other, alpha=-alpha)
+
+    def mul_(self, other: Union["FlatStateDict", Number]) -> "FlatStateDict":
+        """Element-wise `self *= other`, where `other` is a flat state dict or a scalar."""
+        self.buffer.mul_(self._other_buffer(other))
+        return self
+
+    def div_(self, other: Union["FlatStateDict", Number]) -> "FlatStateDict":
+        """Element-wise `self /= other`, where `other` is a flat state dict or a scalar."""
+        self.buffer.div_(self._other_buffer(other))
+        return self
+
+    def pow_(self, p: Number) -> "FlatStateDict":
+        self.buffer.pow_(p)
+        return self
+
+    def abs_(self) -> "FlatStateDict":
+        self.buffer.abs_()
+        return self
+
+    # ---------- out-of-place operations ----------
+
+    def add(
+        self,
+        other: Union["FlatStateDict", Number],
+        alpha: Number = 1,
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """Return `self + alpha * other`."""
+        out = self._out(out)
+        torch.add(self.buffer, self._other_buffer(other), alpha=alpha, out=out.buffer)
+        return out
+
+    def sub(
+        self,
+        other: Union["FlatStateDict", Number],
+        alpha: Number = 1,
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """Return `self - alpha * other`."""
+        out = self._out(out)
+        torch.sub(self.buffer, self._other_buffer(other), alpha=alpha, out=out.buffer)
+        return out
+
+    def mul(
+        self,
+        other: Union["FlatStateDict", Number],
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """Return the element-wise product `self * other`."""
+        out = self._out(out)
+        torch.mul(self.buffer, self._other_buffer(other), out=out.buffer)
+        return out
+
+    def div(
+        self,
+        other: Union["FlatStateDict", Number],
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """Return the element-wise division `self / other`."""
+        out = self._out(out)
+        torch.div(self.buffer, self._other_buffer(other), out=out.buffer)
+        return out
+
+    def pow(self, p: Number, out: Optional["FlatStateDict"] = None) -> "FlatStateDict":
+        out = self._out(out)
+        torch.pow(self.buffer, p, out=out.buffer)
+        return out
+
+    def abs(self, out: Optional["FlatStateDict"] = None) -> "FlatStateDict":
+        out = self._out(out)
+        torch.abs(self.buffer, out=out.buffer)
+        return out
+
+    def binary_mask(
+        self,
+        other: Union["FlatStateDict", Number],
+        compare_fn: Literal["greater", "less", "equal", "not_equal"] = "greater",
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """
+        Return the boolean mask of the element-wise comparison of `self` and `other`,
+        see `state_dict_binary_mask`.
+        """
+        compare_fn_dict = {
+            "greater": torch.gt,
+            "less": torch.lt,
+            "equal": torch.eq,
+            "not_equal": torch.ne,
+        }
+        out = self._out(out, dtype=torch.bool)
+        compare_fn_dict[compare_fn](
+            self.buffer, self._other_buffer(other), out=out.buffer
+        )
+        return out
+
+    __add__ = add
+    __sub__ = sub
+    __mul__ = mul
+    __rmul__ = mul
+    __truediv__ = div
+    __iadd__ = add_
+    __isub__ = sub_
+    __imul__ = mul_
+    __itruediv__ = div_
+
+    def __neg__(self) -> "FlatStateDict":
+        return type(self)(torch.neg(self.buffer), self.index)
+
+    # ---------- reductions over several flat state dicts ----------
+
+    @staticmethod
+    def weighted_sum(
+        flat_state_dicts: List["FlatStateDict"],
+        weights: List[Number],
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """
+        Return `sum_i weights[i] * flat_state_dicts[i]`, accumulated into `out` if given.
+        """
+        assert len(flat_state_dicts) == len(
+            weights
+        ), "The number of state_dicts and weights must be the same"
+        assert (
+            len(flat_state_dicts) > 0
+        ), "The number of state_dicts must be greater than 0"
+        first = flat_state_dicts[0]
+        out = first._out(out)
+        torch.mul(first.buffer, weights[0], out=out.buffer)
+        for flat_state_dict, weight in zip(flat_state_dicts[1:], weights[1:]):
+            out.buffer.add_(first._other_buffer(flat_state_dict), alpha=weight)
+        return out
+
+    @staticmethod
+    def sum(
+        flat_state_dicts: List["FlatStateDict"],
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """Return the sum of the flat state dicts."""
+        return FlatStateDict.weighted_sum(
+            flat_state_dicts, [1] * len(flat_state_dicts), out=out
+        )
+
+    @staticmethod
+    def avg(
+        flat_state_dicts: List["FlatStateDict"],
+        out: Optional["FlatStateDict"] = None,
+    ) -> "FlatStateDict":
+        """Return the average of the flat state dicts."""
+        out = FlatStateDict.sum(flat_state_dicts, out=out)
+        return out.div_(len(flat_state_dicts))
@@ -0,0 +1,204 @@
+"""
+Schedule many independent matrix decompositions (e.g. one SVD per layer).
+"""
+
+import logging
+import os
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import (
+    Any,
+    Callable,
+    Deque,
+    Dict,
+    Hashable,
+    Iterable,
+    Iterator,
+    List,
+    Literal,
+    Mapping,
+    Optional,
+    Tuple,
+    TypeVar,
+    Union,
+)
+
+import torch
+from torch import Tensor
+
+from .devices import to_device
+
+log = logging.getLogger(__name__)
+
+__all__ = ["SVDScheduler"]
+
+K = TypeVar("K", bound=Hashable)
+
+
+def _reduced_svd(matrix: Tensor) -> Tuple[Tensor, Tensor, Tensor]:
+    return torch.linalg.svd(matrix, full_matrices=False)
+
+
+class SVDScheduler:
+    """
+    Run a decomposition function over many independent matrices.
+
+    - "sequential": one matrix after the other, as a plain Python loop would.
+    - "batched": matrices with the same shape, dtype and device are stacked and decomposed with a
+      single call, e.g. a batched `torch.linalg.svd`. At most `max_batch_bytes` of inputs are stacked at once.
+    - "threads": the matrices are decomposed by a pool of `num_workers` threads (PyTorch releases the GIL
+      in its linear algebra kernels), with at most `2 * num_workers` matrices in flight. The intra-op threads
+      of PyTorch are split among the workers, the thread count of the caller is left unchanged.
+
+    In all modes the inputs are consumed lazily and the results are yielded in the order of the inputs,
+    so that a generator of matrices keeps the memory bounded.
+
+    Examples:
+        >>> scheduler = SVDScheduler(mode="threads", num_workers=8)
+        >>> results = scheduler.map({name: w for name, w in state_dict.items() if w.dim() == 2})
+        >>> u, s, vh = results["layer.0.weight"]
+
+    Args:
+        mode (Literal["sequential", "batched", "threads"]): How the decompositions are run.
+        num_workers (Optional[int]): The number of threads in "threads" mode. Defaults to the number of CPUs.
+        max_batch_bytes (Optional[int]): The maximum size of the stacked inputs in "batched" mode. Defaults to 1 GiB.
+        accelerator (Optional[Union[str, torch.device]]): The device to run the decompositions on.
+            The results are moved back to the device of the inputs.
+    """
+
+    def __init__(
+        self,
+        mode: Literal["sequential", "batched", "threads"] = "sequential",
+        num_workers: Optional[int] = None,
+        max_batch_bytes: Optional[int] = None,
+        accelerator: Optional[Union[str, torch.device]] = None,
+    ):
+        if mode not in ("sequential", "batched", "threads"):
+            raise ValueError(f"Unknown SVD scheduler mode: {mode}")
+        self.mode = mode
+        self.num_workers = (
+            num_workers if num_workers is not None else (os.cpu_count() or 1)
+        )
+        self.max_batch_bytes = (
+            max_batch_bytes if max_batch_bytes is not None else 2**30
+        )
+        self.accelerator = accelerator
+
+    def _run(self, fn: Callable[[Tensor], Any], matrix: Tensor) -> Any:
+        if self.accelerator is None:
+            return fn(matrix)
+        original_device = matrix.device
+        return to_device(fn(matrix.to(self.accelerator)), original_device)
+
+    def imap(
+        self,
+        matrices: Union[Mapping[K, Tensor], Iterable[Tuple[K, Tensor]]],
+        svd_fn: Optional[Callable[[Tensor], Any]] = None,
+    ) -> Iterator[Tuple[K, Any]]:
+        """
+        Decompose the matrices and yield `(key, svd_fn(matrix))` in the order of the inputs.
+
+        Args:
+            matrices (Union[Mapping[K, Tensor], Iterable[Tuple[K, Tensor]]]): The matrices to decompose, as a mapping
+                or an iterable of `(key, matrix)` pairs.
+            svd_fn (Optional[Callable[[Tensor], Any]]): The decomposition, returning a tensor or a tuple of tensors.
+                Defaults to `torch.linalg.svd(matrix, full_matrices=False)`. In "batched" mode it is called on
+                stacked matrices of shape (batch_size, m, n) and its outputs are split along the first dimension.
+        """
+        if svd_fn is None:
+            svd_fn = _reduced_svd
+        if isinstance(matrices, Mapping):
+            matrices = matrices.items()
+
+        if self.mode == "sequential":
+            for key, matrix in matrices:
+                yield key, self._run(svd_fn, matrix)
+        elif self.mode == "batched":
+            yield from self._imap_batched(matrices, svd_fn)
+        else:
+            yield from self._imap_threads(matrices, svd_fn)
+
+    def map(
+        self,
+        matrices: Union[Mapping[K, Tensor], Iterable[Tuple[K, Tensor]]],
+        svd_fn: Optional[Callable[[Tensor], Any]] = None,
+    ) -> Dict[K, Any]:
+        """
+        Decompose the matrices and return the results as a dict. See `imap`.
+        """
+        return dict(self.imap(matrices, svd_fn=svd_fn))
+
+    def _imap_batched(
+        self,
+        matrices: Iterable[Tuple[K, Tensor]],
+        svd_fn: Callable[[Tensor], Any],
+    ) -> Iterator[Tuple[K, Any]]:
+        pending: List[Tuple[K, Tensor]] = []
+        pending_bytes = 0
+        for key, matrix in matrices:
+            pending.append((key, matrix))
+            pending_bytes += matrix.nbytes
+            if pending_bytes >= self.max_batch_bytes:
+                yield from self._run_batches(pending, svd_fn)
+                pending, pending_bytes = [], 0
+        if len(pending) > 0:
+            yield from self._run_batches(pending, svd_fn)
+
+    def _run_batches(
+        self,
+        pending: List[Tuple[K, Tensor]],
+        svd_fn: Callable[[Tensor], Any],
+    ) -> Iterator[Tuple[K, Any]]:
+        # group the matrices with the same shape, dtype and device
+        groups: Dict[Tuple, List[int]] = {}
+        for idx, (_, matrix) in enumerate(pending):
+            groups.setdefault(
+                (tuple(matrix.shape), matrix.dtype, matrix.device), []
+            ).append(idx)
+
+        results: List[Any] = [None] * len(pending)
+        for indices in groups.values():
+            if len(indices) == 1:
+                results[indices[0]] = self._run(svd_fn, pending[indices[0]][1])
+                continue
+            outputs = self._run(
+                svd_fn, torch.stack([pending[idx][1] for idx in indices])
+            )
+            if isinstance(outputs, Tensor):
+                for idx, output in zip(indices, outputs.unbind(0)):
+                    results[idx] = output
+            else:
+                for idx, output in zip(
+                    indices, zip(*(output.unbind(0) for output in outputs))
+                ):
+                    results[idx] = tuple(output)
+
+        for (key, _), result in zip(pending, results):
+            yield key, result
+
+    def _imap_threads(
+        self,
+        matrices: Iterable[Tuple[K, Tensor]],
+        svd_fn: Callable[[Tensor], Any],
+    ) -> Iterator[Tuple[K, Any]]:
+        # the grad mode is thread-local, the workers use the one of the caller
+        grad_enabled = torch.is_grad_enabled()
+        # the intra-op threads are split among the workers, the thread count is only set in the
+        # worker threads, so the caller keeps its own while it consumes the results
+        num_threads = max(torch.get_num_threads() // self.num_workers, 1)
+
+        def run(matrix: Tensor):
+            torch.set_num_threads(num_threads)
+            with torch.set_grad_enabled(grad_enabled):
+                return self._run(svd_fn, matrix)
+
+        with ThreadPoolExecutor(max_workers=self.num_workers) as executor:
+            futures: Deque[Tuple[K, Future]] = deque()
+            for key, matrix in matrices:
+                futures.append((key, executor.submit(run, matrix)))
+                if len(futures) >= 2 * self.num_workers:
+                    key, future = futures.popleft()
+                    yield key, future.result()
+            while len(futures) > 0:
+                key, future = futures.popleft()
+                yield key, future.result()